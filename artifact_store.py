@@ -0,0 +1,237 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+import config
+
+class ArtifactStore:
+    """
+    A class for keeping the intermediate products of a run (aligned inputs, intensity, damage, risk raster, statistics)
+    on disk, keyed by a hash of everything they were computed from, so a rerun only recomputes the stages whose inputs
+    changed
+    """
+    def __init__(self, store_dir, max_size_mb=8192):
+        """
+        Initializes the ArtifactStore object.
+
+        :param store_dir: Directory where the artifacts are stored, one folder per artifact
+        :param max_size_mb: Size limit of the store in megabytes, the least recently used artifacts are removed above it
+        """
+        self.store_dir = store_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = {}
+        self.misses = {}
+        # Folders of the artifacts loaded or stored in the current run, they are memory-mapped or used by later stages
+        # and are never evicted during the run
+        self.in_use = set()
+        os.makedirs(store_dir, exist_ok=True)
+
+    def begin_run(self):
+        """
+        Starts a new run: the artifacts of earlier runs are no longer protected from the eviction. A store that is
+        reused for many runs (batch or worker processes) only protects the artifacts of the current one.
+        """
+        self.in_use = set()
+
+    @staticmethod
+    def key(stage, **parts):
+        """
+        Builds the key of an artifact. Stages that depend on another stage take its key as one of the parts, so a
+        change anywhere upstream changes every key below it.
+
+        :param stage: Name of the stage, e.g. "damage"
+        :param parts: Everything the artifact is computed from (JSON-compatible values)
+        :return: String "<stage>-<SHA-256 of the parts>"
+        """
+        digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+        return f"{stage}-{digest}"
+
+    def _path(self, key):
+        """
+        Returns the folder of an artifact.
+        """
+        return os.path.join(self.store_dir, key)
+
+    def get(self, key):
+        """
+        Opens a stored artifact, arrays are memory-mapped without copying them into RAM.
+
+        :param key: Artifact key from key()
+        :return: Dictionary of name -> read-only numpy memmap (for .npy files) or file path, or None if not stored
+        """
+        stage = key.split("-")[0]
+        artifact = self.load(key)
+        if artifact is None:
+            self.misses[stage] = self.misses.get(stage, 0) + 1
+        else:
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+        return artifact
+
+    def load(self, key):
+        """
+        Opens a stored artifact like get(), without counting a hit or miss (e.g. right after it was stored).
+
+        :param key: Artifact key from key()
+        :return: Dictionary of name -> read-only numpy memmap or file path, or None if not stored
+        """
+        path = self._path(key)
+        if not os.path.isdir(path):
+            return None
+
+        os.utime(path)  # Mark as recently used for the LRU eviction
+        self.in_use.add(path)
+        artifact = {}
+        for name in os.listdir(path):
+            file_path = os.path.join(path, name)
+            if name.endswith(".npy"):
+                artifact[name[:-4]] = np.load(file_path, mmap_mode="r")
+            else:
+                artifact[name] = file_path
+        return artifact
+
+    @contextmanager
+    def put(self, key):
+        """
+        Stores a new artifact. The files are written into a temporary folder that only gets the final name when the
+        block exits without an error, so an interrupted run never leaves a broken artifact.
+
+        :param key: Artifact key from key()
+        :return: Context manager yielding an ArtifactWriter
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        try:
+            writer = ArtifactWriter(tmp_path)
+            yield writer
+            writer.close()
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                pass  # Another worker stored the same artifact first, both are identical
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.in_use.add(path)
+        self._evict()
+
+    def _entries(self):
+        """
+        Returns (last use, size, path) of every stored artifact.
+        """
+        entries = []
+        for name in os.listdir(self.store_dir):
+            path = os.path.join(self.store_dir, name)
+            if os.path.isdir(path) and not name.endswith(".tmp"):
+                size = sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+        return entries
+
+    def _evict(self):
+        """
+        Removes the least recently used artifacts until the store is below its size limit. The artifacts used in the
+        current run (see begin_run()) are kept, even if the store stays above the limit.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path not in self.in_use:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    def size(self):
+        """
+        Returns the number of stored artifacts and their total size in bytes.
+        """
+        entries = self._entries()
+        return len(entries), sum(size for _, size, _ in entries)
+
+    def clear(self):
+        """
+        Removes all stored artifacts.
+
+        :return: Number of removed artifacts
+        """
+        entries = self._entries()
+        for _, _, path in entries:
+            shutil.rmtree(path, ignore_errors=True)
+        return len(entries)
+
+    def report(self):
+        """
+        Returns the hit and miss counts of every stage as text.
+        """
+        stages = sorted(set(self.hits) | set(self.misses))
+        counts = ", ".join(f"{stage} {self.hits.get(stage, 0)}/{self.misses.get(stage, 0)}" for stage in stages)
+        return f"Artifact store (hits/misses): {counts or 'not used'}"
+
+
+class ArtifactWriter:
+    """
+    A class for writing the files of a new artifact
+    """
+    def __init__(self, path):
+        self.path = path
+        self.arrays = {}
+
+    def array(self, name, shape, dtype):
+        """
+        Creates an array of the artifact as a writable memmap, so it can be filled block by block.
+
+        :param name: Name of the array
+        :param shape: Shape of the array
+        :param dtype: numpy dtype of the array
+        :return: numpy memmap
+        """
+        self.arrays[name] = np.lib.format.open_memmap(os.path.join(self.path, f"{name}.npy"), mode="w+", dtype=dtype, shape=shape)
+        return self.arrays[name]
+
+    def write_block(self, name, shape, window, block):
+        """
+        Writes one window of an array, the array is created with the dtype of the first block.
+
+        :param name: Name of the array
+        :param shape: Shape of the whole array
+        :param window: rasterio Window of the block
+        :param block: numpy array with the values of the window
+        """
+        if name not in self.arrays:
+            self.array(name, shape, block.dtype)
+        self.arrays[name][window.toslices()] = block
+
+    def file(self, name, source_path):
+        """
+        Copies a file (e.g. the risk GeoTIFF) into the artifact.
+
+        :param name: File name inside the artifact
+        :param source_path: Path of the file to copy
+        """
+        shutil.copyfile(source_path, os.path.join(self.path, name))
+
+    def close(self):
+        """
+        Flushes the arrays to disk.
+        """
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+
+
+if __name__ == "__main__":
+    # Command line access to the store, e.g. `python artifact_store.py --clear` to free the disk space
+    parser = argparse.ArgumentParser(description="Manage the on-disk store of intermediate products.")
+    parser.add_argument("--clear", action="store_true", help="remove all stored artifacts")
+    args = parser.parse_args()
+
+    if not config.ARTIFACT_STORE_DIR:
+        parser.exit(message="The artifact store is disabled (ARTIFACT_STORE_DIR in config.py is None).\n")
+    store = ArtifactStore(config.ARTIFACT_STORE_DIR, config.ARTIFACT_STORE_SIZE_MB)
+    if args.clear:
+        print(f"Removed {store.clear()} artifact(s) from {store.store_dir}")
+    else:
+        count, total = store.size()
+        print(f"{count} artifact(s), {total / 1024 / 1024:.1f} MB in {store.store_dir}")
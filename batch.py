@@ -0,0 +1,158 @@
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import main
+
+# Keys of a scenario, the same as the user inputs collected by the GUI (plus an optional name and block size)
+SCENARIO_KEYS = ["name", "flood_depth_file", "velocity_file", "return_period", "no_data_value", "output_dir", "generate_pdf", "block_size"]
+PATH_KEYS = ["flood_depth_file", "velocity_file", "output_dir"]
+
+# Resources of a worker process, loaded once by _init_worker and reused for every scenario the worker runs
+_resources = None
+
+
+def load_manifest(manifest_path):
+    """
+    Reads a manifest of scenarios from a CSV, JSON or YAML file. Every scenario has the keys of SCENARIO_KEYS,
+    only "flood_depth_file", "return_period", "no_data_value" and "output_dir" are mandatory. Relative paths are
+    relative to the folder of the manifest.
+
+    :param manifest_path: Path to the .csv, .json, .yaml or .yml manifest
+    :return: A list of scenario dictionaries that can be passed to main.run_analysis()
+    """
+    extension = os.path.splitext(manifest_path)[1].lower()
+    with open(manifest_path, newline="", encoding="utf-8") as f:
+        if extension == ".csv":
+            rows = list(csv.DictReader(f))
+        elif extension == ".json":
+            rows = json.load(f)
+        elif extension in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is needed to read YAML manifests, install it with `pip install pyyaml`.")
+            rows = yaml.safe_load(f)
+        else:
+            raise ValueError(f"Unsupported manifest format: {extension} (use .csv, .json, .yaml or .yml)")
+
+    # JSON and YAML manifests can also hold the list under a "scenarios" key
+    if isinstance(rows, dict):
+        rows = rows["scenarios"]
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    return [_parse_scenario(row, index, base_dir) for index, row in enumerate(rows, start=1)]
+
+
+def _parse_scenario(row, index, base_dir):
+    """
+    Converts one manifest row into the user inputs dictionary used by main.run_analysis().
+
+    :param row: Dictionary read from the manifest (values are strings for CSV manifests)
+    :param index: Position of the row in the manifest, used for the default name
+    :param base_dir: Folder of the manifest, relative paths are resolved against it
+    :return: Scenario dictionary
+    """
+    unknown = set(row) - set(SCENARIO_KEYS)
+    if unknown:
+        raise ValueError(f"Scenario {index}: unknown manifest columns {sorted(unknown)}")
+
+    # Empty CSV cells count as missing values
+    row = {key: value for key, value in row.items() if value not in (None, "")}
+    missing = {"flood_depth_file", "return_period", "no_data_value", "output_dir"} - set(row)
+    if missing:
+        raise ValueError(f"Scenario {index}: missing mandatory fields {sorted(missing)}")
+
+    scenario = {
+        "name": str(row.get("name", f"scenario_{index}")),
+        "return_period": int(row["return_period"]),
+        "no_data_value": float(row["no_data_value"]),
+        "generate_pdf": str(row.get("generate_pdf", False)).strip().lower() in ("1", "true", "yes", "y"),
+    }
+    if "block_size" in row:
+        scenario["block_size"] = int(row["block_size"])
+    for key in PATH_KEYS:
+        value = row.get(key)
+        scenario[key] = os.path.join(base_dir, value) if value else None
+    return scenario
+
+
+def _init_worker():
+    """
+    Loads the land use source (in memory), the damage model and the resample cache once per worker process.
+    """
+    global _resources
+    _resources = main.load_resources(land_use_in_memory=True)
+
+
+def _run_scenario(scenario):
+    """
+    Runs one scenario in a worker process and records its status and timing, errors do not stop the batch.
+
+    :param scenario: Scenario dictionary from load_manifest()
+    :return: Dictionary with the name, status, runtime in seconds, error message and output paths
+    """
+    start = time.perf_counter()
+    status = {"name": scenario["name"], "status": "ok", "seconds": 0.0, "error": "", "outputs": {}}
+    try:
+        os.makedirs(scenario["output_dir"], exist_ok=True)
+        status["outputs"] = main.run_analysis(scenario, _resources)
+    except Exception as e:
+        status["status"] = "failed"
+        status["error"] = f"{type(e).__name__}: {e}"
+    status["seconds"] = round(time.perf_counter() - start, 3)
+    return status
+
+
+def write_report(statuses, report_path):
+    """
+    Saves the per-scenario status and timing report as a CSV file.
+
+    :param statuses: List of status dictionaries from run_batch()
+    :param report_path: string where the CSV will be saved
+    """
+    with open(report_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Scenario", "Status", "Seconds", "Error", "Risk Raster", "PDF"])
+        for status in statuses:
+            outputs = status["outputs"]
+            writer.writerow([status["name"], status["status"], status["seconds"], status["error"], outputs.get("risk", ""), outputs.get("pdf", "")])
+    print(f"Batch report saved to {report_path}")
+
+
+def run_batch(scenarios, workers=None, report_path=None):
+    """
+    Runs many scenarios in parallel across a pool of worker processes, without the GUI.
+
+    :param scenarios: List of scenario dictionaries (see load_manifest())
+    :param workers: Number of worker processes, defaults to the number of CPUs
+    :param report_path: Optional string where the status and timing report CSV will be saved
+    :return: A list of status dictionaries in the order of the scenarios
+    """
+    output_dirs = [os.path.abspath(scenario["output_dir"]) for scenario in scenarios]
+    if len(set(output_dirs)) != len(output_dirs):
+        raise ValueError("Every scenario needs its own output directory, otherwise the outputs overwrite each other.")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+        statuses = list(executor.map(_run_scenario, scenarios))
+
+    failed = sum(status["status"] != "ok" for status in statuses)
+    print(f"Batch finished in {time.perf_counter() - start:.1f} s: {len(statuses) - failed} ok, {failed} failed")
+    if report_path:
+        write_report(statuses, report_path)
+    return statuses
+
+
+if __name__ == "__main__":
+    # Headless entry point, e.g. `python batch.py scenarios.csv --workers 4`
+    parser = argparse.ArgumentParser(description="Run many flood risk scenarios in parallel without the GUI.")
+    parser.add_argument("manifest", help="CSV, JSON or YAML file with one scenario per row/entry")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--report", default=None, help="path of the status report CSV (default: <manifest>_report.csv)")
+    args = parser.parse_args()
+
+    report_path = args.report or f"{os.path.splitext(args.manifest)[0]}_report.csv"
+    run_batch(load_manifest(args.manifest), args.workers, report_path)
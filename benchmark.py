@@ -0,0 +1,354 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform as transform_coords
+from PIL import Image
+import config
+import main
+from damage import DamageModel
+from instrumentation import peak_rss_mb, reset_peak_rss
+from pdfdocument import PDFDocument
+from raster import Raster
+from stats import RiskStatistics
+
+# Centre of the synthetic rasters (Tübingen), so every CRS combination covers the same place
+CENTER_LONLAT = (9.05, 48.52)
+STAGES = ["load", "reproject", "damage_lookup", "risk", "save", "stats", "pdf", "streaming_run"]
+# Stages shorter than this are not reported as regressions, their timing is mostly noise
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def _grid(crs, size, resolution_m, margin=0.0):
+    """
+    Returns the transform and shape of a square grid around CENTER_LONLAT.
+
+    :param crs: CRS of the grid
+    :param size: Width and height in pixels (before the margin)
+    :param resolution_m: Pixel size in meters, converted to degrees for geographic CRS
+    :param margin: Extra extent on every side, as a fraction of the size
+    :return: Tuple (transform, (height, width))
+    """
+    crs = rasterio.crs.CRS.from_user_input(crs)
+    resolution = resolution_m / 111320 if crs.is_geographic else resolution_m
+    xs, ys = transform_coords("EPSG:4326", crs, [CENTER_LONLAT[0]], [CENTER_LONLAT[1]])
+    pixels = int(math.ceil(size * (1 + 2 * margin)))
+    half = pixels * resolution / 2
+    return from_origin(xs[0] - half, ys[0] + half, resolution, resolution), (pixels, pixels)
+
+
+def _write_blocks(path, shape, transform, crs, dtype, nodata, block_function, block_rows=1024):
+    """
+    Writes a synthetic raster strip by strip, so rasters larger than the memory can be generated.
+
+    :param block_function: Function (rows, cols) -> array, called with the global row and column indices of a strip
+    """
+    with rasterio.open(path, "w", driver="GTiff", height=shape[0], width=shape[1], count=1, dtype=dtype, crs=crs,
+                       transform=transform, nodata=nodata, tiled=True, blockxsize=256, blockysize=256) as dst:
+        cols = np.arange(shape[1])
+        for start in range(0, shape[0], block_rows):
+            rows = np.arange(start, min(start + block_rows, shape[0]))
+            block = block_function(rows[:, None], cols[None, :]).astype(dtype)
+            dst.write(block, 1, window=rasterio.windows.Window(0, start, shape[1], len(rows)))
+
+
+def make_synthetic_inputs(data_dir, size, inundation_crs="EPSG:3857", land_use_crs="EPSG:3857", resolution=15.0,
+                          land_use_resolution=150.0, seed=0):
+    """
+    Generates an inundation, a velocity and a CORINE-like land use GeoTIFF. The inundation is a meandering river with
+    a flooded band around it, the land use has patches of CORINE classes, some unknown classes and no-data pixels.
+    Existing files with the same parameters are reused.
+
+    :param data_dir: Folder of the generated files
+    :param size: Width and height of the inundation and velocity rasters in pixels
+    :param inundation_crs: CRS of the inundation and velocity rasters
+    :param land_use_crs: CRS of the land use raster
+    :param resolution: Pixel size of the inundation and velocity rasters in meters
+    :param land_use_resolution: Pixel size of the land use raster in meters
+    :param seed: Seed of the land use patches
+    :return: Dictionary with the paths "inundation", "velocity" and "land_use"
+    """
+    name = f"{size}_{inundation_crs}_{land_use_crs}_{resolution:g}_{land_use_resolution:g}_{seed}".replace(":", "")
+    paths = {key: os.path.join(data_dir, f"{key}_{name}.tif") for key in ("inundation", "velocity", "land_use")}
+    if all(os.path.exists(path) for path in paths.values()):
+        return paths
+    os.makedirs(data_dir, exist_ok=True)
+
+    transform, shape = _grid(inundation_crs, size, resolution)
+
+    def river_distance(rows, cols):
+        # Distance in pixels from a river meandering through the middle of the raster
+        centre = size / 2 + size / 8 * np.sin(cols / size * 6 * np.pi)
+        return np.abs(rows - centre)
+
+    def inundation(rows, cols):
+        width = size / 10 * (1 + 0.3 * np.sin(cols / size * 14 * np.pi))
+        depth = 3.0 * (1 - river_distance(rows, cols) / width) + 0.3 * np.sin(rows / 7.0) * np.cos(cols / 11.0)
+        return np.where(depth > 0.05, depth, 0)  # 0 is the no-data value, like the sample inundation rasters
+
+    def velocity(rows, cols):
+        return np.clip(2.5 - river_distance(rows, cols) / size * 20, 0, None) + 0.2 * np.cos(rows / 13.0)
+
+    _write_blocks(paths["inundation"], shape, transform, inundation_crs, "float32", 0, inundation)
+    _write_blocks(paths["velocity"], shape, transform, inundation_crs, "float32", None, velocity)
+
+    # Land use patches of about 5 x 5 land use pixels, covering the inundation extent with a margin
+    land_use_size = size * resolution / land_use_resolution
+    land_use_transform, land_use_shape = _grid(land_use_crs, land_use_size, land_use_resolution, margin=0.1)
+    rng = np.random.default_rng(seed)
+    patch = 5
+    codes = np.array(sorted(config.LAND_USE_MAP) + [48, 49, -128], dtype=np.int8)  # Unknown classes and no-data
+    weights = np.ones(len(codes))
+    weights[-3:] = 0.5
+    patches = rng.choice(codes, size=(land_use_shape[0] // patch + 1, land_use_shape[1] // patch + 1), p=weights / weights.sum())
+
+    def land_use(rows, cols):
+        return patches[rows // patch, cols // patch]
+
+    _write_blocks(paths["land_use"], land_use_shape, land_use_transform, land_use_crs, "int8", -128, land_use)
+    return paths
+
+
+class SyntheticTileSource:
+    """
+    A tile source that returns the same plain tile for every request, so the PDF stage runs offline
+    """
+    def __init__(self):
+        buffer = io.BytesIO()
+        Image.new("RGB", (256, 256), (230, 230, 220)).save(buffer, format="PNG")
+        self.tile = buffer.getvalue()
+
+    def get_tile(self, z, x, y):
+        return self.tile
+
+
+def _time_stage(function):
+    """
+    Runs one stage and measures its wall time and peak memory. Prints of the stage are suppressed.
+
+    :return: Tuple (result of the function, seconds, peak RSS in MB)
+    """
+    reset_peak_rss()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    return result, time.perf_counter() - start, peak_rss_mb()
+
+
+def run_case(paths, work_dir, stages=None):
+    """
+    Runs the pipeline stages of main.run_analysis() one after another on the synthetic inputs:
+    load (inundation pixels), reproject (land use and velocity onto the inundation grid), damage_lookup,
+    risk (compute_risk or, with config.COMPACT_PIPELINE, compute_risk_compact, including its own lookup), save (risk GeoTIFF with config.OUTPUT_PROFILE),
+    stats (summary and land use CSVs), pdf (report with offline tiles) and streaming_run (the whole run in
+    block-streaming mode, as in production).
+
+    :param paths: Dictionary from make_synthetic_inputs()
+    :param work_dir: Folder for the outputs of the stages
+    :param stages: Names of the stages to run (from STAGES), all if None. Stages need the results of the in-memory
+        stages before them, so those are run as well, but only the selected ones are reported
+    :return: Dictionary of stage name -> {"seconds", "peak_rss_mb"}
+    """
+    selected = set(stages or STAGES)
+    damage_model = DamageModel(config.LAND_USE_MAP, config.DEPTH_DAMAGE_CURVES)
+    land_use_raster = Raster(paths["land_use"])
+    output_path = os.path.join(work_dir, "risk_output.tif")
+    results = {}
+    state = {}
+
+    def record(name, function):
+        state[name], seconds, peak = _time_stage(function)
+        results[name] = {"seconds": round(seconds, 4), "peak_rss_mb": round(peak, 1)}
+
+    in_memory = [stage for stage in STAGES[:-1] if stage in selected]
+    last_in_memory = STAGES.index(in_memory[-1]) if in_memory else -1
+
+    def needed(stage):
+        return STAGES.index(stage) <= last_in_memory
+
+    if needed("load"):
+        inundation_raster = Raster(paths["inundation"])
+        record("load", lambda: inundation_raster.data)
+    if needed("reproject"):
+        def reproject():
+            with main.open_warped_inputs(inundation_raster, paths["land_use"], paths["velocity"]) as warped_inputs:
+                return warped_inputs.read()
+        record("reproject", reproject)
+    if needed("damage_lookup"):
+        record("damage_lookup", lambda: damage_model.lookup(state["reproject"]["land_use"], land_use_raster.nodata))
+    if needed("risk"):
+        if config.COMPACT_PIPELINE:
+            record("risk", lambda: main.compute_risk_compact(
+                state["load"], state["reproject"]["land_use"], state["reproject"]["velocity"], 100, -999.0, damage_model,
+                land_use_raster.nodata, inundation_raster.nodata, Raster(paths["velocity"]).nodata
+            ))
+        else:
+            record("risk", lambda: main.compute_risk(
+                state["load"], state["reproject"]["land_use"], state["reproject"]["velocity"], 100, -999.0, damage_model,
+                land_use_raster.nodata
+            ) + (None,))
+    if needed("save"):
+        record("save", lambda: inundation_raster.save_raster(output_path, state["risk"][0], -999.0, profile=config.OUTPUT_PROFILE))
+    if needed("stats"):
+        def statistics():
+            risk_statistics = RiskStatistics(-999.0, config.MEDIAN_RELATIVE_ERROR)
+            risk_statistics.update(state["risk"][0], state["load"], state["risk"][1], state["risk"][2])
+            main.save_summary_table(risk_statistics, os.path.join(work_dir, "summary_table.csv"))
+            main.save_risk_by_land_use(risk_statistics, os.path.join(work_dir, "land_use_risk.csv"))
+        record("stats", statistics)
+    if needed("pdf"):
+        def pdf():
+            report = PDFDocument(os.path.join(work_dir, "report.pdf"), tile_cache=SyntheticTileSource(), dpi=config.PDF_DPI)
+            report.generate_from_raster(output_path)
+        record("pdf", pdf)
+    state.clear()
+
+    if "streaming_run" in selected:
+        resources = {
+            "land_use_path": paths["land_use"],
+            "land_use_source": paths["land_use"],
+            "land_use_raster": land_use_raster,
+            "damage_model": damage_model,
+            "resample_cache": None,  # Every run has to warp, like a run on a new grid
+        }
+        user_inputs = {
+            "return_period": 100, "no_data_value": -999.0, "flood_depth_file": paths["inundation"],
+            "velocity_file": paths["velocity"], "output_dir": os.path.join(work_dir, "streaming"), "block_size": 0,
+        }
+        os.makedirs(user_inputs["output_dir"], exist_ok=True)
+        record("streaming_run", lambda: main.run_analysis(user_inputs, resources))
+
+    return {stage: results[stage] for stage in STAGES if stage in results and stage in selected}
+
+
+def environment():
+    """
+    Returns the machine and library versions, stored with the results so baselines are only compared like for like.
+    """
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares benchmark results with a baseline, stage by stage.
+
+    :param results: Results dictionary of run_benchmarks()
+    :param baseline: Results dictionary of an earlier run
+    :param threshold: Allowed slowdown as a fraction, e.g. 0.2 for 20 %
+    :return: List of (case, stage, baseline seconds, seconds, ratio, regression) tuples
+    """
+    rows = []
+    for case, stages in results["cases"].items():
+        for stage, measured in stages.items():
+            reference = baseline.get("cases", {}).get(case, {}).get(stage)
+            if reference is None:
+                continue
+            ratio = measured["seconds"] / reference["seconds"] if reference["seconds"] else math.inf
+            regression = ratio > 1 + threshold and measured["seconds"] - reference["seconds"] > MIN_REGRESSION_SECONDS
+            rows.append((case, stage, reference["seconds"], measured["seconds"], ratio, regression))
+    return rows
+
+
+def run_benchmarks(sizes, crs_pairs, data_dir, stages=None, repeat=1):
+    """
+    Generates the synthetic inputs and runs every case. With several repeats the fastest time of each stage is kept,
+    the memory peak is the largest one.
+
+    :param sizes: List of raster sizes in pixels
+    :param crs_pairs: List of (inundation CRS, land use CRS) tuples
+    :param data_dir: Folder of the synthetic inputs
+    :param stages: Names of the stages to run, all if None
+    :param repeat: Number of runs of each case
+    :return: Results dictionary with "environment", "config" and "cases"
+    """
+    results = {
+        "environment": environment(),
+        "config": {"output_profile": config.OUTPUT_PROFILE, "warp_threads": config.WARP_THREADS,
+                   "land_use_resampling": config.LAND_USE_RESAMPLING, "compact_pipeline": config.COMPACT_PIPELINE},
+        "cases": {},
+    }
+    for size in sizes:
+        for inundation_crs, land_use_crs in crs_pairs:
+            case = f"{size}px_{inundation_crs}_{land_use_crs}"
+            print(f"Generating inputs for {case}...")
+            paths = make_synthetic_inputs(data_dir, size, inundation_crs, land_use_crs)
+
+            runs = []
+            for _ in range(repeat):
+                with tempfile.TemporaryDirectory() as work_dir:
+                    runs.append(run_case(paths, work_dir, stages))
+            results["cases"][case] = {
+                stage: {
+                    "seconds": min(run[stage]["seconds"] for run in runs),
+                    "peak_rss_mb": max(run[stage]["peak_rss_mb"] for run in runs),
+                }
+                for stage in runs[0]
+            }
+            for stage, measured in results["cases"][case].items():
+                print(f"  {stage:<14} {measured['seconds']:>9.3f} s {measured['peak_rss_mb']:>9.1f} MB")
+    return results
+
+
+if __name__ == "__main__":
+    # e.g. `python benchmark.py --sizes 1000 5000 --crs EPSG:3857 EPSG:3857 --crs EPSG:25832 EPSG:3857`, then
+    # `python benchmark.py ... --baseline benchmark_results.json` after a change
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on synthetic rasters (no real data or network needed).")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000], help="raster sizes in pixels (default: 1000)")
+    parser.add_argument("--crs", nargs=2, action="append", metavar=("INUNDATION_CRS", "LAND_USE_CRS"),
+                        help="CRS combination, repeatable (default: EPSG:3857 EPSG:3857 and EPSG:25832 EPSG:3857)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, help="stages to report (default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest one is kept (default: 1)")
+    parser.add_argument("--data-dir", help="folder for the synthetic inputs, kept and reused between runs (default: temporary)")
+    parser.add_argument("--output", default="benchmark_results.json", help="results file (default: benchmark_results.json)")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare with")
+    parser.add_argument("--compact", action="store_true", help="use the compact dtype pipeline (config.COMPACT_PIPELINE)")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown against the baseline (default: 0.2 = 20 %%)")
+    args = parser.parse_args()
+    if args.compact:
+        config.COMPACT_PIPELINE = True
+
+    crs_pairs = [tuple(pair) for pair in args.crs] if args.crs else [("EPSG:3857", "EPSG:3857"), ("EPSG:25832", "EPSG:3857")]
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="flood_benchmark_")
+    try:
+        benchmark_results = run_benchmarks(args.sizes, crs_pairs, data_dir, args.stages, args.repeat)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(benchmark_results, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_results = json.load(f)
+        if baseline_results.get("environment", {}).get("platform") != benchmark_results["environment"]["platform"]:
+            print("Warning: the baseline was recorded on another platform, timings may not be comparable")
+        comparison = compare(benchmark_results, baseline_results, args.threshold)
+        for case, stage, reference, measured, ratio, regression in comparison:
+            flag = "REGRESSION" if regression else ""
+            print(f"{case:<40} {stage:<14} {reference:>9.3f} s -> {measured:>9.3f} s ({ratio:>5.2f}x) {flag}")
+        regressions = [row for row in comparison if row[-1]]
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than the baseline by more than {args.threshold:.0%}")
+            sys.exit(1)
+        print("No regressions against the baseline")
@@ -71,5 +71,135 @@ LAND_USE_MAP = {
     # No Data
     48: 0    # NODATA
 }
+# `python land_use_tiles.py` prepares a tiled copy with mode overviews and a tile index (..._tiled.tif), point
+# LAND_USE_PATH to it so runs only read the tiles of the inundation footprint
 LAND_USE_PATH = "data/Project_Files/U2018_CLC2018_V2020_20u1.tif"
-VELOCITY_THRESHOLD = 1
\ No newline at end of file
+VELOCITY_THRESHOLD = 1
+
+# Optional piecewise-linear depth-damage curves per land use pixel value, as (depths, damage factors). The damage factor
+# replaces the flood intensity for that class, classes without a curve keep the intensity
+DEPTH_DAMAGE_CURVES = {
+    # Example: continuous urban fabric, no damage below 0.1 m and full damage from 2 m
+    # 1: ([0.1, 0.5, 1.0, 2.0], [0.0, 0.25, 0.6, 1.0]),
+}
+
+# Block-streaming mode for large rasters. None computes the whole raster in memory, 0 walks the internal blocks of the
+# inundation raster, any other integer uses square windows with that side length in pixels
+BLOCK_SIZE = None
+
+# Resampling method of each input (rasterio Resampling name). Land use classes are categorical, use "nearest" or "mode"
+# so no invalid in-between classes are created. INUNDATION_RESAMPLING is used for flood depths that are put on another
+# grid, e.g. the other return periods of ead.py
+LAND_USE_RESAMPLING = "nearest"
+VELOCITY_RESAMPLING = "bilinear"
+INUNDATION_RESAMPLING = "bilinear"
+# Number of threads GDAL uses to warp each input (or "ALL_CPUS"), and the memory limit of each warp operation in MB
+# (0 uses the GDAL default of 64 MB)
+WARP_THREADS = "ALL_CPUS"
+WARP_MEMORY_LIMIT_MB = 256
+
+# On-disk cache of land use grids resampled to inundation grids, None disables it. Above the size limit the least
+# recently used grids are removed, run `python resample_cache.py --clear` to invalidate the cache
+RESAMPLE_CACHE_DIR = "cache/land_use"
+RESAMPLE_CACHE_SIZE_MB = 2048
+
+# Error bound of the medians in summary_table.csv, relative to the median value. The statistics are computed in a
+# single streaming pass, rasters with few distinct values (e.g. land use) get the exact median
+MEDIAN_RELATIVE_ERROR = 0.001
+
+# Layout of the output rasters, the name of a profile in raster.OUTPUT_PROFILES ("plain" striped and uncompressed like
+# before, "compressed" tiled DEFLATE with overviews, "compact" ZSTD and float32, "cog" Cloud-optimized GeoTIFF) or a
+# dictionary of profile options, e.g. {"tiled": True, "compress": "lzw", "overviews": False}
+OUTPUT_PROFILE = "plain"
+
+# Where the PDF report gets basemap tiles that are not cached: a tile server URL with {z}/{x}/{y}, a .mbtiles file or a
+# folder of {z}/{x}/{y}.png tiles. None only uses cached tiles, so the reports do no network I/O. Seed the cache from
+# your own tile server or an MBTiles file (see `python tile_cache.py prefetch --help`), the public OpenStreetMap server
+# does not allow bulk downloads. The attribution is printed on the map, it is required by the OpenStreetMap license
+BASEMAP_SOURCE = None
+BASEMAP_ATTRIBUTION = "(C) OpenStreetMap contributors"
+# MBTiles file of the basemap tile cache and its size limit, the least recently used tiles are removed above it
+BASEMAP_CACHE_PATH = "cache/basemap.mbtiles"
+BASEMAP_CACHE_SIZE_MB = 1024
+# Resolution of the map in the PDF report, the risk raster is read from its overviews at about this resolution
+PDF_DPI = 100
+# Renders the PDF report in a background process, after the raster and CSV files are written
+PDF_IN_BACKGROUND = True
+
+# Optional profiler around the stages of a run (see run_manifest.json for the stage names). "cprofile" saves
+# profile_<stage>.prof into the output folder, "module:function" calls a function (stage name, output folder) that
+# returns a context manager, e.g. to run a sampling profiler. The FLOOD_RISK_PROFILER environment variable overrides it.
+# PROFILE_STAGES are the names of the stages that are profiled, None profiles all of them
+PROFILER = None
+PROFILE_STAGES = None
+
+# Computes the risk as float32 with single-byte land use values in reused buffers, which needs about a quarter of the
+# memory. Only pixels where the inundation or land use is no-data get the no-data value (a valid pixel with zero risk
+# stays 0), and the statistics only count valid pixels
+COMPACT_PIPELINE = False
+
+# Store of intermediate products (aligned inputs, intensity, damage, risk raster, statistics), keyed by a hash of their
+# inputs and settings. A rerun with e.g. another return period, VELOCITY_THRESHOLD or LAND_USE_MAP value only
+# recomputes the stages below the change. None disables it, above the size limit the least recently used artifacts are
+# removed, run `python artifact_store.py --clear` to free the disk space
+ARTIFACT_STORE_DIR = None
+ARTIFACT_STORE_SIZE_MB = 8192
+
+# Polygon layers (municipalities, districts, parcels...) the risk is summed over, each a dictionary with "name" (used in
+# the CSV names), "path" (GeoJSON, GeoPackage or Shapefile) and optionally "layer", "id_field" (attribute written as
+# zone id) and "all_touched". Every run then saves zonal_risk_<name>.csv and zonal_land_use_<name>.csv (risk per zone
+# and land use class), e.g. [{"name": "municipality", "path": "data/municipalities.gpkg", "id_field": "AGS"}]
+ZONE_LAYERS = []
+# Cache of the zone layers rasterized onto the hazard grids, so repeated scenarios on the same grid only sum the risk.
+# None rasterizes the layers in every run
+ZONE_CACHE_DIR = "cache/zones"
+ZONE_CACHE_SIZE_MB = 2048
+
+# Local address of the HTTP API of `python worker.py`, which keeps warm worker processes (modules, land use, damage
+# model, caches) and runs the jobs posted to it. Keep the host on 127.0.0.1, the API has no authentication.
+# WORKER_SOCKET is a Unix socket path the worker listens on instead of the TCP port, None uses the TCP port
+WORKER_HOST = "127.0.0.1"
+WORKER_PORT = 8765
+WORKER_SOCKET = None
+# Number of worker processes (None uses the number of CPUs), and of the jobs that can wait for a free worker process,
+# further jobs are refused until one starts
+WORKER_PROCESSES = None
+WORKER_QUEUE_SIZE = 64
+
+# Number of members of the Monte Carlo ensemble of `python ensemble.py` and the seed they are drawn with (the same seed
+# draws the same members)
+ENSEMBLE_MEMBERS = 100
+ENSEMBLE_SEED = 0
+# Distribution of the damage value of every land use class, as factors of its LAND_USE_MAP value: {"type": "fixed"},
+# {"type": "normal", "cv": 0.2}, {"type": "lognormal", "sigma": 0.3}, {"type": "uniform", "low": 0.8, "high": 1.2} or
+# {"type": "triangular", "low": 0.7, "mode": 1.0, "high": 1.5}. ENSEMBLE_CLASS_DISTRIBUTIONS replaces it for single
+# classes (pixel value -> distribution), ENSEMBLE_THRESHOLD_DISTRIBUTION is the distribution of VELOCITY_THRESHOLD
+ENSEMBLE_DAMAGE_DISTRIBUTION = {"type": "lognormal", "sigma": 0.3}
+ENSEMBLE_CLASS_DISTRIBUTIONS = {}
+ENSEMBLE_THRESHOLD_DISTRIBUTION = {"type": "uniform", "low": 0.5, "high": 1.5}
+# Percentiles of the ensemble rasters and tables
+ENSEMBLE_PERCENTILES = [5, 50, 95]
+# Number of members evaluated at once, only limits the temporaries of the damage computation
+ENSEMBLE_CHUNK_SIZE = 16
+# Size limit of the risk of all members on a strip of a block, the strips are made small enough
+ENSEMBLE_MEMORY_MB = 256
+
+# Rule of `python mosaic.py` for pixels covered by several hazard tiles: "max" (largest damage), "first" (first tile
+# with data, in the order the tiles are given) or "mean"
+MOSAIC_OVERLAP = "max"
+# CRS (e.g. "EPSG:25832") and pixel size of the mosaic grid, None uses the CRS of the first tile and the finest
+# resolution of the tiles
+MOSAIC_CRS = None
+MOSAIC_RESOLUTION = None
+# Side length in pixels of the windows of the mosaic grid that are processed in parallel, and the number of worker
+# processes (None uses the number of CPUs)
+MOSAIC_BLOCK_SIZE = 512
+MOSAIC_WORKERS = None
+
+# Smallest risk of a hotspot pixel. If set, every run saves hotspots.csv (connected areas of high risk ranked by total
+# risk) and hotspot_labels.tif, None skips the hotspot stage (`python hotspots.py` still works)
+HOTSPOT_THRESHOLD = None
+# Hotspots with fewer pixels are dropped
+HOTSPOT_MIN_PIXELS = 4
+# 8 joins pixels that touch at the edges or corners, 4 only at the edges
+HOTSPOT_CONNECTIVITY = 8
\ No newline at end of file
@@ -0,0 +1,217 @@
+import hashlib
+import numpy as np
+
+
+def chunked_take(table, indices, out=None, chunk_size=1 << 20):
+    """
+    Gathers table values like np.take, in chunks of the flattened indices. numpy converts the indices to intp first, a
+    single gather over a whole raster of byte-sized classes would need 8 bytes per pixel.
+
+    :param table: 1D numpy lookup array
+    :param indices: numpy array of positions in the table
+    :param out: Optional C-contiguous array of the table dtype and the shape of the indices
+    :param chunk_size: Number of pixels gathered at once
+    :return: numpy array of the gathered values
+    """
+    indices = np.ascontiguousarray(indices)
+    if out is None:
+        out = np.empty(indices.shape, dtype=table.dtype)
+    flat_indices, flat_out = indices.reshape(-1), out.reshape(-1)
+    for start in range(0, flat_indices.size, chunk_size):
+        np.take(table, flat_indices[start:start + chunk_size], out=flat_out[start:start + chunk_size], mode="clip")
+    return out
+
+
+class DamageModel:
+    """
+    A class for turning land use classes and flood intensity into damage values (compiled lookup tables and
+    optional depth-damage curves)
+    """
+    def __init__(self, land_use_map, depth_damage_curves=None, unknown_value=0):
+        """
+        Initializes the DamageModel object and compiles the land use map into a dense lookup array indexed by class code.
+
+        :param land_use_map: Dictionary of land use pixel value -> economic damage (see config.LAND_USE_MAP)
+        :param depth_damage_curves: Optional dictionary of land use pixel value -> (depths, damage factors). The damage
+            factor is interpolated piecewise-linearly from the flood intensity and multiplied with the economic damage.
+            Classes without a curve use the intensity itself as factor, like the original risk formula
+        :param unknown_value: Economic damage used for class codes that are not in the land use map
+        """
+        codes = np.array(sorted(land_use_map), dtype=np.int64)
+        if codes.min() < 0:
+            raise ValueError("Land use class codes must not be negative.")
+
+        # Slot max_code + 1 holds unknown codes and slot max_code + 2 holds the no-data pixels of the land use raster
+        self.max_code = int(codes.max())
+        self.unknown_slot = self.max_code + 1
+        self.nodata_slot = self.max_code + 2
+
+        values = np.array([land_use_map[code] for code in codes])
+        self.values = np.full(self.max_code + 3, unknown_value, dtype=np.result_type(values, unknown_value))
+        self.values[codes] = values
+        self.values[self.nodata_slot] = 0
+
+        self.known = np.zeros(self.max_code + 3, dtype=bool)
+        self.known[codes] = True
+        self.known[self.nodata_slot] = True
+
+        # Slots fit into a single byte for the CORINE classes, and integer damages up to 255 as well
+        self.slot_dtype = np.min_scalar_type(self.nodata_slot)
+        integer_values = np.all(self.values == np.round(self.values)) and self.values.min() >= 0 and self.values.max() <= 255
+        self.compact_values = self.values.astype(np.uint8 if integer_values else np.float32)
+
+        # Codes that were found in the data but are missing from the land use map, so the caller can report them
+        self.unknown_codes = set()
+        self._index_tables = {}
+        self._compile_curves(depth_damage_curves or {}, land_use_map)
+
+    def _compile_curves(self, depth_damage_curves, land_use_map):
+        """
+        Evaluates every depth-damage curve on the union of all curve breakpoints. Between two breakpoints of the union
+        every curve is linear, so a pixel only needs a gather of the two neighbouring table values.
+
+        :param depth_damage_curves: Dictionary of land use pixel value -> (depths, damage factors)
+        :param land_use_map: Dictionary of land use pixel value -> economic damage
+        """
+        self.curve_breakpoints = None
+        if not depth_damage_curves:
+            return
+
+        missing = set(depth_damage_curves) - set(land_use_map)
+        if missing:
+            raise ValueError(f"Depth-damage curves given for land use classes that are not in the land use map: {sorted(missing)}")
+
+        breakpoints = np.unique(np.concatenate([np.asarray(depths, dtype=np.float64) for depths, _ in depth_damage_curves.values()]))
+        if len(breakpoints) == 1:
+            # A single breakpoint is a constant curve, add a second one so there is always a segment to interpolate on
+            breakpoints = np.append(breakpoints, breakpoints[0] + 1)
+
+        # Row 0 is used by the classes without a curve
+        self.curve_table = np.zeros((len(depth_damage_curves) + 1, len(breakpoints)))
+        self.curve_rows = np.zeros(self.max_code + 3, dtype=np.intp)
+        for row, code in enumerate(sorted(depth_damage_curves), start=1):
+            depths, factors = depth_damage_curves[code]
+            self.curve_table[row] = np.interp(breakpoints, depths, factors)
+            self.curve_rows[code] = row
+        self.curve_breakpoints = breakpoints
+
+    def fingerprint(self):
+        """
+        Returns a hash of the compiled lookup tables and curves, which changes whenever a value of the land use map or a
+        depth-damage curve changes.
+
+        :return: Hex digest
+        """
+        digest = hashlib.sha256()
+        for table in (self.values, self.known, self.curve_breakpoints, getattr(self, "curve_table", None), getattr(self, "curve_rows", None)):
+            if table is not None:
+                digest.update(str(table.dtype).encode())
+                digest.update(np.ascontiguousarray(table).tobytes())
+            digest.update(b"|")
+        return digest.hexdigest()
+
+    def _slots(self, codes, nodata=None):
+        """
+        Computes the lookup slot of every class code, codes that are not in the land use map go to the unknown slot.
+
+        :param codes: numpy array with land use classes
+        :param nodata: No-data value of the land use raster
+        :return: numpy array of slot positions
+        """
+        slots = np.full(codes.shape, self.unknown_slot, dtype=np.intp)
+        in_range = (codes >= 0) & (codes <= self.max_code) & (codes == np.floor(codes))
+        slots[in_range] = codes[in_range].astype(np.intp)
+        slots[~self.known[slots]] = self.unknown_slot
+        if nodata is not None:
+            slots[codes == nodata] = self.nodata_slot
+        return slots
+
+    def index(self, land_use_data, nodata=None):
+        """
+        Converts land use class codes into positions of the compiled lookup arrays and records unknown codes.
+
+        :param land_use_data: numpy array with land use classes
+        :param nodata: No-data value of the land use raster, these pixels get no damage
+        :return: numpy array of slot positions, same shape as land_use_data (self.slot_dtype for 8 and 16 bit classes)
+        """
+        land_use_data = np.asarray(land_use_data)
+
+        # For 8 and 16 bit classes every possible code gets its slot once, then the conversion is a single gather
+        if land_use_data.dtype.kind in "iu" and land_use_data.dtype.itemsize <= 2:
+            unsigned = np.dtype(f"u{land_use_data.dtype.itemsize}")
+            key = (land_use_data.dtype, nodata)
+            if key not in self._index_tables:
+                all_codes = np.arange(2 ** (8 * unsigned.itemsize), dtype=unsigned).view(land_use_data.dtype)
+                self._index_tables[key] = self._slots(all_codes, nodata).astype(self.slot_dtype)
+            slots = chunked_take(self._index_tables[key], land_use_data.view(unsigned))
+        else:
+            slots = self._slots(land_use_data, nodata)
+
+        unknown = slots == self.unknown_slot
+        if unknown.any():
+            self.unknown_codes.update(np.unique(land_use_data[unknown]).tolist())
+        return slots
+
+    def lookup(self, land_use_data, nodata=None):
+        """
+        Looks up the economic damage of every land use pixel.
+
+        :param land_use_data: numpy array with land use classes
+        :param nodata: No-data value of the land use raster, these pixels get no damage
+        :return: numpy array with the economic damage of each pixel
+        """
+        return self.values[self.index(land_use_data, nodata)]
+
+    def damage_factor(self, slots, intensity):
+        """
+        Evaluates the depth-damage curves for every pixel. Pixels of classes without a curve keep the intensity.
+
+        :param slots: numpy array of lookup slots from index()
+        :param intensity: numpy array with the flood intensity (depth, or depth times velocity)
+        :return: numpy array with the damage factor of each pixel
+        """
+        if self.curve_breakpoints is None:
+            return intensity
+
+        breakpoints = self.curve_breakpoints
+        rows = self.curve_rows[slots]
+        segment = np.clip(np.searchsorted(breakpoints, intensity, side="right") - 1, 0, len(breakpoints) - 2)
+        start, end = breakpoints[segment], breakpoints[segment + 1]
+
+        # Curves are constant outside of their first and last breakpoint, like np.interp
+        fraction = np.clip((intensity - start) / (end - start), 0, 1)
+        lower = self.curve_table[rows, segment]
+        factor = lower + fraction * (self.curve_table[rows, segment + 1] - lower)
+        return np.where(rows > 0, factor, intensity)
+
+    def evaluate(self, land_use_data, intensity, nodata=None):
+        """
+        Computes the economic damage and the damage of every pixel in one pass over the land use classes.
+
+        :param land_use_data: numpy array with land use classes
+        :param intensity: numpy array with the flood intensity on the same grid
+        :param nodata: No-data value of the land use raster, these pixels get no damage
+        :return: tuple of numpy arrays (land use values, damage)
+        """
+        slots = self.index(land_use_data, nodata)
+        land_use_values = self.values[slots]
+        damage = land_use_values * self.damage_factor(slots, intensity)
+        return land_use_values, damage
+
+    def evaluate_compact(self, land_use_data, intensity, nodata=None, values_out=None):
+        """
+        Like evaluate(), without float64 temporaries: the land use values are gathered as self.compact_values.dtype
+        (uint8 for the default land use map), and the damage is computed in place into the intensity array.
+
+        :param land_use_data: numpy array with land use classes
+        :param intensity: float numpy array with the flood intensity on the same grid, overwritten with the damage
+        :param nodata: No-data value of the land use raster, these pixels get no damage
+        :param values_out: Optional preallocated array for the land use values, of self.compact_values.dtype
+        :return: tuple of numpy arrays (land use values, damage), the damage is the intensity array
+        """
+        slots = self.index(land_use_data, nodata)
+        land_use_values = chunked_take(self.compact_values, slots, out=values_out)
+        if self.curve_breakpoints is not None:
+            np.copyto(intensity, self.damage_factor(slots, intensity), casting="same_kind")
+        np.multiply(intensity, land_use_values, out=intensity)
+        return land_use_values, intensity
@@ -0,0 +1,162 @@
+import argparse
+import os
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+import config
+import main
+from raster import Raster, ResampledGroup
+
+
+def integrate_ead(damage_stack, return_periods):
+    """
+    Integrates damage over the annual exceedance probability (1 / return period) with the trapezoidal rule, for every
+    pixel at once. Only the range between the most frequent and the rarest scenario is integrated, there is no
+    extrapolation beyond them.
+
+    :param damage_stack: numpy array of shape (scenarios, rows, cols), sorted by increasing return period
+    :param return_periods: Return periods of the scenarios, sorted increasingly
+    :return: numpy array with the expected annual damage of each pixel
+    """
+    probabilities = 1 / np.asarray(return_periods, dtype=np.float64)
+    widths = probabilities[:-1] - probabilities[1:]
+
+    # Sum over the scenario axis of width * (damage at both ends of the interval) / 2
+    return 0.5 * np.tensordot(widths, damage_stack[:-1] + damage_stack[1:], axes=1)
+
+
+def mask_nodata(data, nodata):
+    """
+    Sets the no-data (and NaN) pixels of a depth or velocity block to 0, so pixels outside of the extent of a scenario
+    get no damage instead of the no-data value as their depth.
+
+    :param data: numpy array with depth or velocity values
+    :param nodata: No-data value of the raster, or None
+    :return: numpy array without no-data values
+    """
+    missing = np.isnan(data) if data.dtype.kind == "f" else np.zeros(data.shape, dtype=bool)
+    if nodata is not None and not np.isnan(nodata):
+        missing |= data == nodata
+    return np.where(missing, 0, data) if missing.any() else data
+
+
+def run_ead(hazards, output_dir, no_data_value, block_size=None, resources=None):
+    """
+    Computes an expected annual damage (EAD) raster and one risk raster per return period in a single pass over the
+    data. All hazard scenarios are put on the grid of the rarest scenario (usually the largest flood extent), so the
+    land use is resampled and looked up once for all of them.
+
+    :param hazards: List of dictionaries with "return_period", "flood_depth_file" and optionally "velocity_file"
+    :param output_dir: Directory where ead_output.tif and the risk_T<return period>.tif rasters are saved
+    :param no_data_value: number written to pixels without risk
+    :param block_size: None computes the whole grid in memory, otherwise the block size as in config.BLOCK_SIZE
+    :param resources: Dictionary from main.load_resources(), loaded here if not provided
+    :return: Dictionary of output file paths, "ead" and one "risk_T<return period>" entry per scenario
+    """
+    hazards = sorted(hazards, key=lambda hazard: hazard["return_period"])
+    return_periods = [hazard["return_period"] for hazard in hazards]
+    if len(hazards) < 2:
+        raise ValueError("At least two return periods are needed to integrate the expected annual damage.")
+    if len(set(return_periods)) != len(return_periods):
+        raise ValueError("Every hazard scenario needs a different return period.")
+
+    if resources is None:
+        resources = main.load_resources()
+    damage_model = resources["damage_model"]
+    land_use_source = resources["land_use_source"]
+    land_use_nodata = resources["land_use_raster"].nodata
+
+    target_raster = Raster(hazards[-1]["flood_depth_file"])
+    if not target_raster.overlaps(resources["land_use_raster"]):
+        raise ValueError("Inundation raster is outside of the land use raster, or there is a coordinate system issue.")
+
+    # Land use is resampled once for every scenario, from the resample cache when possible
+    land_use_grid = None
+    if resources["resample_cache"]:
+        land_use_grid = resources["resample_cache"].fetch(
+            target_raster, resources["land_use_path"], Resampling[config.LAND_USE_RESAMPLING], block_size or 0,
+            config.WARP_THREADS, config.WARP_MEMORY_LIMIT_MB, source_dataset=land_use_source
+        )
+
+    # Every other input is warped onto the target grid in one group, the target inundation is read directly
+    sources = {}
+    if land_use_grid is None:
+        sources["land_use"] = (land_use_source, Resampling[config.LAND_USE_RESAMPLING])
+    for index, hazard in enumerate(hazards):
+        if index != len(hazards) - 1:
+            sources[f"inundation_{index}"] = (hazard["flood_depth_file"], Resampling[config.INUNDATION_RESAMPLING])
+        if hazard.get("velocity_file"):
+            sources[f"velocity_{index}"] = (hazard["velocity_file"], Resampling[config.VELOCITY_RESAMPLING])
+
+    outputs = {f"risk_T{return_period}": os.path.join(output_dir, f"risk_T{return_period}.tif") for return_period in return_periods}
+    outputs["ead"] = os.path.join(output_dir, "ead_output.tif")
+    windows = [None] if block_size is None else target_raster.iter_windows(block_size)
+    total_ead = 0.0
+
+    with ExitStack() as stack:
+        target_src = stack.enter_context(rasterio.open(target_raster.file_path))
+        warped_inputs = stack.enter_context(ResampledGroup(target_raster, sources, config.WARP_THREADS, config.WARP_MEMORY_LIMIT_MB))
+        writers = {}
+        # No-data values of the depths and velocities, a warped scenario also gets it outside of its own extent
+        nodata = {name: vrt.nodata for name, vrt in warped_inputs.vrts.items() if name != "land_use"}
+        nodata[f"inundation_{len(hazards) - 1}"] = target_src.nodata
+
+        for window in windows:
+            blocks = warped_inputs.read(window)
+            blocks[f"inundation_{len(hazards) - 1}"] = target_src.read(1, window=window)
+            for name, value in nodata.items():
+                blocks[name] = mask_nodata(blocks[name], value)
+            if land_use_grid is not None:
+                blocks["land_use"] = land_use_grid if window is None else land_use_grid[window.toslices()]
+
+            # One lookup of the land use values for the whole stack of scenarios
+            slots = damage_model.index(blocks["land_use"], land_use_nodata)
+            land_use_values = damage_model.values[slots]
+            intensity = np.stack([
+                main.compute_intensity(blocks[f"inundation_{index}"], blocks.get(f"velocity_{index}"))
+                for index in range(len(hazards))
+            ])
+            damage_stack = land_use_values * damage_model.damage_factor(slots, intensity)
+
+            results = {f"risk_T{return_period}": damage * (1 / return_period) for damage, return_period in zip(damage_stack, return_periods)}
+            results["ead"] = integrate_ead(damage_stack, return_periods)
+            total_ead += float(results["ead"].sum())
+
+            for name, result in results.items():
+                # Replace 0s with the no_data_value, like the single scenario risk raster
+                result = np.where(result == 0, no_data_value, result)
+                if name not in writers:
+                    writers[name] = stack.enter_context(
+                        target_raster.open_writer(outputs[name], result.dtype, no_data_value, config.OUTPUT_PROFILE)
+                    )
+                writers[name].write(result, 1, window=window)
+
+    print(f"Expected annual damage raster saved to {outputs['ead']} (total EAD: {total_ead:.2f})")
+    if damage_model.unknown_codes:
+        print(f"Land use classes not in LAND_USE_MAP (damage set to 0): {sorted(damage_model.unknown_codes)}")
+    return outputs
+
+
+if __name__ == "__main__":
+    # e.g. `python ead.py --hazard 10 HQ10.tif --hazard 100 HQ100.tif HQ100_velocity.tif --output-dir results`
+    parser = argparse.ArgumentParser(description="Compute an expected annual damage raster from several return periods.")
+    parser.add_argument("--hazard", nargs="+", action="append", required=True, metavar="ARG",
+                        help="RETURN_PERIOD INUNDATION_FILE [VELOCITY_FILE], repeat for every scenario")
+    parser.add_argument("--output-dir", required=True, help="directory for the EAD and per-scenario risk rasters")
+    parser.add_argument("--no-data", type=float, default=-999, help="no-data value of the outputs (default: -999)")
+    parser.add_argument("--block-size", type=int, default=config.BLOCK_SIZE, help="block-streaming window size, 0 for internal blocks")
+    args = parser.parse_args()
+
+    hazard_list = []
+    for values in args.hazard:
+        if len(values) not in (2, 3):
+            parser.error("--hazard needs RETURN_PERIOD INUNDATION_FILE [VELOCITY_FILE]")
+        hazard_list.append({
+            "return_period": int(values[0]),
+            "flood_depth_file": values[1],
+            "velocity_file": values[2] if len(values) == 3 else None,
+        })
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    run_ead(hazard_list, args.output_dir, args.no_data, args.block_size)
@@ -0,0 +1,297 @@
+import argparse
+import os
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+import config
+import main
+from raster import Raster
+
+
+def sample_factors(distribution, size, rng):
+    """
+    Draws factors of a point estimate (e.g. a value of the land use map) from a distribution. All distributions are
+    relative to the point estimate, a factor of 1 keeps it.
+
+    :param distribution: Dictionary with "type" and its parameters: {"type": "fixed"}, {"type": "normal", "cv": 0.2},
+        {"type": "lognormal", "sigma": 0.3} (median 1), {"type": "uniform", "low": 0.8, "high": 1.2} or
+        {"type": "triangular", "low": 0.7, "mode": 1.0, "high": 1.5}
+    :param size: Number of factors
+    :param rng: numpy random Generator
+    :return: numpy array of non-negative factors
+    """
+    kind = distribution.get("type", "fixed")
+    if kind == "fixed":
+        factors = np.ones(size)
+    elif kind == "normal":
+        factors = rng.normal(1.0, distribution["cv"], size)
+    elif kind == "lognormal":
+        factors = np.exp(rng.normal(0.0, distribution["sigma"], size))
+    elif kind == "uniform":
+        factors = rng.uniform(distribution["low"], distribution["high"], size)
+    elif kind == "triangular":
+        factors = rng.triangular(distribution["low"], distribution.get("mode", 1.0), distribution["high"], size)
+    else:
+        raise ValueError(f"Unknown distribution type: {kind} (use fixed, normal, lognormal, uniform or triangular)")
+    return np.clip(factors, 0, None)  # Damages and velocity thresholds cannot be negative
+
+
+class DamageEnsemble:
+    """
+    A class for the members of a Monte Carlo ensemble: one row of damage values per member in a (members x lookup
+    slots) table, so the damage of every member is a single gather with the slots of a DamageModel, and one velocity
+    threshold per member
+    """
+    def __init__(self, damage_model, land_use_map, members, damage_distribution, class_distributions=None,
+                 threshold_distribution=None, velocity_threshold=1, seed=0):
+        """
+        Initializes the DamageEnsemble object and draws all members.
+
+        :param damage_model: DamageModel compiled from the land use map, its slots index the member table
+        :param land_use_map: Dictionary of land use pixel value -> economic damage (point estimates)
+        :param members: Number of members
+        :param damage_distribution: Distribution of the damage values of every class (see sample_factors())
+        :param class_distributions: Optional dictionary of land use pixel value -> distribution, replacing the default
+            distribution for these classes
+        :param threshold_distribution: Distribution of the velocity threshold, fixed if None
+        :param velocity_threshold: Point estimate of the velocity threshold
+        :param seed: Seed of the random generator, the same seed draws the same members
+        """
+        rng = np.random.default_rng(seed)
+        self.members = members
+        self.codes = sorted(land_use_map)
+        self.point_values = land_use_map
+
+        # Unknown codes and no-data keep their value in every member
+        self.table = np.tile(damage_model.values.astype(np.float32), (members, 1))
+        for code in self.codes:
+            distribution = (class_distributions or {}).get(code, damage_distribution)
+            self.table[:, code] = land_use_map[code] * sample_factors(distribution, members, rng)
+        self.thresholds = (velocity_threshold * sample_factors(threshold_distribution or {"type": "fixed"}, members, rng)).astype(np.float32)
+
+    def damage(self, damage_model, slots, inundation, velocity, start, stop):
+        """
+        Computes the damage of the members start to stop for a block.
+
+        :param damage_model: DamageModel the member table was built from
+        :param slots: numpy array of lookup slots of the block (intp), from damage_model.index()
+        :param inundation: float32 numpy array with the inundation of the block
+        :param velocity: float32 numpy array with the velocity of the block, or None
+        :param start: First member
+        :param stop: Member after the last one
+        :return: float32 numpy array of shape (stop - start, rows, cols)
+        """
+        # Same formula as main.compute_intensity(), with the threshold of every member
+        if velocity is None:
+            intensity = inundation[np.newaxis]
+        else:
+            above = velocity[np.newaxis] > self.thresholds[start:stop, np.newaxis, np.newaxis]
+            intensity = np.where(above, inundation * velocity, inundation)
+
+        values = np.take(self.table[start:stop], slots, axis=1)
+        values *= damage_model.damage_factor(slots, intensity)
+        return values
+
+    def to_dataframe(self, member_totals=None):
+        """
+        Returns the drawn parameters of every member, so an ensemble can be reproduced and single members inspected.
+
+        :param member_totals: Optional numpy array with the total risk of every member
+        :return: pandas DataFrame with the columns Member, Velocity Threshold, (Total Risk) and one per land use class
+        """
+        columns = {"Member": np.arange(1, self.members + 1), "Velocity Threshold": self.thresholds}
+        if member_totals is not None:
+            columns["Total Risk"] = member_totals
+        for code in self.codes:
+            columns[f"Class {code}"] = self.table[:, code]
+        return pd.DataFrame(columns)
+
+
+def run_ensemble(user_inputs, members=None, percentiles=None, chunk_size=None, seed=None, resources=None, memory_mb=None):
+    """
+    Computes a Monte Carlo ensemble of the risk in a single pass over the data, with damage values and velocity
+    thresholds drawn from the distributions in config.py. For every block, the land use is looked up once and all
+    members are evaluated in chunks of chunk_size members. The percentiles need the risk of every member on the same
+    pixels, so each block is split into strips of rows whose member stack (members x strip pixels x 4 bytes) fits into
+    memory_mb; memory is bounded by memory_mb, not by the number of members or the block size. chunk_size only limits
+    the temporaries of the damage computation.
+
+    Outputs in user_inputs["output_dir"]:
+    - ensemble_mean.tif and ensemble_p<percentile>.tif: mean and percentiles of the risk of every pixel over the
+      members (float32, pixels without risk in any member get the no-data value)
+    - ensemble_land_use_risk.csv: mean and percentiles of the total risk of every land use class and of all classes
+    - ensemble_members.csv: the drawn parameters and the total risk of every member
+
+    :param user_inputs: Dictionary with "flood_depth_file", "velocity_file", "return_period", "no_data_value",
+        "output_dir" and optionally "block_size" (None uses the internal blocks of the inundation raster)
+    :param members: Number of members, defaults to config.ENSEMBLE_MEMBERS
+    :param percentiles: Percentiles of the outputs, defaults to config.ENSEMBLE_PERCENTILES
+    :param chunk_size: Number of members evaluated at once, defaults to config.ENSEMBLE_CHUNK_SIZE
+    :param seed: Seed of the random generator, defaults to config.ENSEMBLE_SEED
+    :param resources: Dictionary from main.load_resources(), loaded here if not provided
+    :param memory_mb: Size limit of the member stack of a strip in megabytes, defaults to config.ENSEMBLE_MEMORY_MB
+        (np.percentile sorts a copy of it, so the peak is about twice as much)
+    :return: Dictionary of output file paths
+    """
+    members = members or config.ENSEMBLE_MEMBERS
+    memory_mb = memory_mb or config.ENSEMBLE_MEMORY_MB
+    percentiles = list(percentiles or config.ENSEMBLE_PERCENTILES)
+    chunk_size = chunk_size or config.ENSEMBLE_CHUNK_SIZE
+    seed = config.ENSEMBLE_SEED if seed is None else seed
+    no_data_value = user_inputs["no_data_value"]
+    output_dir = user_inputs["output_dir"]
+    block_size = user_inputs.get("block_size", config.BLOCK_SIZE) or 0
+
+    if resources is None:
+        resources = main.load_resources()
+    damage_model = resources["damage_model"]
+    land_use_nodata = resources["land_use_raster"].nodata
+    ensemble = DamageEnsemble(
+        damage_model, config.LAND_USE_MAP, members, config.ENSEMBLE_DAMAGE_DISTRIBUTION,
+        config.ENSEMBLE_CLASS_DISTRIBUTIONS, config.ENSEMBLE_THRESHOLD_DISTRIBUTION, config.VELOCITY_THRESHOLD, seed
+    )
+
+    inundation_raster = Raster(user_inputs["flood_depth_file"])
+    velocity_file = user_inputs.get("velocity_file")
+    if not inundation_raster.overlaps(resources["land_use_raster"]):
+        raise ValueError("Inundation raster is outside of the land use raster, or there is a coordinate system issue.")
+
+    land_use_grid = None
+    if resources["resample_cache"]:
+        land_use_grid = resources["resample_cache"].fetch(
+            inundation_raster, resources["land_use_path"], Resampling[config.LAND_USE_RESAMPLING], block_size,
+            config.WARP_THREADS, config.WARP_MEMORY_LIMIT_MB, source_dataset=resources["land_use_source"]
+        )
+
+    outputs = {"mean": os.path.join(output_dir, "ensemble_mean.tif")}
+    for percentile in percentiles:
+        outputs[f"p{percentile:g}"] = os.path.join(output_dir, f"ensemble_p{percentile:g}.tif")
+
+    # Total risk of every member and lookup slot, and the pixels with risk of every slot
+    slot_count = len(damage_model.values)
+    totals = np.zeros((members, slot_count))
+    pixel_counts = np.zeros(slot_count, dtype=np.int64)
+    risk_scale = np.float32(1 / user_inputs["return_period"])
+
+    with ExitStack() as stack:
+        inundation_src = stack.enter_context(rasterio.open(inundation_raster.file_path))
+        warped_inputs = stack.enter_context(main.open_warped_inputs(inundation_raster, resources["land_use_source"], velocity_file, land_use_grid))
+        writers = {}
+
+        for block_window in inundation_raster.iter_windows(block_size):
+            inundation_block = inundation_src.read(1, window=block_window).astype(np.float32, copy=False)
+            blocks = warped_inputs.read(block_window)
+            land_use_block = land_use_grid[block_window.toslices()] if land_use_grid is not None else blocks["land_use"]
+            velocity_block = blocks["velocity"].astype(np.float32, copy=False) if "velocity" in blocks else None
+            slots_block = damage_model.index(land_use_block, land_use_nodata).astype(np.intp)
+
+            # Strips of rows whose member stack fits into the memory limit
+            strip_rows = max(1, int(memory_mb * 1024 * 1024 // (members * block_window.width * 4)))
+            for row in range(0, block_window.height, strip_rows):
+                rows = slice(row, min(row + strip_rows, block_window.height))
+                window = Window(block_window.col_off, block_window.row_off + row, block_window.width, rows.stop - row)
+                inundation = inundation_block[rows]
+                velocity = velocity_block[rows] if velocity_block is not None else None
+                slots = slots_block[rows]
+
+                # Risk of every member on this strip, computed chunk by chunk of members
+                member_risk = np.empty((members,) + inundation.shape, dtype=np.float32)
+                for start in range(0, members, chunk_size):
+                    stop = min(start + chunk_size, members)
+                    member_risk[start:stop] = ensemble.damage(damage_model, slots, inundation, velocity, start, stop)
+                    member_risk[start:stop] *= risk_scale
+
+                    # One bincount over the combined (member, slot) position gives the total risk per class of the chunk
+                    combined = (np.arange(stop - start)[:, np.newaxis] * slot_count + slots.ravel()).ravel()
+                    totals[start:stop] += np.bincount(
+                        combined, weights=member_risk[start:stop].ravel(), minlength=(stop - start) * slot_count
+                    ).reshape(stop - start, slot_count)
+
+                # Like the single run risk raster, pixels without risk in any member get the no-data value
+                results = {"mean": member_risk.mean(axis=0, dtype=np.float64)}
+                valid = results["mean"] > 0
+                pixel_counts += np.bincount(slots[valid], minlength=slot_count)
+                for percentile, values in zip(percentiles, np.percentile(member_risk, percentiles, axis=0)):
+                    results[f"p{percentile:g}"] = values
+                del member_risk
+
+                for name, result in results.items():
+                    result = np.where(valid, result, no_data_value).astype(np.float32)
+                    if name not in writers:
+                        writers[name] = stack.enter_context(
+                            inundation_raster.open_writer(outputs[name], np.float32, no_data_value, config.OUTPUT_PROFILE)
+                        )
+                    writers[name].write(result, 1, window=window)
+
+    member_totals = totals.sum(axis=1)
+    outputs["land_use_risk"] = os.path.join(output_dir, "ensemble_land_use_risk.csv")
+    ensemble_table(ensemble, damage_model, totals, pixel_counts, percentiles).to_csv(outputs["land_use_risk"], index=False)
+    outputs["members"] = os.path.join(output_dir, "ensemble_members.csv")
+    ensemble.to_dataframe(member_totals).to_csv(outputs["members"], index=False)
+
+    low, high = np.percentile(member_totals, [min(percentiles), max(percentiles)])
+    print(f"Ensemble of {members} members saved to {output_dir} (total risk: mean {member_totals.mean():.2f}, "
+          f"P{min(percentiles):g} {low:.2f}, P{max(percentiles):g} {high:.2f})")
+    if damage_model.unknown_codes:
+        print(f"Land use classes not in LAND_USE_MAP (damage set to 0): {sorted(damage_model.unknown_codes)}")
+    return outputs
+
+
+def ensemble_table(ensemble, damage_model, totals, pixel_counts, percentiles):
+    """
+    Builds the table of the total risk per land use class over the members.
+
+    :param ensemble: DamageEnsemble of the members
+    :param damage_model: DamageModel whose slots index the totals
+    :param totals: numpy array (members x slots) with the total risk of every member and slot
+    :param pixel_counts: numpy array with the number of pixels with risk of every slot
+    :param percentiles: Percentiles of the table
+    :return: pandas DataFrame with one row per land use class with risk, and a last row "All" with the total risk
+    """
+    slots = [code for code in ensemble.codes if pixel_counts[code]]
+    labels = [str(code) for code in slots]
+    point_values = [ensemble.point_values[code] for code in slots]
+    if pixel_counts[damage_model.unknown_slot]:
+        slots.append(damage_model.unknown_slot)
+        labels.append("unknown")
+        point_values.append(damage_model.values[damage_model.unknown_slot])
+
+    columns = np.concatenate([totals[:, slots], totals.sum(axis=1, keepdims=True)], axis=1)
+    table = pd.DataFrame({
+        "Land Use Class": labels + ["All"],
+        "Damage Value": point_values + [None],
+        "Pixel Count": [int(pixel_counts[slot]) for slot in slots] + [int(pixel_counts.sum())],
+        "Mean Total Risk": columns.mean(axis=0),
+    })
+    for percentile, values in zip(percentiles, np.percentile(columns, percentiles, axis=0)):
+        table[f"P{percentile:g} Total Risk"] = values
+    return table
+
+
+if __name__ == "__main__":
+    # e.g. `python ensemble.py data/BiberachInundation.tif --velocity data/BiberachVelocity.tif --return-period 100 --output-dir results`
+    parser = argparse.ArgumentParser(description="Compute a Monte Carlo ensemble of the flood risk with uncertain damage values.")
+    parser.add_argument("inundation", help="inundation raster")
+    parser.add_argument("--velocity", default=None, help="optional flow velocity raster")
+    parser.add_argument("--return-period", type=int, required=True, help="return period of the inundation")
+    parser.add_argument("--output-dir", required=True, help="directory for the ensemble rasters and tables")
+    parser.add_argument("--no-data", type=float, default=-999, help="no-data value of the outputs (default: -999)")
+    parser.add_argument("--members", type=int, default=config.ENSEMBLE_MEMBERS, help="number of members (default: %(default)s)")
+    parser.add_argument("--percentiles", type=float, nargs="+", default=config.ENSEMBLE_PERCENTILES, help="percentiles of the outputs (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=config.ENSEMBLE_SEED, help="random seed (default: %(default)s)")
+    parser.add_argument("--block-size", type=int, default=config.BLOCK_SIZE, help="block-streaming window size, 0 for internal blocks")
+    parser.add_argument("--memory-mb", type=int, default=config.ENSEMBLE_MEMORY_MB, help="size limit of the member stack of a strip (default: %(default)s)")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    run_ensemble({
+        "flood_depth_file": args.inundation,
+        "velocity_file": args.velocity,
+        "return_period": args.return_period,
+        "no_data_value": args.no_data,
+        "output_dir": args.output_dir,
+        "block_size": args.block_size,
+    }, args.members, args.percentiles, seed=args.seed, memory_mb=args.memory_mb)
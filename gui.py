@@ -1,11 +1,48 @@
+import base64
+import os
+import queue
+import threading
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from io import BytesIO
+from tkinter import filedialog, messagebox, ttk
+import rasterio
+from matplotlib import image as mpl_image
+from instrumentation import RunCancelled
+from pdfdocument import PDFDocument
 
-def launch_gui():
+# Largest width or height of the risk preview shown after a run, in pixels
+PREVIEW_SIZE = 400
+
+
+def render_preview(raster_path, max_pixels=PREVIEW_SIZE):
+    """
+    Draws a low-resolution preview of a risk raster, read from its overviews if it has them.
+
+    :param raster_path: Path to the risk GeoTIFF
+    :param max_pixels: Largest width or height of the preview
+    :return: PNG image as base64 text, for tk.PhotoImage(data=...)
+    """
+    with rasterio.open(raster_path) as src:
+        data, _ = PDFDocument.read_decimated(src, max_pixels)
+    buffer = BytesIO()
+    mpl_image.imsave(buffer, data, cmap="Reds", format="png")  # No-data pixels are transparent
+    return base64.b64encode(buffer.getvalue())
+
+
+def launch_gui(run_function=None):
     """
     Launches the gui for flood risk analysis user inputs: return period, no data value, file paths, optional PDF generation.
 
-    Returns dictionary containing user-defined parameters:
+    Without a run function, the window closes when "Run Script" is clicked and the inputs are returned. With a run
+    function, the window stays open and runs it in a background thread: it shows the progress of every stage, can
+    cancel the run (the run function removes its partial outputs) and shows a preview of the risk raster when the run
+    is done. Several runs can be started one after the other.
+
+    :param run_function: Optional function (user inputs, progress) -> dictionary of output paths, e.g.
+        main.run_from_gui. progress(stage name, fraction done) raises RunCancelled after Cancel was clicked.
+
+    Returns dictionary containing user-defined parameters (without a run function, otherwise the outputs of the last
+    successful run or None):
         - "return_period" (int): The flood return period
         - "no_data_value" (float): The no-data value used in analysis
         - "flood_depth_file" (str): Path to the inundation file
@@ -41,8 +78,11 @@ def launch_gui():
                 "generate_pdf": generate_pdf
             }
 
-            # Close GUI
-            root.destroy()
+            # Close GUI, or run the analysis in the background
+            if run_function is None:
+                root.destroy()
+            else:
+                start_run(user_inputs)
 
         except Exception as e:
             messagebox.showerror("Error", str(e))
@@ -68,6 +108,108 @@ def launch_gui():
         if output_path:
             variable.set(output_path)
 
+    def start_run(inputs):
+        """
+        Starts the run function in a background thread, the window stays responsive.
+
+        :param inputs: The user inputs of the run
+        """
+        nonlocal worker
+        cancel_event.clear()
+        run_button.config(state="disabled")
+        cancel_button.config(state="normal")
+        preview_label.config(image="")
+        progress_var.set(0)
+        status_var.set("Starting...")
+
+        def report(stage, fraction):
+            # Called from the worker thread, the widgets are only updated by poll_events in the Tk thread
+            if cancel_event.is_set():
+                raise RunCancelled()
+            events.put(("progress", (stage, fraction)))
+
+        def work():
+            try:
+                events.put(("done", run_function(inputs, report)))
+            except RunCancelled:
+                events.put(("cancelled", None))
+            except Exception as e:
+                events.put(("error", f"{type(e).__name__}: {e}"))
+
+        worker = threading.Thread(target=work, daemon=True)
+        worker.start()
+        root.after(100, poll_events)
+
+    def poll_events():
+        """
+        Shows the progress reported by the worker thread, until the run has finished.
+        """
+        while True:
+            try:
+                kind, value = events.get_nowait()
+            except queue.Empty:
+                break
+            if kind != "progress":
+                finish_run(kind, value)
+                return
+            if not cancel_event.is_set():  # Keeps "Cancelling..." until the run has stopped
+                stage, fraction = value
+                status_var.set(f"{stage}: {fraction:.0%}")
+                progress_var.set(fraction * 100)
+        root.after(100, poll_events)
+
+    def finish_run(kind, value):
+        """
+        Shows the result of a run: the preview of the risk raster, the cancellation or the error.
+
+        :param kind: "done", "cancelled" or "error"
+        :param value: Dictionary of output paths, or the error message
+        """
+        nonlocal outputs
+        if closing:
+            root.destroy()
+            return
+        run_button.config(state="normal")
+        cancel_button.config(state="disabled")
+        if kind == "done":
+            outputs = value
+            progress_var.set(100)
+            status_var.set(f"Done, results saved to {os.path.dirname(value['risk'])}")
+            # Errors raised in a Tk callback are only printed, they are shown like the errors of the run instead
+            try:
+                preview = tk.PhotoImage(data=render_preview(value["risk"]))
+            except Exception as e:
+                status_var.set(f"Done, results saved to {os.path.dirname(value['risk'])} (no preview)")
+                messagebox.showerror("Error", f"The preview of the risk raster could not be drawn: {e}")
+                return
+            preview_label.config(image=preview)
+            preview_label.image = preview  # Tk does not keep a reference to the image
+        elif kind == "cancelled":
+            progress_var.set(0)
+            status_var.set("Cancelled, the outputs of the run were removed")
+        else:
+            status_var.set("Failed")
+            messagebox.showerror("Error", value)
+
+    def cancel_run():
+        """
+        Asks the worker thread to stop, it stops at the next block or stage.
+        """
+        cancel_event.set()
+        cancel_button.config(state="disabled")
+        status_var.set("Cancelling...")
+
+    def on_close():
+        """
+        Closes the window, a running analysis is cancelled first so it does not leave partial outputs.
+        """
+        nonlocal closing
+        if worker is not None and worker.is_alive():
+            closing = True
+            cancel_run()
+        else:
+            root.destroy()
+
     # Initialize GUI
     root = tk.Tk()
     root.title("Flood Risk Analysis Configuration")
@@ -106,11 +248,30 @@ def launch_gui():
     )
 
     # Run button
-    tk.Button(root, text="Run Script", command=on_run_script).grid(
-        row=len(fields) + len(file_fields) + 1, column=0, columnspan=3, pady=20
-    )
+    run_button = tk.Button(root, text="Run Script", command=on_run_script)
+    run_button.grid(row=len(fields) + len(file_fields) + 1, column=0, columnspan=3, pady=20)
+
+    # Progress, cancellation and preview of runs in the background
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    worker = None
+    closing = False
+    outputs = None
+    status_var = tk.StringVar()
+    progress_var = tk.DoubleVar()
+    cancel_button = tk.Button(root, text="Cancel", command=cancel_run, state="disabled")
+    preview_label = tk.Label(root)
+    if run_function is not None:
+        row = len(fields) + len(file_fields) + 2
+        tk.Label(root, textvariable=status_var).grid(row=row, column=0, columnspan=3, padx=10, sticky="w")
+        ttk.Progressbar(root, variable=progress_var, maximum=100).grid(row=row + 1, column=0, columnspan=2, padx=10, pady=5, sticky="we")
+        cancel_button.grid(row=row + 1, column=2, padx=10, pady=5)
+        preview_label.grid(row=row + 2, column=0, columnspan=3, padx=10, pady=10)
+        root.protocol("WM_DELETE_WINDOW", on_close)
 
     user_inputs = None
     root.mainloop()
 
+    if run_function is not None:
+        return outputs  # Outputs of the last successful run
     return user_inputs  # Return the user inputs dictionary after GUI is closed
\ No newline at end of file
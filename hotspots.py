@@ -0,0 +1,344 @@
+import argparse
+import os
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from skimage.measure import label
+import config
+from raster import Raster, resolve_output_profile
+
+
+def label_block(risk, threshold, no_data_value=None, connectivity=8):
+    """
+    Labels the connected areas of pixels with a risk of at least the threshold in one block.
+
+    :param risk: numpy array with risk values
+    :param threshold: Smallest risk of a hotspot pixel
+    :param no_data_value: No-data value of the risk raster, these pixels are never part of a hotspot
+    :param connectivity: 4 (edges) or 8 (edges and corners) neighbours
+    :return: tuple (numpy array of labels 1..n, 0 outside of hotspots, and n)
+    """
+    mask = np.isfinite(risk) & (risk >= threshold)
+    if no_data_value is not None:
+        mask &= risk != no_data_value
+    return label(mask, connectivity=1 if connectivity == 4 else 2, return_num=True)
+
+
+def seam_pairs(labels, neighbours, connectivity=8):
+    """
+    Returns the pairs of labels that touch across a seam between two blocks.
+
+    :param labels: Labels of the first row (or column) of the current block, 0 outside of hotspots
+    :param neighbours: Labels of the adjacent row (or column) of the blocks before it, one more value on each side
+        (0 where there is no pixel)
+    :param connectivity: 4 or 8 neighbours, with 8 the diagonal neighbours across the seam touch as well
+    :return: numpy array of shape (pairs, 2)
+    """
+    shifts = (-1, 0, 1) if connectivity == 8 else (0,)
+    pairs = []
+    for shift in shifts:
+        other = neighbours[1 + shift:1 + shift + labels.size]
+        touching = (labels > 0) & (other > 0)
+        pairs.append(np.column_stack((labels[touching], other[touching])))
+    return np.concatenate(pairs)
+
+
+class HotspotStatistics:
+    """
+    A class for the statistics of the hotspots (connected areas of high risk) of a risk raster, collected block by
+    block: every block is labelled on its own, and the labels that touch across the block seams are merged at the end
+    """
+    def __init__(self, transform, land_use_nodata=None):
+        """
+        Initializes the HotspotStatistics object.
+
+        :param transform: Affine transform of the risk raster, for the bounding boxes and areas
+        :param land_use_nodata: No-data value of the land use classes, not counted for the dominant class
+        """
+        self.transform = transform
+        self.land_use_nodata = land_use_nodata
+        self.label_count = 0  # Labels of all blocks, before merging
+        self.blocks = []
+        self.classes = []
+        self.pairs = [np.empty((0, 2), dtype=np.int64)]
+
+    def update(self, window, labels, count, risk, land_use=None):
+        """
+        Adds the hotspots of a block with a single vectorized pass over its hotspot pixels.
+
+        :param window: rasterio Window of the block
+        :param labels: Labels 1..count of the block from label_block()
+        :param count: Number of labels of the block
+        :param risk: numpy array with the risk values of the block
+        :param land_use: Optional numpy array with the land use classes of the block
+        :return: The global number of the first label of the block, label i of the block is first + i - 1
+        """
+        first = self.label_count + 1
+        self.label_count += count
+        if count == 0:
+            return first
+
+        # Hotspot pixels in row-major order, sorted by label so every label is one contiguous run
+        rows, cols = np.nonzero(labels)
+        local = labels[rows, cols] - 1
+        order = np.argsort(local, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(local[order]) != 0])
+        values = risk[rows, cols].astype(np.float64)
+        self.blocks.append({
+            "pixels": np.bincount(local, minlength=count),
+            "total": np.bincount(local, weights=values, minlength=count),
+            "max": np.maximum.reduceat(values[order], starts),
+            "row_min": rows[order][starts] + window.row_off,
+            "row_max": np.maximum.reduceat(rows[order], starts) + window.row_off,
+            "col_min": np.minimum.reduceat(cols[order], starts) + window.col_off,
+            "col_max": np.maximum.reduceat(cols[order], starts) + window.col_off,
+        })
+
+        if land_use is not None:
+            classes = land_use[rows, cols]
+            keep = classes != self.land_use_nodata if self.land_use_nodata is not None else np.ones(classes.size, bool)
+            codes, inverse = np.unique(classes[keep], return_inverse=True)
+            # One bincount over the combined (label, class) position counts the classes of every label
+            counts = np.bincount(local[keep] * codes.size + inverse, minlength=count * codes.size).reshape(count, codes.size)
+            label_index, class_index = np.nonzero(counts)
+            self.classes.append(np.column_stack((
+                label_index + first, codes[class_index].astype(np.int64), counts[label_index, class_index]
+            )))
+        return first
+
+    def add_pairs(self, pairs):
+        """
+        Records labels that touch across a seam, they belong to the same hotspot.
+        """
+        self.pairs.append(np.asarray(pairs, dtype=np.int64).reshape(-1, 2))
+
+    def merge_labels(self):
+        """
+        Merges the labels that touch across seams, with label propagation and pointer jumping until every pair has the
+        same root.
+
+        :return: numpy array label -> root label (index 0 is the background)
+        """
+        parent = np.arange(self.label_count + 1)
+        pairs = np.unique(np.concatenate(self.pairs), axis=0)
+        while pairs.size:
+            first, second = parent[pairs[:, 0]], parent[pairs[:, 1]]
+            differ = first != second
+            if not differ.any():
+                break
+            np.minimum.at(parent, np.maximum(first, second)[differ], np.minimum(first, second)[differ])
+            while True:
+                grandparent = parent[parent]
+                if np.array_equal(grandparent, parent):
+                    break
+                parent = grandparent
+        return parent
+
+    def resolve(self, min_pixels=1):
+        """
+        Merges the labels across seams and ranks the hotspots by total risk.
+
+        :param min_pixels: Hotspots with fewer pixels are dropped
+        :return: tuple (pandas DataFrame of the hotspots, numpy array label -> rank, 0 for dropped labels)
+        """
+        root = self.merge_labels()
+        size = self.label_count + 1
+        merged = {"pixels": np.zeros(size), "total": np.zeros(size), "max": np.full(size, -np.inf),
+                  "row_min": np.full(size, np.iinfo(np.int64).max), "row_max": np.full(size, -1),
+                  "col_min": np.full(size, np.iinfo(np.int64).max), "col_max": np.full(size, -1)}
+        first = 1
+        for block in self.blocks:
+            roots = root[first:first + block["pixels"].size]
+            first += block["pixels"].size
+            merged["pixels"] += np.bincount(roots, weights=block["pixels"], minlength=size)
+            merged["total"] += np.bincount(roots, weights=block["total"], minlength=size)
+            for name, function in (("max", np.maximum), ("row_max", np.maximum), ("col_max", np.maximum),
+                                   ("row_min", np.minimum), ("col_min", np.minimum)):
+                function.at(merged[name], roots, block[name])
+
+        hotspots = np.flatnonzero((root == np.arange(size)) & (merged["pixels"] >= max(min_pixels, 1)))
+        hotspots = hotspots[np.lexsort((hotspots, -merged["total"][hotspots]))]
+        rank = np.zeros(size, dtype=np.int64)
+        rank[hotspots] = np.arange(1, hotspots.size + 1)
+
+        dominant, share = np.full(size, np.nan), np.full(size, np.nan)
+        if self.classes:
+            classes = np.concatenate(self.classes)
+            keys = np.column_stack((root[classes[:, 0]], classes[:, 1]))
+            keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+            counts = np.bincount(inverse.ravel(), weights=classes[:, 2])
+            # The class with the most pixels of every root comes first
+            order = np.lexsort((-counts, keys[:, 0]))
+            firsts = order[np.r_[True, np.diff(keys[order, 0]) != 0]]
+            dominant[keys[firsts, 0]] = keys[firsts, 1]
+            class_pixels = np.bincount(keys[:, 0], weights=counts, minlength=size)
+            share[keys[firsts, 0]] = counts[firsts] / class_pixels[keys[firsts, 0]]
+
+        left, top = self.transform * (merged["col_min"][hotspots], merged["row_min"][hotspots])
+        right, bottom = self.transform * (merged["col_max"][hotspots] + 1, merged["row_max"][hotspots] + 1)
+        table = pd.DataFrame({
+            "Rank": rank[hotspots],
+            "Pixel Count": merged["pixels"][hotspots].astype(np.int64),
+            "Area": merged["pixels"][hotspots] * abs(self.transform.a * self.transform.e),
+            "Total Risk": merged["total"][hotspots],
+            "Max Risk": merged["max"][hotspots],
+            "Mean Risk": merged["total"][hotspots] / merged["pixels"][hotspots],
+            "Dominant Land Use": pd.array(dominant[hotspots], dtype="Int64") if self.classes else pd.NA,
+            "Dominant Land Use Share": share[hotspots],
+            "Row Min": merged["row_min"][hotspots], "Row Max": merged["row_max"][hotspots],
+            "Col Min": merged["col_min"][hotspots], "Col Max": merged["col_max"][hotspots],
+            "Left": left, "Bottom": bottom, "Right": right, "Top": top,
+        })
+        return table, rank[root]
+
+
+def hotspot_windows(risk_raster, block_size=None):
+    """
+    Returns the windows of the hotspot search, in row-major order.
+
+    :param risk_raster: Raster object of the risk GeoTIFF
+    :param block_size: None labels the whole raster at once, otherwise the block size as in config.BLOCK_SIZE
+    :return: List of rasterio Window objects
+    """
+    if block_size is None:
+        return [Window(0, 0, risk_raster.shape[1], risk_raster.shape[0])]
+    return list(risk_raster.iter_windows(block_size))
+
+
+def find_hotspots(risk_path, threshold, land_use=None, land_use_nodata=None, connectivity=8, block_size=None):
+    """
+    Labels the hotspots of a risk GeoTIFF block by block and collects their statistics. Only the labels of the row
+    of pixels above the current row of blocks and of the column left of the current block are kept to find the labels
+    that touch across the seams, so memory is bounded by the block size.
+
+    :param risk_path: Path to the risk GeoTIFF, its no-data value marks pixels without risk
+    :param threshold: Smallest risk of a hotspot pixel
+    :param land_use: Optional land use classes for the dominant class: an array on the risk grid (e.g. from the
+        resample cache), or the path to (or open dataset of) a land use raster, which is warped window by window
+    :param land_use_nodata: No-data value of the land use classes, read from the raster if land_use is not an array
+    :param connectivity: 4 or 8 neighbours
+    :param block_size: None labels the whole raster at once, otherwise the block size as in config.BLOCK_SIZE
+    :return: tuple (HotspotStatistics object, list of the label offset of every window for write_label_raster())
+    """
+    risk_raster = Raster(risk_path)
+    width = risk_raster.shape[1]
+    with ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(risk_path))
+        vrt = None
+        if land_use is not None and not isinstance(land_use, np.ndarray):
+            land_use_nodata = land_use.nodata if hasattr(land_use, "nodata") else Raster(land_use).nodata
+            vrt = stack.enter_context(risk_raster.open_resampled(land_use, Resampling[config.LAND_USE_RESAMPLING]))
+
+        statistics = HotspotStatistics(src.transform, land_use_nodata)
+        offsets = []
+        # Labels of the last row of the previous and of the current row of blocks, with one empty pixel on each side
+        above, below = np.zeros(width + 2, dtype=np.int64), np.zeros(width + 2, dtype=np.int64)
+        left, row_off = None, 0
+        for window in hotspot_windows(risk_raster, block_size):
+            if window.row_off != row_off:
+                above, below = below, np.zeros(width + 2, dtype=np.int64)
+                left, row_off = None, window.row_off
+
+            risk = src.read(1, window=window)
+            labels, count = label_block(risk, threshold, src.nodata, connectivity)
+            land_use_block = None
+            if count and vrt is not None:
+                land_use_block = vrt.read(1, window=window)
+            elif count and land_use is not None:
+                land_use_block = land_use[window.toslices()]
+            first = statistics.update(window, labels, count, risk, land_use_block)
+            offsets.append(first - 1)
+
+            labels = np.where(labels > 0, labels + (first - 1), 0)
+            if window.row_off > 0:
+                statistics.add_pairs(seam_pairs(labels[0], above[window.col_off:window.col_off + window.width + 2], connectivity))
+            if left is not None:
+                statistics.add_pairs(seam_pairs(labels[:, 0], left, connectivity))
+            below[window.col_off + 1:window.col_off + window.width + 1] = labels[-1]
+            left = np.r_[0, labels[:, -1], 0]
+    return statistics, offsets
+
+
+def write_label_raster(risk_path, output_path, ranks, offsets, threshold, connectivity=8, block_size=None):
+    """
+    Writes the hotspot label raster: every pixel gets the rank of its hotspot (1 = highest total risk), 0 outside of
+    hotspots. The blocks are labelled again exactly like in find_hotspots(), so no raster of intermediate labels is
+    stored.
+
+    :param risk_path: Path to the risk GeoTIFF
+    :param output_path: Path of the label GeoTIFF
+    :param ranks: numpy array label -> rank from HotspotStatistics.resolve()
+    :param offsets: Label offset of every window from find_hotspots()
+    :param threshold: Smallest risk of a hotspot pixel, as in find_hotspots()
+    :param connectivity: 4 or 8 neighbours, as in find_hotspots()
+    :param block_size: Block size, as in find_hotspots()
+    """
+    risk_raster = Raster(risk_path)
+    # Labels are categorical, the overviews must not average them
+    profile = resolve_output_profile(config.OUTPUT_PROFILE)
+    profile["overview_resampling"] = "nearest"
+    dtype = np.uint16 if ranks.max(initial=0) < 2 ** 16 else np.uint32
+    with rasterio.open(risk_path) as src, risk_raster.open_writer(output_path, dtype, 0, profile) as dst:
+        for window, offset in zip(hotspot_windows(risk_raster, block_size), offsets):
+            labels, _ = label_block(src.read(1, window=window), threshold, src.nodata, connectivity)
+            dst.write(np.where(labels > 0, ranks[labels + offset], 0).astype(dtype), 1, window=window)
+
+
+def run_hotspots(risk_path, output_dir, threshold=None, land_use=None, land_use_nodata=None, min_pixels=None,
+                 connectivity=None, block_size=None):
+    """
+    Finds the hotspots of a risk GeoTIFF: connected areas of pixels with a risk of at least the threshold. Saves
+    hotspots.csv (one row per hotspot, ranked by total risk, with the pixel count, area in CRS units, total, maximum
+    and mean risk, dominant land use class and its share of the pixels, and the bounding box in pixels and
+    coordinates) and hotspot_labels.tif (the rank of the hotspot of every pixel).
+
+    :param risk_path: Path to the risk GeoTIFF
+    :param output_dir: Folder of the outputs
+    :param threshold: Smallest risk of a hotspot pixel, defaults to config.HOTSPOT_THRESHOLD
+    :param land_use: Optional land use classes for the dominant class (see find_hotspots())
+    :param land_use_nodata: No-data value of the land use classes, read from the raster if land_use is not an array
+    :param min_pixels: Smallest hotspot in pixels, defaults to config.HOTSPOT_MIN_PIXELS
+    :param connectivity: 4 or 8 neighbours, defaults to config.HOTSPOT_CONNECTIVITY
+    :param block_size: None labels the whole raster at once, otherwise the block size as in config.BLOCK_SIZE
+    :return: Dictionary of output name -> path
+    """
+    threshold = config.HOTSPOT_THRESHOLD if threshold is None else threshold
+    if threshold is None:
+        raise ValueError("No hotspot threshold, set HOTSPOT_THRESHOLD in config.py.")
+    min_pixels = config.HOTSPOT_MIN_PIXELS if min_pixels is None else min_pixels
+    connectivity = connectivity or config.HOTSPOT_CONNECTIVITY
+    if connectivity not in (4, 8):
+        raise ValueError(f"The connectivity of the hotspots must be 4 or 8, not {connectivity}")
+
+    statistics, offsets = find_hotspots(risk_path, threshold, land_use, land_use_nodata, connectivity, block_size)
+    table, ranks = statistics.resolve(min_pixels)
+
+    paths = {"hotspots": os.path.join(output_dir, "hotspots.csv"), "hotspot_labels": os.path.join(output_dir, "hotspot_labels.tif")}
+    table.to_csv(paths["hotspots"], index=False)
+    write_label_raster(risk_path, paths["hotspot_labels"], ranks, offsets, threshold, connectivity, block_size)
+    print(f"{len(table)} hotspot(s) with a risk of at least {threshold} saved to {paths['hotspots']} and {paths['hotspot_labels']}")
+    return paths
+
+
+if __name__ == "__main__":
+    # e.g. `python hotspots.py output/risk_output.tif --threshold 1.0 --block-size 1024`
+    parser = argparse.ArgumentParser(description="Find and rank the connected areas of high risk of a risk GeoTIFF.")
+    parser.add_argument("risk", help="risk GeoTIFF written by the tool")
+    parser.add_argument("--threshold", type=float, default=config.HOTSPOT_THRESHOLD, help="smallest risk of a hotspot pixel (default: HOTSPOT_THRESHOLD of config.py)")
+    parser.add_argument("--min-pixels", type=int, default=config.HOTSPOT_MIN_PIXELS, help="smallest hotspot in pixels (default: %(default)s)")
+    parser.add_argument("--connectivity", type=int, choices=(4, 8), default=config.HOTSPOT_CONNECTIVITY, help="neighbours of a pixel (default: %(default)s)")
+    parser.add_argument("--block-size", type=int, default=None, help="label block by block for large rasters, 0 for internal blocks (default: whole raster)")
+    parser.add_argument("--no-land-use", action="store_true", help="skip the dominant land use class")
+    parser.add_argument("--output-dir", help="folder of the outputs (default: folder of the risk GeoTIFF)")
+    args = parser.parse_args()
+
+    if args.threshold is None:
+        parser.error("--threshold is required when HOTSPOT_THRESHOLD is not set in config.py")
+    run_hotspots(
+        args.risk, args.output_dir or os.path.dirname(os.path.abspath(args.risk)), args.threshold,
+        None if args.no_land_use else config.LAND_USE_PATH, min_pixels=args.min_pixels, connectivity=args.connectivity,
+        block_size=args.block_size
+    )
@@ -0,0 +1,290 @@
+import cProfile
+import hashlib
+import importlib
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+import numpy as np
+import rasterio
+
+# SHA-256 of files already hashed by this process, by (path, size, modification time)
+_file_hashes = {}
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory to the current one (Linux only), so every stage gets its own peak.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of the process in MB, since the last reset_peak_rss() on Linux.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS, and cannot be reset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def io_bytes():
+    """
+    Returns the bytes read and written by the process so far (all threads, including GDAL's), or (None, None) where
+    /proc/self/io is not available.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def file_sha256(path):
+    """
+    Computes the SHA-256 of a file, once per process for an unchanged file.
+
+    :param path: Path to the file
+    :return: Hex digest of the file contents
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def config_snapshot(config_module):
+    """
+    Returns the settings of the config module that can be stored as JSON, plus a fingerprint of the land use map and
+    the depth-damage curves, so runs with different damage values can be told apart.
+
+    :param config_module: The imported config module
+    :return: Dictionary of setting name -> value
+    """
+    snapshot = {}
+    for name in dir(config_module):
+        if name.isupper():
+            try:
+                snapshot[name] = json.loads(json.dumps(getattr(config_module, name)))
+            except (TypeError, ValueError):
+                snapshot[name] = repr(getattr(config_module, name))
+    damage_values = {
+        "land_use_map": sorted(getattr(config_module, "LAND_USE_MAP", {}).items()),
+        "depth_damage_curves": sorted((code, [list(depths), list(factors)]) for code, (depths, factors) in
+                                      getattr(config_module, "DEPTH_DAMAGE_CURVES", {}).items()),
+    }
+    snapshot["land_use_map_version"] = hashlib.sha256(json.dumps(damage_values).encode()).hexdigest()[:16]
+    return snapshot
+
+
+class RunCancelled(Exception):
+    """
+    Raised by a progress callback to stop a run, e.g. when the user presses Cancel in the GUI
+    """
+
+
+@contextmanager
+def cprofile_stage(stage_name, output_dir):
+    """
+    Profiler hook that runs cProfile around a stage and saves profile_<stage>.prof into the output directory, e.g. for
+    `python -m pstats` or snakeviz.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(output_dir, f"profile_{stage_name}.prof"))
+
+
+class RunRecorder:
+    """
+    A class for recording the wall time, CPU time, peak memory, I/O and raster shapes of every stage of a run, and
+    writing them to a JSON run manifest
+    """
+    def __init__(self, output_dir, profiler=None, profile_stages=None, progress=None):
+        """
+        Initializes the RunRecorder object.
+
+        :param output_dir: Directory of the run outputs, profiles are saved there
+        :param profiler: Optional profiler hook around stages: "cprofile", or "module:function" of a function
+            (stage name, output directory) -> context manager, e.g. to start a sampling profiler
+        :param profile_stages: Names of the stages that are profiled, all stages if None
+        :param progress: Optional function (stage name, fraction done) called when a stage starts and ends and for
+            every block of block-by-block stages. It can stop the run by raising RunCancelled.
+        """
+        self.output_dir = output_dir
+        self.profile_stages = profile_stages
+        self.profiler = self._load_profiler(profiler)
+        self.progress = progress
+        self.profiled_stages = []
+        self.stages = []
+        self.inputs = {}
+        self.started = datetime.now(timezone.utc)
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    @staticmethod
+    def _load_profiler(profiler):
+        """
+        Returns the profiler hook function of a profiler setting.
+        """
+        if not profiler:
+            return None
+        if profiler == "cprofile":
+            return cprofile_stage
+        module_name, _, function_name = profiler.partition(":")
+        return getattr(importlib.import_module(module_name), function_name)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Records one stage of the run. The yielded record can be given the shapes and dtypes of the rasters of the
+        stage with add_raster().
+
+        :param name: Name of the stage
+        :return: Context manager yielding the StageRecord
+        """
+        record = StageRecord(name, self.progress)
+        profiling = self.profiler and (self.profile_stages is None or name in self.profile_stages)
+        reset_peak_rss()
+        read_before, written_before = io_bytes()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        if profiling:
+            self.profiled_stages.append(name)
+        try:
+            with self.profiler(name, self.output_dir) if profiling else nullcontext():
+                record.progress(0.0)
+                yield record
+            record.progress(1.0)
+        finally:
+            record.wall_seconds = round(time.perf_counter() - start_wall, 4)
+            record.cpu_seconds = round(time.process_time() - start_cpu, 4)
+            record.peak_rss_mb = round(peak_rss_mb(), 1)
+            read_after, written_after = io_bytes()
+            if read_before is not None:
+                record.bytes_read = read_after - read_before
+                record.bytes_written = written_after - written_before
+            self.stages.append(record)
+
+    def add_input(self, role, path):
+        """
+        Records an input file with its size and SHA-256.
+
+        :param role: Name of the input, e.g. "flood_depth_file"
+        :param path: Path to the file, ignored if None
+        """
+        if path:
+            self.inputs[role] = {"path": os.path.abspath(path), "size": os.path.getsize(path), "sha256": file_sha256(path)}
+
+    def write_manifest(self, manifest_path, config_values=None, user_inputs=None, outputs=None):
+        """
+        Saves the run manifest as JSON.
+
+        :param manifest_path: string where the JSON will be saved
+        :param config_values: Dictionary from config_snapshot()
+        :param user_inputs: Dictionary of the user inputs of the run
+        :param outputs: Dictionary of output file paths
+        """
+        manifest = {
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_seconds": round(time.perf_counter() - self._start_wall, 4),
+            "cpu_seconds": round(time.process_time() - self._start_cpu, 4),
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "numpy": np.__version__,
+                "rasterio": rasterio.__version__,
+                "gdal": rasterio.__gdal_version__,
+            },
+            "user_inputs": user_inputs or {},
+            "inputs": self.inputs,
+            "config": config_values or {},
+            "stages": [record.to_dict() for record in self.stages],
+            "outputs": {name: path for name, path in (outputs or {}).items() if isinstance(path, str)},
+        }
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2, default=str)
+        print(f"Run manifest saved to {manifest_path}")
+
+
+class StageRecord:
+    """
+    A class holding the measurements of one stage
+    """
+    def __init__(self, name, callback=None):
+        """
+        Initializes the StageRecord object, the measurements are filled in when the stage ends.
+
+        :param name: Name of the stage, e.g. "risk"
+        :param callback: Optional progress function (stage name, fraction done) of the run
+        """
+        self.name = name
+        self.callback = callback
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_mb = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.rasters = {}
+
+    def progress(self, fraction):
+        """
+        Reports the fraction of the stage that is done to the progress callback of the run, if there is one.
+
+        :param fraction: Number between 0 and 1, e.g. the share of the windows that are computed
+        """
+        if self.callback is not None:
+            self.callback(self.name, fraction)
+
+    def add_raster(self, name, data=None, shape=None, dtype=None):
+        """
+        Records the shape and dtype of a raster handled in the stage, from an array or given directly.
+
+        :param name: Name of the raster, e.g. "risk"
+        :param data: numpy array, or None if shape and dtype are given
+        :param shape: Shape of the raster, used without data
+        :param dtype: dtype of the raster, used without data
+        """
+        if data is not None:
+            shape, dtype = data.shape, data.dtype
+        self.rasters[name] = {"shape": list(shape), "dtype": str(np.dtype(dtype))}
+
+    def to_dict(self):
+        """
+        Returns the measurements of the stage for the run manifest.
+
+        :return: Dictionary with the name, wall and CPU seconds, peak RSS, bytes read and written and the rasters
+        """
+        return {
+            "name": self.name,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "peak_rss_mb": self.peak_rss_mb,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "rasters": self.rasters,
+        }
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import numpy as np
+import rasterio
+from rasterio.coords import disjoint_bounds
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, bounds as window_bounds
+import config
+from instrumentation import file_sha256
+from raster import overview_factors
+
+# Side length of the tiles of the prepared land use raster in pixels
+TILE_SIZE = 256
+
+
+def prepared_path(source_path):
+    """
+    Returns the default path of the prepared copy of a land use raster, next to the source.
+    """
+    return f"{os.path.splitext(source_path)[0]}_tiled.tif"
+
+
+def index_path(raster_path):
+    """
+    Returns the path of the tile index of a prepared raster.
+    """
+    return f"{os.path.splitext(raster_path)[0]}.tiles.json"
+
+
+def prepare_land_use(source_path, output_path=None, tile_size=TILE_SIZE, compress="deflate", verify=True):
+    """
+    Converts a land use raster into an internally tiled, compressed GeoTIFF with categorical (mode) overviews, and
+    saves the tile index next to it. The source is read one row of tiles at a time, so the memory stays bounded.
+
+    :param source_path: Path to the land use raster, e.g. config.LAND_USE_PATH
+    :param output_path: Path of the prepared copy, defaults to prepared_path(source_path)
+    :param tile_size: Side length of the tiles in pixels
+    :param compress: GeoTIFF compression of the tiles
+    :param verify: If True, the prepared copy is compared with the source pixel by pixel (see verify_prepared())
+    :return: The path of the prepared copy
+    """
+    output_path = output_path or prepared_path(source_path)
+    tmp_path = f"{output_path}.tmp.tif"
+    tiles = []
+    try:
+        with rasterio.open(source_path) as src:
+            profile = src.profile
+            profile.update(driver="GTiff", tiled=True, blockxsize=tile_size, blockysize=tile_size, compress=compress,
+                           predictor=2, interleave="band")
+            with rasterio.open(tmp_path, "w", **profile) as dst:
+                for row_off in range(0, src.height, tile_size):
+                    strip = Window(0, row_off, src.width, min(tile_size, src.height - row_off))
+                    data = src.read(window=strip)
+                    dst.write(data, window=strip)
+                    for col_off in range(0, src.width, tile_size):
+                        tile = data[0, :, col_off:col_off + tile_size]
+                        window = Window(col_off, row_off, tile.shape[1], tile.shape[0])
+                        valid = tile != src.nodata if src.nodata is not None else np.ones(tile.shape, bool)
+                        tiles.append({
+                            "row": row_off // tile_size,
+                            "col": col_off // tile_size,
+                            "bounds": list(window_bounds(window, src.transform)),
+                            "valid_pixels": int(valid.sum()),
+                            "classes": np.unique(tile[valid]).tolist(),
+                        })
+
+                # Land use classes are categorical, each overview pixel takes the most frequent class below it
+                factors = overview_factors(src.shape, tile_size)
+                if factors:
+                    dst.build_overviews(factors, Resampling.mode)
+                    dst.update_tags(ns="rio_overview", resampling="mode")
+
+        if verify:
+            differences = verify_prepared(source_path, tmp_path, tile_size)
+            if differences:
+                raise ValueError(f"The prepared land use raster differs from {source_path} in {differences} pixel(s)")
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with rasterio.open(output_path) as prepared:
+        index = TileIndex(prepared.crs, prepared.transform, prepared.shape, tile_size, tiles, file_sha256(output_path))
+    index.save(index_path(output_path))
+    return output_path
+
+
+def verify_prepared(source_path, prepared_path, block_rows=TILE_SIZE):
+    """
+    Compares a prepared land use raster with its source at full resolution, one strip of rows at a time.
+
+    :param source_path: Path to the original land use raster
+    :param prepared_path: Path to the prepared copy
+    :param block_rows: Number of rows compared at a time
+    :return: Number of pixels with a different value (0 if the copy is exact)
+    """
+    with rasterio.open(source_path) as src, rasterio.open(prepared_path) as prepared:
+        for name in ("crs", "transform", "shape", "dtypes", "nodata", "count"):
+            if getattr(src, name) != getattr(prepared, name):
+                raise ValueError(f"The prepared land use raster has another {name} than {source_path}")
+
+        differences = 0
+        for row_off in range(0, src.height, block_rows):
+            strip = Window(0, row_off, src.width, min(block_rows, src.height - row_off))
+            differences += int(np.count_nonzero(src.read(window=strip) != prepared.read(window=strip)))
+    return differences
+
+
+class TileIndex:
+    """
+    A class for the spatial index of a prepared land use raster: the extent, number of valid pixels and land use
+    classes of every tile, so the tiles of a footprint are known without reading the raster
+    """
+    def __init__(self, crs, transform, shape, tile_size, tiles, raster_sha256):
+        """
+        Initializes the TileIndex object.
+
+        :param crs: CRS of the raster
+        :param transform: Affine transform of the raster
+        :param shape: Tuple (height, width) of the raster
+        :param tile_size: Side length of the tiles in pixels
+        :param tiles: List of dictionaries with the keys "row", "col", "bounds", "valid_pixels" and "classes"
+        :param raster_sha256: SHA-256 of the raster file, an index of another version of the file is not used
+        """
+        self.crs = crs
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.tile_size = tile_size
+        self.tiles = tiles
+        self.raster_sha256 = raster_sha256
+
+    def save(self, path):
+        """
+        Saves the index as JSON.
+        """
+        with open(path, "w") as f:
+            json.dump({
+                "crs": self.crs.to_wkt(),
+                "transform": list(self.transform)[:6],
+                "shape": list(self.shape),
+                "tile_size": self.tile_size,
+                "raster_sha256": self.raster_sha256,
+                "tiles": self.tiles,
+            }, f)
+
+    @classmethod
+    def load(cls, raster_path):
+        """
+        Loads the index of a prepared raster.
+
+        :param raster_path: Path to the prepared raster
+        :return: TileIndex object, or None if the raster has no index or the index belongs to another version of it
+        """
+        path = index_path(raster_path)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            index = json.load(f)
+        if index["raster_sha256"] != file_sha256(raster_path):
+            print(f"Tile index {path} is outdated and not used, prepare the land use raster again")
+            return None
+        return cls(CRS.from_wkt(index["crs"]), rasterio.Affine(*index["transform"]), index["shape"],
+                   index["tile_size"], index["tiles"], index["raster_sha256"])
+
+    def tiles_for_bounds(self, bounds, crs=None):
+        """
+        Returns the tiles that intersect a bounding box.
+
+        :param bounds: Bounding box as (left, bottom, right, top)
+        :param crs: CRS of the bounding box, defaults to the raster's CRS
+        :return: List of tile dictionaries
+        """
+        if crs is not None and crs != self.crs:
+            bounds = transform_bounds(crs, self.crs, *bounds)
+        return [tile for tile in self.tiles if not disjoint_bounds(bounds, tile["bounds"])]
+
+    def has_data(self, bounds, crs=None):
+        """
+        Checks whether a bounding box covers any valid land use pixel, only the index is used.
+        """
+        return any(tile["valid_pixels"] for tile in self.tiles_for_bounds(bounds, crs))
+
+    def classes(self, bounds, crs=None):
+        """
+        Returns the land use classes that occur in the tiles of a bounding box.
+        """
+        return sorted({code for tile in self.tiles_for_bounds(bounds, crs) for code in tile["classes"]})
+
+
+if __name__ == "__main__":
+    # Preparation command, e.g. `python land_use_tiles.py` and then set LAND_USE_PATH in config.py to the printed path
+    parser = argparse.ArgumentParser(description="Prepare a tiled, compressed land use raster with mode overviews and a tile index.")
+    parser.add_argument("source", nargs="?", default=config.LAND_USE_PATH, help="land use raster (default: LAND_USE_PATH of config.py)")
+    parser.add_argument("--output", default=None, help="path of the prepared raster (default: <source>_tiled.tif)")
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE, help="tile side length in pixels (default: %(default)s)")
+    parser.add_argument("--compress", default="deflate", help="GeoTIFF compression (default: %(default)s)")
+    parser.add_argument("--verify-only", action="store_true", help="only compare an existing prepared raster with the source")
+    parser.add_argument("--footprint", default=None, help="print the tiles and classes a raster (e.g. an inundation file) covers")
+    args = parser.parse_args()
+
+    output_path = args.output or prepared_path(args.source)
+    if args.verify_only:
+        differences = verify_prepared(args.source, output_path, args.tile_size)
+        print(f"{output_path}: {differences} pixel(s) differ from {args.source}")
+        parser.exit(1 if differences else 0)
+    if args.footprint:
+        index = TileIndex.load(output_path)
+        if index is None:
+            parser.exit(1, f"{output_path} has no tile index, prepare it first.\n")
+        with rasterio.open(args.footprint) as footprint:
+            tiles = index.tiles_for_bounds(footprint.bounds, footprint.crs)
+            print(f"{len(tiles)} of {len(index.tiles)} tiles, land use classes {index.classes(footprint.bounds, footprint.crs)}")
+        parser.exit(0)
+
+    prepare_land_use(args.source, output_path, args.tile_size, args.compress)
+    print(f"Prepared land use raster saved to {output_path} (verified pixel by pixel), set LAND_USE_PATH = \"{output_path}\" in config.py to use it")
@@ -1,11 +1,26 @@
-from raster import Raster
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from raster import Raster, ResampledGroup
+from damage import DamageModel
+from resample_cache import ResampleCache
+from stats import RiskStatistics
+from instrumentation import RunCancelled, RunRecorder, config_snapshot, cprofile_stage, file_sha256
+from artifact_store import ArtifactStore
+from zonal import run_zonal, zone_cache
+from hotspots import run_hotspots
+from land_use_tiles import TileIndex
 import numpy as np
 import config
+import glob
 import gui
 import os
+import time
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+import shutil
 from pdfdocument import PDFDocument
-from rasterio.coords import disjoint_bounds
 
 def create_summary_table(risk_data, inundation_data, land_use_data, output_path):
     """
@@ -16,15 +31,21 @@ def create_summary_table(risk_data, inundation_data, land_use_data, output_path)
     :param land_use_data: numpy array with land use raster data
     :param output_path: string where CSV will be saved
     """
-    summary = {
-        "Raster": ["Risk", "Inundation", "Land Use"],
-        "Mean": [np.nanmean(risk_data), np.nanmean(inundation_data), np.nanmean(land_use_data)],
-        "Median": [np.nanmedian(risk_data), np.nanmedian(inundation_data), np.nanmedian(land_use_data)],
-        "Standard Deviation": [np.nanstd(risk_data), np.nanstd(inundation_data), np.nanstd(land_use_data)],
-        "Minimum": [np.nanmin(risk_data), np.nanmin(inundation_data), np.nanmin(land_use_data)],
-        "Maximum": [np.nanmax(risk_data), np.nanmax(inundation_data), np.nanmax(land_use_data)],
-    }
-    summary_df = pd.DataFrame(summary)
+    statistics = RiskStatistics(no_data_value=None, relative_error=config.MEDIAN_RELATIVE_ERROR)
+    statistics.risk.update(risk_data)
+    statistics.inundation.update(inundation_data)
+    statistics.land_use.update(land_use_data)
+    save_summary_table(statistics, output_path)
+
+
+def save_summary_table(statistics, output_path):
+    """
+    Saves the summary table of statistics that were accumulated block by block as a CSV file.
+
+    :param statistics: RiskStatistics object
+    :param output_path: string where CSV will be saved
+    """
+    summary_df = statistics.summary_dataframe()
     summary_df.to_csv(output_path, index=False)
     print(f"Summary table saved to {output_path}")
 
@@ -38,127 +59,706 @@ def calculate_risk_by_land_use(risk_data, land_use_data, no_data_value, output_p
     :param no_data_value: number representing the no-data pixels, exclude from statistics
     :param output_path: string where CSV will be saved
     """
-    # Flatten arrays for analysis, make PD dataframe
-    risk_flat = risk_data.flatten()
-    land_use_flat = land_use_data.flatten()
-    df = pd.DataFrame({"Land Use": land_use_flat, "Risk": risk_flat})
+    statistics = RiskStatistics(no_data_value, relative_error=config.MEDIAN_RELATIVE_ERROR)
+    statistics.by_land_use.update(land_use_data, risk_data)
+    save_risk_by_land_use(statistics, output_path)
 
-    # Remove no-data values
-    df = df[df["Risk"] != no_data_value]
 
-    # Group by land-use type and calculate stats
-    risk_summary = df.groupby("Land Use")["Risk"].agg(["sum", "mean", "count"]).reset_index()
-    risk_summary.columns = ["Land Use Category", "Total Risk", "Average Risk", "Pixel Count"]
+def save_risk_by_land_use(statistics, output_path):
+    """
+    Saves the risk per land use category of statistics that were accumulated block by block as a CSV file.
 
-    # Save to file
+    :param statistics: RiskStatistics object
+    :param output_path: string where CSV will be saved
+    """
+    risk_summary = statistics.by_land_use.to_dataframe()
     risk_summary.to_csv(output_path, index=False)
     print(f"Risk breakdown by land use saved to {output_path}")
 
 
-def main():
+def compute_intensity(inundation_data, velocity_data=None):
     """
-    Executes the flood risk analysis workflow, following these steps:
-    1. Launches a GUI to collect user inputs.
-    2. Loads and processes raster datasets (flood depth, land use, and optionally velocity).
-    3. Resamples the land-use raster to match the flood depth raster resolution.
-    4. Computes flood risk using land use values and inundation characteristics.
-    5. Saves the computed risk raster as a GeoTIFF file.
-    6. Generates statistical summaries and CSV outputs for risk analysis.
-    7. Optionally generates a PDF report summarizing the results.
+    Computes the flood intensity: the inundation, multiplied with the velocity where the velocity is above
+    config.VELOCITY_THRESHOLD.
+
+    :param inundation_data: numpy array with inundation raster data
+    :param velocity_data: numpy array with velocity data on the inundation grid, or None
+    :return: numpy array with the flood intensity
+    """
+    if velocity_data is None:
+        return inundation_data
+
+    return np.where(
+        np.array(velocity_data) > config.VELOCITY_THRESHOLD,
+        inundation_data * velocity_data,
+        inundation_data
+    )
+
+
+def compute_risk(inundation_data, land_use_data, velocity_data, return_period, no_data_value, damage_model, land_use_nodata=None):
+    """
+    Computes the flood risk for aligned inundation, land use and (optional) velocity arrays. The arrays can be the
+    whole raster or a single window of it, every pixel is computed independently.
+
+    :param inundation_data: numpy array with inundation raster data
+    :param land_use_data: numpy array with land use classes on the inundation grid
+    :param velocity_data: numpy array with velocity data on the inundation grid, or None
+    :param return_period: the flood return period
+    :param no_data_value: number written to pixels without risk
+    :param damage_model: DamageModel compiled from the land use map
+    :param land_use_nodata: no-data value of the land use raster, these pixels get no damage
+    :return: tuple of numpy arrays (risk, land use values)
+    """
+    # Handle the optional velocity raster, only if it was inputted
+    velocity_inundation_product = compute_intensity(inundation_data, velocity_data)
+
+    # Calculation of the value (of the pixelated property) and the damage with the compiled lookup table
+    land_use_values, damage = damage_model.evaluate(land_use_data, velocity_inundation_product, land_use_nodata)
+    risk_cleaned = damage_to_risk(damage, return_period, no_data_value)
+
+    return risk_cleaned, land_use_values
+
+
+def damage_to_risk(damage, return_period, no_data_value, valid=None):
+    """
+    Scales the damage with the probability of the flood. Without a validity mask pixels with zero risk get the
+    no_data_value like in compute_risk(), with a mask only the invalid pixels do, like in compute_risk_compact().
+
+    :param damage: numpy array with the damage of each pixel
+    :param return_period: the flood return period
+    :param no_data_value: number written to pixels without risk
+    :param valid: Optional boolean mask of the valid pixels, the risk is then float32
+    :return: numpy array with the risk
+    """
+    if valid is None:
+        risk = damage * (1 / return_period)
+        return np.where(risk == 0, no_data_value, risk)
+
+    risk = np.multiply(damage, np.float32(1 / return_period), dtype=np.float32)
+    np.copyto(risk, no_data_value, where=~valid)
+    return risk
+
+
+def compute_risk_compact(inundation_data, land_use_data, velocity_data, return_period, no_data_value, damage_model,
+                         land_use_nodata=None, inundation_nodata=None, velocity_nodata=None, buffers=None):
+    """
+    Computes the flood risk like compute_risk(), with compact dtypes: the hazard is computed as float32 and the land use
+    values keep a single byte (see DamageModel.evaluate_compact), all arithmetic happens in place in preallocated
+    buffers. Pixels are valid if the inundation and land use are not no-data, only invalid pixels get no_data_value,
+    so a valid pixel with zero risk stays 0.
+
+    :param inundation_data: numpy array with inundation raster data
+    :param land_use_data: numpy array with land use classes on the inundation grid
+    :param velocity_data: numpy array with velocity data on the inundation grid, or None
+    :param return_period: the flood return period
+    :param no_data_value: number written to invalid pixels
+    :param damage_model: DamageModel compiled from the land use map
+    :param land_use_nodata: no-data value of the land use raster
+    :param inundation_nodata: no-data value of the inundation raster, NaN is always no-data
+    :param velocity_nodata: no-data value of the velocity raster, the velocity is not applied on these pixels
+    :param buffers: Optional dictionary that keeps the buffers between calls (e.g. for every block of a stream), the
+        returned arrays are overwritten by the next call with the same shape
+    :return: tuple of numpy arrays (risk as float32, land use values, validity mask)
+    """
+    buffers = {} if buffers is None else buffers
+    shape = inundation_data.shape
+    if shape not in buffers:
+        buffers[shape] = (
+            np.empty(shape, dtype=np.float32), np.empty(shape, dtype=damage_model.compact_values.dtype),
+            np.empty(shape, dtype=bool), np.empty(shape, dtype=bool)
+        )
+    risk, land_use_values, valid, scratch = buffers[shape]
+    compute_intensity_compact(
+        inundation_data, land_use_data, velocity_data, land_use_nodata, inundation_nodata, velocity_nodata, risk, valid,
+        scratch
+    )
+
+    land_use_values, risk = damage_model.evaluate_compact(land_use_data, risk, land_use_nodata, land_use_values)
+    risk *= np.float32(1 / return_period)
+
+    np.copyto(risk, no_data_value, where=np.logical_not(valid, out=scratch))
+    return risk, land_use_values, valid
+
+
+def compute_intensity_compact(inundation_data, land_use_data, velocity_data, land_use_nodata, inundation_nodata,
+                              velocity_nodata, intensity, valid, scratch):
+    """
+    Computes the validity mask and the float32 flood intensity of compute_risk_compact() into the given arrays.
+
+    :param intensity: float32 array for the flood intensity, same shape as the inputs
+    :param valid: bool array for the validity mask
+    :param scratch: bool array used as temporary buffer
+    :return: tuple of the intensity and validity mask arrays
+    """
+    # Validity mask, computed once from the no-data values of the inputs
+    np.isfinite(inundation_data, out=valid)
+    if inundation_nodata is not None:
+        valid &= np.not_equal(inundation_data, inundation_nodata, out=scratch)
+    if land_use_nodata is not None:
+        valid &= np.not_equal(land_use_data, land_use_nodata, out=scratch)
+
+    # Flood intensity, the velocity is only applied above the threshold (NaN and no-data velocities are below it)
+    np.copyto(intensity, inundation_data, casting="same_kind")
+    if velocity_data is not None:
+        np.greater(velocity_data, config.VELOCITY_THRESHOLD, out=scratch)
+        if velocity_nodata is not None and velocity_nodata > config.VELOCITY_THRESHOLD:
+            scratch &= velocity_data != velocity_nodata
+        np.multiply(intensity, velocity_data, out=intensity, where=scratch, casting="same_kind")
+    return intensity, valid
+
+
+def open_warped_inputs(inundation_raster, land_use_source, velocity_file, land_use_grid=None):
+    """
+    Groups the rasters that have to be warped onto the inundation grid, so they are resampled together in one pass.
+    Each input gets its own resampling method from config: land use classes are categorical and must not be
+    interpolated, velocity is continuous.
+
+    :param inundation_raster: Raster object of the inundation file (target grid)
+    :param land_use_source: Path to the land use raster, or an open rasterio dataset of it
+    :param velocity_file: Path to the velocity raster, or None
+    :param land_use_grid: Land use already on the inundation grid (from the resample cache), then it is not warped again
+    :return: ResampledGroup with the sources "land_use" and/or "velocity", to be used as a context manager
+    """
+    sources = {}
+    if land_use_grid is None:
+        sources["land_use"] = (land_use_source, Resampling[config.LAND_USE_RESAMPLING])
+    if velocity_file:
+        sources["velocity"] = (velocity_file, Resampling[config.VELOCITY_RESAMPLING])
+    return ResampledGroup(inundation_raster, sources, config.WARP_THREADS, config.WARP_MEMORY_LIMIT_MB)
+
+
+def stream_risk(inundation_raster, land_use_source, velocity_file, return_period, no_data_value, output_path, damage_model,
+                block_size=0, land_use_grid=None, statistics=None, compact=False, progress=None):
+    """
+    Computes the risk raster window by window and writes every block straight into the output file. Only the
+    matching window of the land use and velocity rasters is resampled, so peak memory depends on the block size and
+    not on the raster size. The output is identical to the in-memory computation.
+
+    :param inundation_raster: Raster object of the inundation file, the data does not need to be loaded
+    :param land_use_source: Path to the land use raster, or an open rasterio dataset of it
+    :param velocity_file: Path to the velocity raster, or None
+    :param return_period: the flood return period
+    :param no_data_value: number written to pixels without risk
+    :param output_path: string where the risk GeoTIFF will be saved
+    :param damage_model: DamageModel compiled from the land use map
+    :param block_size: Side length in pixels of the windows, 0 uses the internal blocks of the inundation raster
+    :param land_use_grid: Optional land use array already on the inundation grid (e.g. memory-mapped from the
+        resample cache), it is sliced window by window instead of warping the land use raster
+    :param statistics: Optional RiskStatistics object, updated with every block so no raster has to be read back
+    :param compact: Computes the risk with compute_risk_compact() instead of compute_risk(), the buffers are reused
+        for every block
+    :param progress: Optional function called with the fraction of the windows that are done after every block
+    """
+    with ExitStack() as stack:
+        # Open the warped land use and velocity datasets once, and only read the window for every block
+        inundation_src = stack.enter_context(rasterio.open(inundation_raster.file_path))
+        land_use_nodata = land_use_source.nodata if hasattr(land_use_source, "nodata") else Raster(land_use_source).nodata
+        velocity_nodata = Raster(velocity_file).nodata if velocity_file else None
+        buffers = {}
+        warped_inputs = stack.enter_context(open_warped_inputs(inundation_raster, land_use_source, velocity_file, land_use_grid))
+
+        dst = None
+        windows = list(inundation_raster.iter_windows(block_size))
+        for done, window in enumerate(windows, start=1):
+            inundation_block = inundation_src.read(1, window=window)
+            warped_blocks = warped_inputs.read(window)
+            if land_use_grid is not None:
+                land_use_block = land_use_grid[window.toslices()]
+            else:
+                land_use_block = warped_blocks["land_use"]
+            velocity_block = warped_blocks.get("velocity")
+
+            valid = None
+            if compact:
+                risk_block, land_use_values, valid = compute_risk_compact(
+                    inundation_block, land_use_block, velocity_block, return_period, no_data_value, damage_model,
+                    land_use_nodata, inundation_src.nodata, velocity_nodata, buffers
+                )
+            else:
+                risk_block, land_use_values = compute_risk(
+                    inundation_block, land_use_block, velocity_block, return_period, no_data_value, damage_model, land_use_nodata
+                )
+            if statistics is not None:
+                statistics.update(risk_block, inundation_block, land_use_values, valid)
+
+            # The output dtype is only known after the first block has been computed
+            if dst is None:
+                dst = stack.enter_context(inundation_raster.open_writer(output_path, risk_block.dtype, no_data_value, config.OUTPUT_PROFILE))
+            dst.write(risk_block, 1, window=window)
+            if progress is not None:
+                progress(done / len(windows))
+
+
+def compute_risk_incremental(inundation_raster, land_use_source, land_use_path, velocity_file, return_period,
+                             no_data_value, output_paths, damage_model, artifact_store, block_size=None,
+                             resample_cache=None, compact=False, recorder=None):
+    """
+    Computes the risk raster and the CSV statistics in cacheable stages, each stored in the artifact store under a
+    hash of its inputs and parameters, and only recomputes the stages whose inputs changed:
+    1. aligned: inundation, land use and velocity on the inundation grid (input files, resampling methods)
+    2. intensity: flood intensity (aligned inputs, VELOCITY_THRESHOLD)
+    3. damage: land use values and damage (intensity, land use map and depth-damage curves)
+    4. risk: the risk GeoTIFF (damage, return period, no-data value, output profile)
+    5. stats: summary_table.csv and land_use_risk.csv (damage, return period, no-data value, median error)
+    A new return period only rescales the stored damage, a new land use value only repeats the lookup. Every stage
+    walks the rasters window by window, the stored arrays are memory-mapped.
+
+    :param inundation_raster: Raster object of the inundation file, the data does not need to be loaded
+    :param land_use_source: Path to the land use raster, or an open rasterio dataset of it
+    :param land_use_path: Path to the land use raster file, for its hash
+    :param velocity_file: Path to the velocity raster, or None
+    :param return_period: the flood return period
+    :param no_data_value: number written to pixels without risk
+    :param output_paths: Dictionary with the paths "risk", "summary" and "land_use_risk"
+    :param damage_model: DamageModel compiled from the land use map
+    :param artifact_store: ArtifactStore holding the stage outputs
+    :param block_size: Side length in pixels of the windows, 0 uses the internal blocks, None a single window
+    :param resample_cache: Optional ResampleCache, used for the land use when the aligned inputs are not stored
+    :param compact: Computes the stages like compute_risk_compact() instead of compute_risk()
+    :param recorder: Optional RunRecorder, every recomputed stage is recorded
+    """
+    store = artifact_store
+    store.begin_run()
+    recorder = recorder or RunRecorder(os.path.dirname(output_paths["risk"]))
+    land_use_nodata = land_use_source.nodata if hasattr(land_use_source, "nodata") else Raster(land_use_source).nodata
+    velocity_nodata = Raster(velocity_file).nodata if velocity_file else None
+    shape = inundation_raster.shape
+
+    # Every key includes the key of the stage it is computed from
+    aligned_key = store.key(
+        "aligned", inundation=file_sha256(inundation_raster.file_path), land_use=file_sha256(land_use_path),
+        velocity=file_sha256(velocity_file) if velocity_file else None,
+        land_use_resampling=config.LAND_USE_RESAMPLING, velocity_resampling=config.VELOCITY_RESAMPLING
+    )
+    intensity_key = store.key("intensity", aligned=aligned_key, velocity_threshold=config.VELOCITY_THRESHOLD, compact=compact)
+    damage_key = store.key("damage", intensity=intensity_key, damage_model=damage_model.fingerprint(), land_use_nodata=land_use_nodata)
+    risk_key = store.key(
+        "risk", damage=damage_key, return_period=return_period, no_data_value=no_data_value, output_profile=config.OUTPUT_PROFILE
+    )
+    stats_key = store.key(
+        "stats", damage=damage_key, return_period=return_period, no_data_value=no_data_value,
+        relative_error=config.MEDIAN_RELATIVE_ERROR
+    )
+
+    risk_artifact, stats_artifact = store.get(risk_key), store.get(stats_key)
+    if risk_artifact:
+        shutil.copyfile(risk_artifact["risk_output.tif"], output_paths["risk"])
+    if stats_artifact:
+        shutil.copyfile(stats_artifact["summary_table.csv"], output_paths["summary"])
+        shutil.copyfile(stats_artifact["land_use_risk.csv"], output_paths["land_use_risk"])
+        print(f"Summary table saved to {output_paths['summary']}")
+        print(f"Risk breakdown by land use saved to {output_paths['land_use_risk']}")
+    if risk_artifact and stats_artifact:
+        print(store.report())
+        return
+
+    windows = [Window(0, 0, shape[1], shape[0])] if block_size is None else list(inundation_raster.iter_windows(block_size))
+    damage = store.get(damage_key)
+    if damage is None:
+        aligned = store.get(aligned_key)
+        if aligned is None:
+            with recorder.stage("aligned") as stage, store.put(aligned_key) as writer, ExitStack() as stack:
+                land_use_grid = None
+                if resample_cache:
+                    land_use_grid = resample_cache.fetch(
+                        inundation_raster, land_use_path, Resampling[config.LAND_USE_RESAMPLING], block_size or 0,
+                        config.WARP_THREADS, config.WARP_MEMORY_LIMIT_MB, source_dataset=land_use_source
+                    )
+                inundation_src = stack.enter_context(rasterio.open(inundation_raster.file_path))
+                warped_inputs = stack.enter_context(open_warped_inputs(inundation_raster, land_use_source, velocity_file, land_use_grid))
+                for done, window in enumerate(windows, start=1):
+                    blocks = warped_inputs.read(window)
+                    blocks["inundation"] = inundation_src.read(1, window=window)
+                    if land_use_grid is not None:
+                        blocks["land_use"] = land_use_grid[window.toslices()]
+                    for name, block in blocks.items():
+                        writer.write_block(name, shape, window, block)
+                    stage.progress(done / len(windows))
+            aligned = store.load(aligned_key)
+
+        intensity = store.get(intensity_key)
+        if intensity is None:
+            with recorder.stage("intensity") as stage, store.put(intensity_key) as writer:
+                for done, window in enumerate(windows, start=1):
+                    slices = window.toslices()
+                    velocity_block = aligned["velocity"][slices] if "velocity" in aligned else None
+                    if compact:
+                        block_shape = (window.height, window.width)
+                        intensity_block, valid_block = compute_intensity_compact(
+                            aligned["inundation"][slices], aligned["land_use"][slices], velocity_block, land_use_nodata,
+                            inundation_raster.nodata, velocity_nodata, np.empty(block_shape, dtype=np.float32),
+                            np.empty(block_shape, dtype=bool), np.empty(block_shape, dtype=bool)
+                        )
+                        writer.write_block("valid", shape, window, valid_block)
+                    else:
+                        intensity_block = compute_intensity(aligned["inundation"][slices], velocity_block)
+                    writer.write_block("intensity", shape, window, intensity_block)
+                    stage.progress(done / len(windows))
+            intensity = store.load(intensity_key)
+
+        with recorder.stage("damage") as stage, store.put(damage_key) as writer:
+            for done, window in enumerate(windows, start=1):
+                slices = window.toslices()
+                if compact:
+                    land_use_values, damage_block = damage_model.evaluate_compact(
+                        aligned["land_use"][slices], np.array(intensity["intensity"][slices]), land_use_nodata
+                    )
+                    writer.write_block("valid", shape, window, intensity["valid"][slices])
+                else:
+                    land_use_values, damage_block = damage_model.evaluate(
+                        aligned["land_use"][slices], intensity["intensity"][slices], land_use_nodata
+                    )
+                writer.write_block("land_use_values", shape, window, land_use_values)
+                writer.write_block("damage", shape, window, damage_block)
+                stage.progress(done / len(windows))
+        damage = store.load(damage_key)
+
+    # The risk is only a rescaled damage, it is computed on the fly for the GeoTIFF and the statistics
+    statistics = None if stats_artifact else RiskStatistics(no_data_value, relative_error=config.MEDIAN_RELATIVE_ERROR)
+    with recorder.stage("risk") as stage, ExitStack() as stack:
+        inundation_src = stack.enter_context(rasterio.open(inundation_raster.file_path))
+        dst = None
+        for done, window in enumerate(windows, start=1):
+            slices = window.toslices()
+            valid = damage["valid"][slices] if "valid" in damage else None
+            risk_block = damage_to_risk(damage["damage"][slices], return_period, no_data_value, valid)
+            if statistics is not None:
+                statistics.update(risk_block, inundation_src.read(1, window=window), damage["land_use_values"][slices], valid)
+            if not risk_artifact:
+                if dst is None:
+                    dst = stack.enter_context(inundation_raster.open_writer(output_paths["risk"], risk_block.dtype, no_data_value, config.OUTPUT_PROFILE))
+                dst.write(risk_block, 1, window=window)
+            stage.progress(done / len(windows))
+
+    if not risk_artifact:
+        with store.put(risk_key) as writer:
+            writer.file("risk_output.tif", output_paths["risk"])
+    if statistics is not None:
+        with recorder.stage("csv"), store.put(stats_key) as writer:
+            save_summary_table(statistics, output_paths["summary"])
+            save_risk_by_land_use(statistics, output_paths["land_use_risk"])
+            writer.file("summary_table.csv", output_paths["summary"])
+            writer.file("land_use_risk.csv", output_paths["land_use_risk"])
+    print(store.report())
+
+
+def load_resources(land_use_in_memory=False):
+    """
+    Loads everything that does not depend on the scenario: the land use source, the compiled damage model and the
+    resample cache. A single run loads them itself, batch workers load them once and reuse them for every scenario.
+
+    :param land_use_in_memory: If True, the land use raster is read once into an in-memory dataset that every
+        later warp uses, instead of reading the file again for each run
+    :return: Dictionary with the keys "land_use_path", "land_use_source", "land_use_raster", "land_use_index",
+        "damage_model", "resample_cache" and "artifact_store"
+    """
+    land_use_path = config.LAND_USE_PATH
+    land_use_source = land_use_path
+    if land_use_in_memory:
+        with rasterio.open(land_use_path) as src:
+            profile = src.profile
+            profile.update(driver="GTiff", compress=None)
+            memfile = MemoryFile()
+            with memfile.open(**profile) as dst:
+                dst.write(src.read())
+        land_use_source = memfile.open()
+
+    return {
+        "land_use_path": land_use_path,
+        "land_use_source": land_use_source,
+        "land_use_raster": Raster(land_use_path),
+        "land_use_index": TileIndex.load(land_use_path),  # Only prepared land use rasters have one
+        "damage_model": DamageModel(config.LAND_USE_MAP, config.DEPTH_DAMAGE_CURVES),
+        "resample_cache": ResampleCache(config.RESAMPLE_CACHE_DIR, config.RESAMPLE_CACHE_SIZE_MB) if config.RESAMPLE_CACHE_DIR else None,
+        "artifact_store": ArtifactStore(config.ARTIFACT_STORE_DIR, config.ARTIFACT_STORE_SIZE_MB) if config.ARTIFACT_STORE_DIR else None,
+    }
+
+
+def generate_report(raster_path, pdf_output_path):
+    """
+    Renders the PDF report of a risk raster. This is a module-level function, so it can run in a background process.
+
+    :param raster_path: Path to the risk GeoTIFF
+    :param pdf_output_path: string where the PDF will be saved
+    :return: The path of the PDF
+    """
+    pdf = PDFDocument(pdf_output_path, title="Flood Risk Summary", author="Automated System", dpi=config.PDF_DPI)
+    pdf.generate_from_raster(raster_path)
+    print(f"PDF saved to {pdf_output_path}")
+    return pdf_output_path
+
+
+def run_analysis(user_inputs, resources=None, report_executor=None, progress=None):
+    """
+    Runs the flood risk analysis for one scenario without the GUI, following these steps:
+    1. Loads and processes raster datasets (flood depth, land use, and optionally velocity).
+    2. Resamples the land-use raster to match the flood depth raster resolution.
+    3. Computes flood risk using land use values and inundation characteristics.
+    4. Saves the computed risk raster as a GeoTIFF file.
+    5. Generates statistical summaries and CSV outputs for risk analysis, also per zone of config.ZONE_LAYERS.
+    6. Optionally generates a PDF report summarizing the results, in the background if an executor is given.
+    7. Saves run_manifest.json with the timings, memory and I/O of every stage, the input hashes and the settings.
+
+    :param user_inputs: Dictionary of user-defined parameters, same keys as returned by gui.launch_gui()
+        (plus the optional "block_size")
+    :param resources: Dictionary from load_resources(), loaded here if not provided
+    :param report_executor: Optional concurrent.futures executor, the PDF report is submitted to it instead of being
+        generated before returning
+    :param progress: Optional function (stage name, fraction done) called at the start and end of every stage and
+        after every block of the streamed stages. If it raises RunCancelled, the files this run has written to the
+        output directory are removed and RunCancelled is raised again.
+    :return: Dictionary of output file paths, plus the "pdf_job" future of a report that is generated in the background
+    """
+    started = time.time()
+    output_dir = user_inputs["output_dir"]
+    # Every stage is timed and measured for the run manifest, FLOOD_RISK_PROFILER overrides config.PROFILER
+    recorder = RunRecorder(
+        output_dir, profiler=os.environ.get("FLOOD_RISK_PROFILER", config.PROFILER), profile_stages=config.PROFILE_STAGES,
+        progress=progress
+    )
+    # Filled by the stages before they write a file, so a cancelled run knows which files are its own
+    outputs = {}
+    try:
+        return _run_analysis(user_inputs, resources, report_executor, recorder, outputs)
+    except RunCancelled:
+        run_paths = [path for path in outputs.values() if isinstance(path, str)]
+        if recorder.profiler is cprofile_stage:
+            run_paths += [os.path.join(output_dir, f"profile_{name}.prof") for name in recorder.profiled_stages]
+        remove_run_outputs(run_paths, started)
+        raise
+
+
+def remove_run_outputs(paths, since):
+    """
+    Removes the files a run has written, so a cancelled run does not leave partial outputs. Only the given paths and
+    their side files (e.g. risk_output.tif.tmp.tif or .aux.xml) are removed, so the files of other runs writing to the
+    same directory at the same time are kept, as are files of earlier runs that were not overwritten yet.
+
+    :param paths: Paths of the output files of the run
+    :param since: Start time of the run (time.time()), only files modified since then are removed
     """
-    #### BEGIN SECTION OF GUI
-    # Launch GUI and get user inputs
-    user_inputs = gui.launch_gui()
+    for output_path in paths:
+        for path in glob.glob(glob.escape(output_path) + "*"):
+            if os.path.getmtime(path) >= since - 1:  # Tolerance for file systems with coarse timestamps
+                os.remove(path)
 
+
+def _run_analysis(user_inputs, resources, report_executor, recorder, outputs):
+    """
+    Runs the stages of run_analysis(), recording them with the RunRecorder and adding the output paths to the outputs
+    dictionary before the files are written.
+    """
     # Extract inputs
     return_period = user_inputs["return_period"]
     no_data_value = user_inputs["no_data_value"]
     flood_depth_file = user_inputs["flood_depth_file"]
     velocity_file = user_inputs.get("velocity_file")  # Optional, defaults to None if not provided
     output_dir = user_inputs["output_dir"]
+    block_size = user_inputs.get("block_size", config.BLOCK_SIZE)  # None keeps the whole raster in memory
 
-    #### END SECTION OF GUI
     #### BEGIN SECTION OF RASTER CLASS INIT, TRANSFORM, RESAMPLE
 
-    # File path and values for land use map
-    land_use_path = config.LAND_USE_PATH
-    land_use_map = config.LAND_USE_MAP
+    # Land use source, the land use values compiled into a lookup table and the resample cache
+    if resources is None:
+        with recorder.stage("load_resources"):
+            resources = load_resources()
+    land_use_path = resources["land_use_path"]
+    land_use_source = resources["land_use_source"]
+    land_use_raster = resources["land_use_raster"]
+    damage_model = resources["damage_model"]
+    resample_cache = resources["resample_cache"]
+    artifact_store = resources.get("artifact_store")
 
-    # Instantiate Raster objects
+    # Instantiate Raster objects, only the metadata is read until the pixel values are needed
+    streaming = block_size is not None
     inundation_raster = Raster(flood_depth_file)
-    land_use_raster = Raster(land_use_path)
     velocity_raster = Raster(velocity_file) if velocity_file else None
 
-    # Resample land-use raster to match inundation raster
-    resampled_land_use = inundation_raster.resample_raster(land_use_path)
+    # The land use raster only covers Baden-Württemberg, check the extent before anything is resampled
+    if not inundation_raster.overlaps(land_use_raster):
+        raise ValueError("Inundation raster is outside of the land use raster, or there is a coordinate system issue.")
+    land_use_index = resources.get("land_use_index")
+    if land_use_index is not None and not land_use_index.has_data(inundation_raster.bounds, inundation_raster.crs):
+        raise ValueError("Inundation raster only covers no-data areas of the land use raster (outside of Baden-Württemberg).")
 
-    # Resample the velocity raster if its provided, also check that velocity and inundation overlap geographically
+    # Check that velocity and inundation overlap geographically if velocity is provided
     # if they do not, then raise error. A wrong file was uploaded (ie Biberach inundation with Tübingen velocity)
     if velocity_raster:
-        if disjoint_bounds(velocity_raster.bounds, inundation_raster.bounds):
+        if not inundation_raster.overlaps(velocity_raster):
             raise ValueError("Velocity raster and inundation raster do not overlap geographically, or there is a coordinate system issue.")
-        velocity_raster_resampled = inundation_raster.resample_raster(velocity_file)
 
-    # Update the land_use_raster object with the resampled data
-    land_use_raster.data = resampled_land_use
-    land_use_raster.transform = inundation_raster.transform
-    land_use_raster.bounds = inundation_raster.bounds
+    # Concatenates the user-defined output path with the output tif
+    output_path = os.path.join(output_dir, "risk_output.tif")
+    summary_csv_path = os.path.join(output_dir, "summary_table.csv")
+    land_use_risk_csv_path = os.path.join(output_dir, "land_use_risk.csv")
+    outputs.update({"risk": output_path, "summary": summary_csv_path, "land_use_risk": land_use_risk_csv_path})
+
+    # Hashes of the inputs, so the manifest tells which files a result was computed from
+    with recorder.stage("hash_inputs"):
+        recorder.add_input("flood_depth_file", flood_depth_file)
+        recorder.add_input("velocity_file", velocity_file)
+        recorder.add_input("land_use_file", land_use_path)
+
+    # Repeat runs on the same grid memory-map the resampled land use from the cache instead of reprojecting it (with
+    # the artifact store, only when the aligned inputs have to be computed again)
+    land_use_grid = None
+    if resample_cache and artifact_store is None:
+        with recorder.stage("resample_cache") as stage:
+            land_use_grid = resample_cache.fetch(
+                inundation_raster, land_use_path, Resampling[config.LAND_USE_RESAMPLING], block_size or 0,
+                config.WARP_THREADS, config.WARP_MEMORY_LIMIT_MB, source_dataset=land_use_source
+            )
+            stage.add_raster("land_use", land_use_grid)
+        print(resample_cache.report())
 
     #### END SECTION OF RASTER CLASS INIT, TRANSFORM, RESAMPLE
     #### BEGIN SECTION OF RISK CALCULATION
 
-    # Calculation of the value (of the pixelated property)
-    land_use_values = np.vectorize(land_use_map.get)(resampled_land_use.data)
+    # Statistics are accumulated while the risk is computed, in a single pass over the data
+    statistics = RiskStatistics(no_data_value, relative_error=config.MEDIAN_RELATIVE_ERROR)
 
-    # Handle the optional velocity raster, only if it was inputted
-    if velocity_raster:
-        velocity_inundation_product = np.where(
-            np.array(velocity_raster_resampled.data) > config.VELOCITY_THRESHOLD,
-            inundation_raster.data * velocity_raster_resampled.data,
-            inundation_raster.data
+    if artifact_store is not None:
+        # Only the stages whose inputs changed since an earlier run are computed, this also writes the CSV files
+        compute_risk_incremental(
+            inundation_raster, land_use_source, land_use_path, velocity_file, return_period, no_data_value,
+            {"risk": output_path, "summary": summary_csv_path, "land_use_risk": land_use_risk_csv_path}, damage_model,
+            artifact_store, block_size, resample_cache, config.COMPACT_PIPELINE, recorder
         )
+        statistics = None
+    elif streaming:
+        # Land use and velocity are resampled window by window, and each risk block is written to the output
+        with recorder.stage("stream_risk") as stage:
+            stream_risk(
+                inundation_raster, land_use_source, velocity_file, return_period, no_data_value, output_path,
+                damage_model, block_size, land_use_grid, statistics, config.COMPACT_PIPELINE, stage.progress
+            )
+            with rasterio.open(output_path) as src:
+                stage.add_raster("risk", shape=src.shape, dtype=src.dtypes[0])
     else:
-        velocity_inundation_product = inundation_raster.data
+        # Resample land-use raster (and velocity raster if provided) to match inundation raster, in one pass
+        with recorder.stage("load") as stage:
+            inundation_data = inundation_raster.data
+            stage.add_raster("inundation", inundation_data)
 
-    # Calculation of the damage and risk
-    damage = land_use_values * velocity_inundation_product
-    risk = damage * (1 / return_period)
+        with recorder.stage("reproject") as stage:
+            with open_warped_inputs(inundation_raster, land_use_source, velocity_file, land_use_grid) as warped_inputs:
+                resampled = warped_inputs.read()
+            resampled_land_use = land_use_grid if land_use_grid is not None else resampled["land_use"]
+            velocity_raster_resampled = resampled.get("velocity")
+            stage.add_raster("land_use", resampled_land_use)
+            if velocity_raster_resampled is not None:
+                stage.add_raster("velocity", velocity_raster_resampled)
 
-    # Replace 0s in risk array with the no_data_value
-    risk_cleaned = np.where(risk == 0, no_data_value, risk)
+        with recorder.stage("risk") as stage:
+            valid = None
+            if config.COMPACT_PIPELINE:
+                risk_cleaned, land_use_values, valid = compute_risk_compact(
+                    inundation_data, resampled_land_use, velocity_raster_resampled, return_period, no_data_value,
+                    damage_model, land_use_raster.nodata, inundation_raster.nodata,
+                    velocity_raster.nodata if velocity_raster else None
+                )
+            else:
+                risk_cleaned, land_use_values = compute_risk(
+                    inundation_data, resampled_land_use, velocity_raster_resampled, return_period, no_data_value,
+                    damage_model, land_use_raster.nodata
+                )
+            stage.add_raster("risk", risk_cleaned)
+            stage.add_raster("land_use_values", land_use_values)
 
-    # Creates new empty risk raster and then fills it with calculated risk data, so it can be saved
-    risk_raster = Raster(file_path=None)
-    risk_raster.data = risk_cleaned
-    risk_raster.transform = inundation_raster.transform
-    risk_raster.crs = inundation_raster.crs
-    risk_raster.bounds = inundation_raster.bounds
+        with recorder.stage("statistics"):
+            statistics.update(risk_cleaned, inundation_data, land_use_values, valid)
+
+        # Creates new empty risk raster and then fills it with calculated risk data, so it can be saved
+        risk_raster = Raster(file_path=None)
+        risk_raster.data = risk_cleaned
+        risk_raster.transform = inundation_raster.transform
+        risk_raster.crs = inundation_raster.crs
+        risk_raster.bounds = inundation_raster.bounds
+
+        with recorder.stage("save"):
+            risk_raster.save_raster(output_path, risk_raster.data, no_data_value=no_data_value, profile=config.OUTPUT_PROFILE)
 
-    # Concatenates the user-defined output path with the output tif and then saves it
-    output_path = os.path.join(output_dir, "risk_output.tif")
-    risk_raster.save_raster(output_path, risk_raster.data, no_data_value=no_data_value)
     print(f"Risk raster saved to {output_path}")
-    print(f"Risk raster CRS: {risk_raster.crs}")
+    print(f"Risk raster CRS: {inundation_raster.crs}")
+    if damage_model.unknown_codes:
+        print(f"Land use classes not in LAND_USE_MAP (damage set to 0): {sorted(damage_model.unknown_codes)}")
 
     #### END SECTION OF RISK CALCULATION
     #### BEGIN SECTION OF STATISTICS SUMMARY, PDF GENERATION
 
-    # Generates PDF
+    if statistics is not None:
+        with recorder.stage("csv"):
+            save_summary_table(statistics, summary_csv_path)
+            save_risk_by_land_use(statistics, land_use_risk_csv_path)
+
+    # Risk per municipality, district, parcel... of the configured zone layers, rasterized once per grid
+    if config.ZONE_LAYERS:
+        with recorder.stage("zonal"):
+            outputs.update(run_zonal(
+                output_path, config.ZONE_LAYERS, output_dir, land_use_grid if land_use_grid is not None else land_use_source,
+                block_size or 0, zone_cache(), land_use_raster.nodata
+            ))
+
+    # Connected areas of high risk, ranked by their total risk
+    if config.HOTSPOT_THRESHOLD is not None:
+        with recorder.stage("hotspots"):
+            outputs.update(run_hotspots(
+                output_path, output_dir, land_use=land_use_grid if land_use_grid is not None else land_use_source,
+                land_use_nodata=land_use_raster.nodata, block_size=block_size
+            ))
+
+    # Generates PDF, last so the raster and CSV files can already be used while the report is rendered
     if user_inputs.get("generate_pdf"):
-        print("Generating PDF...")
         pdf_output_path = os.path.join(output_dir, "FloodRiskAnalysis.pdf")
-        pdf = PDFDocument(pdf_output_path, title="Flood Risk Summary", author="Automated System")
-        pdf.generate_from_raster(output_path, output_dir)
-        print(f"PDF saved to {pdf_output_path}")
+        outputs["pdf"] = pdf_output_path
+        if report_executor is None:
+            print("Generating PDF...")
+            with recorder.stage("pdf"):
+                generate_report(output_path, pdf_output_path)
+        else:
+            print("Generating PDF in the background...")
+            outputs["pdf_job"] = report_executor.submit(generate_report, output_path, pdf_output_path)
 
-    summary_csv_path = os.path.join(output_dir, "summary_table.csv")
-    create_summary_table(risk_cleaned, inundation_raster.data, land_use_values, summary_csv_path)
+    ### END SECTION OF STATISTICS SUMMARY, PDF GENERATION
 
-    land_use_risk_csv_path = os.path.join(output_dir, "land_use_risk.csv")
-    calculate_risk_by_land_use(risk_cleaned, land_use_values, no_data_value, land_use_risk_csv_path)
+    # A report rendered in the background is not part of the stages, its path is listed with the outputs
+    outputs["manifest"] = os.path.join(output_dir, "run_manifest.json")
+    recorder.write_manifest(outputs["manifest"], config_snapshot(config), user_inputs, outputs)
+
+    return outputs
 
-    ### END SECTION OF STATISTICS SUMMARY
+
+def run_from_gui(user_inputs, progress):
+    """
+    Runs the analysis for the GUI, in its background thread. The risk is always computed block by block (the internal
+    blocks of the inundation raster, unless config.BLOCK_SIZE sets a window size), so the progress and cancellation
+    follow the windows of the computation.
+
+    :param user_inputs: Dictionary returned by the input form of the GUI
+    :param progress: Function (stage name, fraction done) of the GUI, raises RunCancelled when Cancel was pressed
+    :return: Dictionary of output file paths
+    """
+    user_inputs = {**user_inputs, "block_size": 0 if config.BLOCK_SIZE is None else config.BLOCK_SIZE}
+    if user_inputs.get("generate_pdf") and config.PDF_IN_BACKGROUND:
+        # The report is drawn in another process, so it does not slow the window down. Once the raster and the CSV
+        # files are written, the run can no longer be cancelled
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            outputs = run_analysis(user_inputs, report_executor=executor, progress=progress)
+            outputs.pop("pdf_job").result()  # Waits for the report and raises its errors
+        return outputs
+    return run_analysis(user_inputs, progress=progress)
+
+
+def main():
+    """
+    Executes the flood risk analysis workflow, following these steps:
+    1. Launches a GUI to collect user inputs.
+    2. Runs the analysis with these inputs in a background thread (see run_from_gui and run_analysis), which saves the
+       risk GeoTIFF, the CSV statistics and optionally the PDF report. The GUI shows the progress of every stage, can
+       cancel the run and shows a preview of the risk raster when it is done.
+    """
+    gui.launch_gui(run_function=run_from_gui)
 
 if __name__ == "__main__":
     # Run the main function when this script is executed
-    main()
\ No newline at end of file
+    main()
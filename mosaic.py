@@ -0,0 +1,370 @@
+import argparse
+import math
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+import numpy as np
+import rasterio
+from rasterio.coords import disjoint_bounds
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+from rasterio.windows import Window, bounds as window_bounds
+import config
+import main
+from raster import Raster
+from stats import RiskStatistics
+
+# Rules for pixels covered by several hazard tiles
+OVERLAP_RULES = ("max", "first", "mean")
+
+# Open tiles, land use and damage model of a worker process, set once by _init_worker and used for every window
+_state = None
+
+
+def union_grid(tile_paths, crs=None, resolution=None):
+    """
+    Builds the virtual grid of a mosaic: the union of the extents of all tiles, in one CRS and resolution. Only the
+    metadata of the tiles is read. The grid is aligned to the first tile when it is already in the target CRS and
+    resolution, so its pixels are read without resampling.
+
+    :param tile_paths: Paths to the hazard tiles (inundation rasters)
+    :param crs: CRS of the mosaic, defaults to the CRS of the first tile
+    :param resolution: Pixel size of the mosaic in CRS units, defaults to the finest resolution of the tiles
+    :return: Raster object without a file, with the crs, transform, bounds, resolution and shape of the grid
+    """
+    tiles = [Raster(path) for path in tile_paths]
+    crs = CRS.from_user_input(crs) if crs else tiles[0].crs
+
+    resolutions = []
+    for tile in tiles:
+        if tile.crs == crs:
+            resolutions.append(tuple(abs(value) for value in tile.resolution))
+        else:
+            transform, _, _ = calculate_default_transform(tile.crs, crs, tile.shape[1], tile.shape[0], *tile.bounds)
+            resolutions.append((abs(transform.a), abs(transform.e)))
+    if resolution:
+        x_res = y_res = float(resolution)
+    else:
+        x_res, y_res = min(res[0] for res in resolutions), min(res[1] for res in resolutions)
+
+    extents = [tile.bounds_in(crs) for tile in tiles]
+    left, bottom = min(extent[0] for extent in extents), min(extent[1] for extent in extents)
+    right, top = max(extent[2] for extent in extents), max(extent[3] for extent in extents)
+
+    # Snap the union outwards to whole pixels from the origin of the first tile (or of the union)
+    origin_x, origin_y = left, top
+    if tiles[0].crs == crs and resolutions[0] == (x_res, y_res):
+        origin_x, origin_y = tiles[0].bounds.left, tiles[0].bounds.top
+    left = origin_x - math.ceil(round((origin_x - left) / x_res, 6)) * x_res
+    top = origin_y + math.ceil(round((top - origin_y) / y_res, 6)) * y_res
+    width = math.ceil(round((right - left) / x_res, 6))
+    height = math.ceil(round((top - bottom) / y_res, 6))
+
+    grid = Raster(file_path=None)
+    grid.crs = crs
+    grid.transform = from_origin(left, top, x_res, y_res)
+    grid.shape = (height, width)
+    grid.resolution = (x_res, y_res)
+    grid.bounds = rasterio.coords.BoundingBox(left, top - height * y_res, left + width * x_res, top)
+    return grid
+
+
+def combine_overlaps(layers, rule):
+    """
+    Combines the values of several tiles on the same window of the mosaic grid.
+
+    :param layers: List of tuples (values, covered), covered is the boolean mask of the pixels with data of the tile,
+        in the order of the tiles
+    :param rule: "max" (largest value), "first" (value of the first tile with data) or "mean" (mean of the tiles
+        with data)
+    :return: tuple of numpy arrays (combined values, 0 where no tile has data, and the mask of pixels with data)
+    """
+    shape = layers[0][0].shape
+    covered_any = np.zeros(shape, dtype=bool)
+    if rule == "first":
+        combined = np.zeros(shape)
+        for values, covered in layers:
+            taken = covered & ~covered_any
+            combined[taken] = values[taken]
+            covered_any |= taken
+    elif rule == "max":
+        combined = np.full(shape, -np.inf)
+        for values, covered in layers:
+            np.maximum(combined, values, out=combined, where=covered)
+            covered_any |= covered
+        combined[~covered_any] = 0
+    elif rule == "mean":
+        combined = np.zeros(shape)
+        counts = np.zeros(shape, dtype=np.int32)
+        for values, covered in layers:
+            np.add(combined, values, out=combined, where=covered)
+            counts += covered
+        covered_any = counts > 0
+        np.divide(combined, counts, out=combined, where=covered_any)
+    else:
+        raise ValueError(f"Unknown overlap rule: {rule} (use one of {OVERLAP_RULES})")
+    return combined, covered_any
+
+
+def _init_worker(grid, tiles, overlap, num_threads):
+    """
+    Opens the land use source, the damage model and every tile on the mosaic grid once per worker process. Tiles
+    whose pixels are aligned with the mosaic grid are read directly, the others are warped onto it.
+
+    :param grid: Mosaic grid from union_grid()
+    :param tiles: List of dictionaries with "flood_depth_file" and optionally "velocity_file"
+    :param overlap: Overlap rule, see combine_overlaps()
+    :param num_threads: Number of threads GDAL uses for warping, or "ALL_CPUS"
+    """
+    global _state
+    stack = ExitStack()
+    resources = main.load_resources()
+    land_use_vrt = stack.enter_context(grid.open_resampled(
+        resources["land_use_source"], Resampling[config.LAND_USE_RESAMPLING], num_threads, config.WARP_MEMORY_LIMIT_MB
+    ))
+
+    readers = []
+    for tile, bounds in zip(tiles, tile_bounds(grid, tiles)):
+        src = stack.enter_context(rasterio.open(tile["flood_depth_file"]))
+        offset = _grid_offset(grid, src)
+        if offset is None:
+            # Without a no-data value the footprint of the warped tile comes from an alpha band
+            src = stack.enter_context(WarpedVRT(
+                src, crs=grid.crs, transform=grid.transform, width=grid.shape[1], height=grid.shape[0],
+                resampling=Resampling[config.INUNDATION_RESAMPLING], add_alpha=src.nodata is None,
+                warp_mem_limit=config.WARP_MEMORY_LIMIT_MB, warp_extras={"NUM_THREADS": num_threads}
+            ))
+        velocity = None
+        if tile.get("velocity_file"):
+            velocity = stack.enter_context(grid.open_resampled(
+                tile["velocity_file"], Resampling[config.VELOCITY_RESAMPLING], num_threads, config.WARP_MEMORY_LIMIT_MB
+            ))
+        readers.append({"src": src, "offset": offset, "velocity": velocity, "bounds": bounds})
+
+    _state = {"stack": stack, "grid": grid, "overlap": overlap, "land_use": land_use_vrt, "readers": readers,
+              "damage_model": resources["damage_model"], "land_use_nodata": resources["land_use_raster"].nodata}
+
+
+def tile_bounds(grid, tiles):
+    """
+    Returns the bounds of every tile in the CRS of the mosaic grid.
+    """
+    return [Raster(tile["flood_depth_file"]).bounds_in(grid.crs) for tile in tiles]
+
+
+def window_has_tiles(grid, window, bounds):
+    """
+    Checks whether a window of the mosaic grid intersects any of the tile bounds from tile_bounds().
+    """
+    box = window_bounds(window, grid.transform)
+    return any(not disjoint_bounds(box, tile) for tile in bounds)
+
+
+def _grid_offset(grid, src):
+    """
+    Returns the (column, row) offset of a dataset on the mosaic grid, or None if its pixels are not aligned with it.
+    """
+    if src.crs != grid.crs or not np.allclose(src.res, grid.resolution, rtol=0, atol=1e-9 * max(grid.resolution)):
+        return None
+    col_off = (src.transform.c - grid.transform.c) / grid.resolution[0]
+    row_off = (grid.transform.f - src.transform.f) / grid.resolution[1]
+    if abs(col_off - round(col_off)) > 1e-6 or abs(row_off - round(row_off)) > 1e-6:
+        return None
+    return int(round(col_off)), int(round(row_off))
+
+
+def _tiles_in_window(window):
+    """
+    Returns the readers of the tiles that intersect a window of the mosaic grid.
+    """
+    box = window_bounds(window, _state["grid"].transform)
+    return [reader for reader in _state["readers"] if not disjoint_bounds(box, reader["bounds"])]
+
+
+def _read_tile(reader, window):
+    """
+    Reads the inundation and the mask of pixels with data of a tile in a window of the mosaic grid.
+
+    :return: tuple of numpy arrays (inundation, mask), or None if the tile only touches the window
+    """
+    src = reader["src"]
+    if isinstance(src, WarpedVRT):
+        return src.read(1, window=window), src.read_masks(1, window=window) > 0
+
+    # Aligned tile, only the part of the window inside the tile is read and the rest is not covered
+    col_off, row_off = reader["offset"]
+    tile_window = Window(window.col_off - col_off, window.row_off - row_off, window.width, window.height)
+    try:
+        part = tile_window.intersection(Window(0, 0, src.width, src.height))
+    except rasterio.errors.WindowError:
+        return None
+    shape = (window.height, window.width)
+    inundation = np.full(shape, src.nodata or 0, dtype=src.dtypes[0])
+    covered = np.zeros(shape, dtype=bool)
+    rows = slice(part.row_off - tile_window.row_off, part.row_off - tile_window.row_off + part.height)
+    cols = slice(part.col_off - tile_window.col_off, part.col_off - tile_window.col_off + part.width)
+    inundation[rows, cols] = src.read(1, window=part)
+    covered[rows, cols] = src.read_masks(1, window=part) > 0
+    return inundation, covered
+
+
+def _process_window(window):
+    """
+    Computes the damage of every tile in a window of the mosaic grid and combines them with the overlap rule. The land
+    use of the window is read and looked up once for all tiles.
+
+    :param window: rasterio Window of the mosaic grid
+    :return: tuple (window, combined damage, combined inundation, land use values, mask of pixels with data, land
+        use classes not in LAND_USE_MAP)
+    """
+    damage_model = _state["damage_model"]
+    land_use = _state["land_use"].read(1, window=window)
+    slots = damage_model.index(land_use, _state["land_use_nodata"])
+    land_use_values = damage_model.values[slots]
+
+    damages, inundations = [], []
+    for reader in _tiles_in_window(window):
+        tile = _read_tile(reader, window)
+        if tile is None:
+            continue
+        inundation, covered = tile
+        velocity = reader["velocity"].read(1, window=window) if reader["velocity"] is not None else None
+
+        intensity = main.compute_intensity(inundation, velocity)
+        damages.append((land_use_values * damage_model.damage_factor(slots, intensity), covered))
+        inundations.append((inundation, covered))
+
+    if not damages:  # The tiles only touch the edge of the window
+        empty = np.zeros(land_use.shape)
+        return window, empty, empty, land_use_values, np.zeros(land_use.shape, dtype=bool), set(damage_model.unknown_codes)
+
+    damage, covered = combine_overlaps(damages, _state["overlap"])
+    inundation, _ = combine_overlaps(inundations, _state["overlap"])
+    return window, damage, inundation, land_use_values, covered, set(damage_model.unknown_codes)
+
+
+def run_mosaic(tiles, output_dir, return_period, no_data_value, overlap=None, crs=None, resolution=None, block_size=None,
+               workers=None):
+    """
+    Computes one seamless risk raster from many hazard tiles (e.g. the inundation maps of neighbouring river sections),
+    without building the mosaic in memory. The tiles are put on a virtual union grid (see union_grid()) that is walked
+    window by window: every window reads and looks up the land use once for all tiles that intersect it, and windows
+    without tiles are not computed. The windows are processed in parallel by worker processes, and the main process
+    writes the blocks and collects the statistics in tile order as they come back, so memory is bounded by a few
+    blocks per worker.
+
+    Outputs in output_dir: mosaic_risk.tif, mosaic_summary_table.csv and mosaic_land_use_risk.csv. The statistics only
+    count the pixels where a tile has data, like with config.COMPACT_PIPELINE.
+
+    :param tiles: List of dictionaries with "flood_depth_file" and optionally "velocity_file", in order of priority
+        for the "first" overlap rule
+    :param output_dir: Directory of the outputs
+    :param return_period: the flood return period of every tile
+    :param no_data_value: number written to pixels without risk
+    :param overlap: Rule for pixels covered by several tiles (see combine_overlaps()), defaults to config.MOSAIC_OVERLAP
+    :param crs: CRS of the mosaic, defaults to config.MOSAIC_CRS or the CRS of the first tile
+    :param resolution: Pixel size of the mosaic, defaults to config.MOSAIC_RESOLUTION or the finest tile resolution
+    :param block_size: Side length of the windows in pixels, defaults to config.MOSAIC_BLOCK_SIZE
+    :param workers: Number of worker processes, defaults to config.MOSAIC_WORKERS (None uses the number of CPUs)
+    :return: Dictionary of output file paths
+    """
+    overlap = overlap or config.MOSAIC_OVERLAP
+    if overlap not in OVERLAP_RULES:
+        raise ValueError(f"Unknown overlap rule: {overlap} (use one of {OVERLAP_RULES})")
+    if not tiles:
+        raise ValueError("The mosaic needs at least one hazard tile.")
+    block_size = block_size or config.MOSAIC_BLOCK_SIZE
+    workers = workers or config.MOSAIC_WORKERS or os.cpu_count() or 1
+
+    grid = union_grid([tile["flood_depth_file"] for tile in tiles], crs or config.MOSAIC_CRS,
+                      resolution or config.MOSAIC_RESOLUTION)
+    if not grid.overlaps(Raster(config.LAND_USE_PATH)):
+        raise ValueError("The hazard tiles are outside of the land use raster, or there is a coordinate system issue.")
+
+    bounds = tile_bounds(grid, tiles)
+    windows = list(grid.iter_windows(block_size))
+    needed = [window for window in windows if window_has_tiles(grid, window, bounds)]
+    print(f"Mosaic of {len(tiles)} tiles: {grid.shape[1]} x {grid.shape[0]} pixels in {grid.crs}, "
+          f"{len(needed)} of {len(windows)} blocks with data")
+
+    outputs = {
+        "risk": os.path.join(output_dir, "mosaic_risk.tif"),
+        "summary": os.path.join(output_dir, "mosaic_summary_table.csv"),
+        "land_use_risk": os.path.join(output_dir, "mosaic_land_use_risk.csv"),
+    }
+    statistics = RiskStatistics(no_data_value, relative_error=config.MEDIAN_RELATIVE_ERROR)
+    unknown_codes = set()
+
+    # Each worker process warps with one thread, a single process uses the configured number of threads
+    worker_args = (grid, tiles, overlap, 1 if workers > 1 else config.WARP_THREADS)
+    with ExitStack() as stack:
+        dst = stack.enter_context(grid.open_writer(outputs["risk"], np.float64, no_data_value, config.OUTPUT_PROFILE))
+        for window in windows:
+            if not window_has_tiles(grid, window, bounds):
+                dst.write(np.full((window.height, window.width), no_data_value, dtype=np.float64), 1, window=window)
+
+        if workers == 1:
+            _init_worker(*worker_args)
+            stack.callback(_state["stack"].close)
+            results = map(_process_window, needed)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=worker_args))
+            results = _ordered_results(executor, needed, 2 * workers)
+
+        for window, damage, inundation, land_use_values, covered, codes in results:
+            # Like the single run risk raster, pixels without risk get the no-data value
+            risk = damage * (1 / return_period)
+            statistics.update(risk, inundation, land_use_values, covered)
+            dst.write(np.where(risk == 0, no_data_value, risk), 1, window=window)
+            unknown_codes |= codes
+
+    main.save_summary_table(statistics, outputs["summary"])
+    main.save_risk_by_land_use(statistics, outputs["land_use_risk"])
+    print(f"Mosaic risk raster saved to {outputs['risk']} (total risk: {statistics.risk.sum:.2f}, overlap rule: {overlap})")
+    if unknown_codes:
+        print(f"Land use classes not in LAND_USE_MAP (damage set to 0): {sorted(unknown_codes)}")
+    return outputs
+
+
+def _ordered_results(executor, windows, max_pending):
+    """
+    Yields the results of _process_window() in the order of the windows, with at most max_pending windows submitted
+    and not yet consumed, so finished blocks do not pile up in memory.
+    """
+    pending = deque()
+    for window in windows:
+        pending.append(executor.submit(_process_window, window))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+if __name__ == "__main__":
+    # e.g. `python mosaic.py --tile north.tif --tile south.tif south_velocity.tif --return-period 100 --output-dir results`
+    parser = argparse.ArgumentParser(description="Compute one seamless risk raster from many hazard tiles.")
+    parser.add_argument("--tile", nargs="+", action="append", required=True, metavar="ARG",
+                        help="INUNDATION_FILE [VELOCITY_FILE], repeat for every tile (in priority order)")
+    parser.add_argument("--return-period", type=int, required=True, help="flood return period of the tiles")
+    parser.add_argument("--output-dir", required=True, help="directory for the mosaic risk raster and tables")
+    parser.add_argument("--no-data", type=float, default=-999, help="no-data value of the outputs (default: -999)")
+    parser.add_argument("--overlap", choices=OVERLAP_RULES, default=config.MOSAIC_OVERLAP, help="rule for overlapping tiles (default: %(default)s)")
+    parser.add_argument("--crs", default=config.MOSAIC_CRS, help="CRS of the mosaic, e.g. EPSG:25832 (default: CRS of the first tile)")
+    parser.add_argument("--resolution", type=float, default=config.MOSAIC_RESOLUTION, help="pixel size of the mosaic (default: finest tile resolution)")
+    parser.add_argument("--block-size", type=int, default=config.MOSAIC_BLOCK_SIZE, help="window size in pixels (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=config.MOSAIC_WORKERS, help="number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    tile_list = []
+    for values in args.tile:
+        if len(values) not in (1, 2):
+            parser.error("--tile needs INUNDATION_FILE [VELOCITY_FILE]")
+        tile_list.append({"flood_depth_file": values[0], "velocity_file": values[1] if len(values) == 2 else None})
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    run_mosaic(tile_list, args.output_dir, args.return_period, args.no_data, args.overlap, args.crs, args.resolution,
+               args.block_size, args.workers)
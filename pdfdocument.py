@@ -1,11 +1,18 @@
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
 from reportlab.lib.styles import getSampleStyleSheet
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import contextily as ctx
 import rasterio
+from rasterio.enums import Resampling
 from rasterio.plot import show
-import os
+from rasterio.transform import Affine
+from rasterio.warp import transform_bounds
+from io import BytesIO
+import math
+import config
+from tile_cache import TileCache, render_basemap
 
 
 class PDFDocument:
@@ -14,17 +21,21 @@ class PDFDocument:
 
     Author: Shun Shiina
     """
-    def __init__(self, file_path, title="Document", author="Author"):
+    def __init__(self, file_path, title="Document", author="Author", tile_cache=None, dpi=100):
         """
         Initializes the PDFDocument object.
 
         :param file_path: The output file path for the generated PDF
         :param title: The title of the document
         :param author: The author of the document
+        :param tile_cache: TileCache of the basemap tiles, the one configured in config.py if not provided
+        :param dpi: Resolution of the map image, the raster is read at about this many pixels per inch of the figure
         """
         self.file_path = file_path
         self.title = title
         self.author = author
+        self.tile_cache = tile_cache
+        self.dpi = dpi
         self.elements = []
         self.styles = getSampleStyleSheet()
 
@@ -40,40 +51,82 @@ class PDFDocument:
         self.elements.append(title)
         self.elements.append(Spacer(1, 20))
 
-    def add_image(self, raster_path, output_dir):
+    def add_image(self, raster_path, output_dir=None, figsize=8):
         """
-        Adds the flood risk raster image overlaid on OpenStreetMap at the same position.
+        Adds the flood risk raster image overlaid on OpenStreetMap at the same position. The basemap tiles come from the
+        local tile cache, only tiles that are not cached are requested from the configured tile source.
 
         :param raster_path: Path to the raster file
-        :param output_dir: Directory where the temp image gets saved
+        :param output_dir: Not used anymore, the image is kept in memory until the PDF is saved
+        :param figsize: Width and height of the figure in inches
         """
         with rasterio.open(raster_path) as src:
-            # Plot the raster data
-            fig, ax = plt.subplots(figsize=(8, 8))
-            show(src, ax=ax, cmap='Reds')
-            ctx.add_basemap(ax, crs=src.crs.to_string(), source=ctx.providers.OpenStreetMap.Mapnik, alpha=0.4)
+            data, transform = self.read_decimated(src, math.ceil(figsize * self.dpi))
+
+            # Plot the raster data, with the object-oriented interface so reports can be rendered in parallel threads
+            fig = Figure(figsize=(figsize, figsize))
+            FigureCanvasAgg(fig)
+            ax = fig.subplots()
+            show(data, transform=transform, ax=ax, cmap='Reds')
+            self.add_basemap(ax, src.crs, src.bounds)
             ax.axis('off')  # Turn off axes for a clean look
 
-            # Save the figure as a temporary image
-            image_path = os.path.join(output_dir, "temp_overlay.png")
-            plt.savefig(image_path, bbox_inches="tight")
-            plt.close(fig)
+        # Each report has its own image buffer, so parallel runs into the same directory do not collide
+        image_buffer = BytesIO()
+        fig.savefig(image_buffer, format="png", bbox_inches="tight", dpi=self.dpi)
+        image_buffer.seek(0)
 
         # Add the image to the PDF
-        img = Image(image_path, width=500, height=400)
+        img = Image(image_buffer, width=500, height=400)
         self.elements.append(img)
         self.elements.append(Spacer(1, 6))
 
-        # Delay file removal until the PDF is saved
-        self.temp_image_path = image_path
+    @staticmethod
+    def read_decimated(src, max_pixels):
+        """
+        Reads the first band at no more pixels than the figure can show, from the overviews of the raster if it has
+        them, instead of the full resolution array.
+
+        :param src: Open rasterio dataset
+        :param max_pixels: Largest width or height of the returned array
+        :return: Tuple of the masked numpy array and its transform
+        """
+        scale = max(src.width / max_pixels, src.height / max_pixels, 1)
+        out_shape = (max(1, round(src.height / scale)), max(1, round(src.width / scale)))
+        data = src.read(1, out_shape=out_shape, resampling=Resampling.nearest, masked=True)
+        transform = src.transform * Affine.scale(src.width / out_shape[1], src.height / out_shape[0])
+        return data, transform
+
+    def add_basemap(self, ax, crs, bounds):
+        """
+        Draws the basemap tiles under the same extent as the raster, like ctx.add_basemap but from the tile cache.
+
+        :param ax: Matplotlib axes of the raster plot
+        :param crs: CRS of the raster
+        :param bounds: Bounds of the raster in its CRS
+        """
+        if self.tile_cache is None:
+            self.tile_cache = TileCache.from_config()
+
+        image, extent, missing = render_basemap(self.tile_cache, transform_bounds(crs, "EPSG:4326", *bounds))
+        if missing:
+            print(f"{missing} basemap tile(s) are not available at the zoom level of the map (upscaled from lower zoom levels "
+                  f"where cached), seed the tile cache with `python tile_cache.py prefetch --raster ... --source ...`")
+        if crs != "EPSG:3857":
+            image, extent = ctx.warp_tiles(image, extent, t_crs=crs)
+
+        # Keep the extent of the raster plot, the tiles reach beyond it
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        ax.imshow(image, extent=extent, interpolation="bilinear", alpha=0.4)
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+        ctx.add_attribution(ax, config.BASEMAP_ATTRIBUTION)
 
     def save(self):
         """
-        Saves the PDF with all added elements, removes temporary image.
+        Saves the PDF with all added elements.
         """
         self.doc.build(self.elements)
-        if hasattr(self, 'temp_image_path') and os.path.exists(self.temp_image_path):
-            os.remove(self.temp_image_path)
 
     def add_bounds(self, bounds):
         """
@@ -87,7 +140,7 @@ class PDFDocument:
         self.elements.append(Spacer(1, 20))
         self.elements.append(text)
 
-    def generate_from_raster(self, raster_path, output_dir):
+    def generate_from_raster(self, raster_path, output_dir=None):
         """
         Main method to build the PDF report. The steps are as follows:
         1. Extracts the bounding box of the raster
@@ -97,7 +150,7 @@ class PDFDocument:
         5. Saves the final PDF document
 
         :param raster_path: Path to the raster outputted by the main function
-        :param output_dir: Directory where the output files get saved
+        :param output_dir: Not used anymore, only the PDF is written
         """
         with rasterio.open(raster_path) as src:
             bounds = src.bounds
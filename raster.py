@@ -1,5 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+import os
 import rasterio
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+import rasterio.shutil
+from rasterio.coords import disjoint_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling, transform_bounds
+from rasterio.windows import Window
 import numpy as np
 
 class Raster:
@@ -10,82 +17,319 @@ class Raster:
     """
     def __init__(self, file_path=None):
         """
-        Initializes the Raster object.
+        Initializes the Raster object. Opening is lazy, only the metadata is read here and the pixel values are read
+        the first time `data` is accessed (or window by window with the read methods).
 
-        :param file_path: Path to the raster file. If provided, the raster is loaded automatically
+        :param file_path: Path to the raster file. If provided, the metadata is loaded automatically
         """
         self.file_path = file_path
         self.crs = None
         self.transform = None
         self.bounds = None
         self.resolution = None
-        self.data = None
+        self.shape = None
+        self.nodata = None
+        self._data = None
 
-        # Only load the raster if file_path is provided (i.e. not None) - needed for the empty raster creation
+        # Only load the metadata if file_path is provided (i.e. not None) - needed for the empty raster creation
         if self.file_path:
             self._load_raster()
 
     def _load_raster(self):
         """
-        Loads the raster file into memory, extracting CRS, transform, bounds, and resolution.
+        Loads the raster metadata, extracting CRS, transform, bounds, resolution, shape and no-data value without reading pixels.
         """
         with rasterio.open(self.file_path) as src:
             self.crs = src.crs
             self.transform = src.transform
             self.bounds = src.bounds
             self.resolution = src.res  # (x_res, y_res)
-            self.data = src.read(1)  # First band
+            self.shape = (src.height, src.width)
+            self.nodata = src.nodata
 
-    def resample_raster(self, raster2_path):
+    @property
+    def data(self):
+        """
+        Pixel values of the first band, read from the file on first access.
+        """
+        if self._data is None and self.file_path:
+            self._data = self.read_window(None)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def bounds_in(self, crs):
+        """
+        Returns the raster bounds transformed into another CRS.
+
+        :param crs: Target CRS of the bounds
+        :return: A tuple (left, bottom, right, top)
+        """
+        if crs is None or crs == self.crs:
+            return tuple(self.bounds)
+        return transform_bounds(self.crs, crs, *self.bounds)
+
+    def overlaps(self, other):
+        """
+        Checks if another raster overlaps geographically with the current raster, only the metadata is used.
+
+        :param other: Raster object to be compared
+        :return: True if the bounding boxes intersect
+        """
+        return not disjoint_bounds(other.bounds_in(self.crs), self.bounds)
+
+    def iter_windows(self, block_size=0):
+        """
+        Yields the windows used to walk over the raster block by block.
+
+        :param block_size: Side length in pixels of square windows, 0 uses the internal blocks of the file
+        :return: A generator of rasterio Window objects, in row-major order
+        """
+        if not block_size:
+            with rasterio.open(self.file_path) as src:
+                windows = [window for _, window in src.block_windows(1)]
+            yield from windows
+            return
+
+        height, width = self.shape
+        for row_off in range(0, height, block_size):
+            for col_off in range(0, width, block_size):
+                yield Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+
+    def read_window(self, window):
+        """
+        Reads a single window of the first band from the raster file.
+
+        :param window: rasterio Window to be read, None reads the whole band
+        :return: A numpy array with the raster data inside the window
+        """
+        with rasterio.open(self.file_path) as src:
+            return src.read(1, window=window)
+
+    @contextmanager
+    def open_resampled(self, raster2_path, resampling=Resampling.bilinear, num_threads=1, warp_mem_limit=0):
+        """
+        Opens another raster as a virtual dataset warped onto the current raster's grid. Reads from the virtual
+        dataset are computed in fixed warp blocks, so a window gives exactly the same values as the full read.
+
+        :param raster2_path: Path to the raster file to be resampled, or an open rasterio dataset (it stays open)
+        :param resampling: rasterio Resampling method, use nearest or mode for categorical data like land use classes
+        :param num_threads: Number of threads GDAL uses for warping, or "ALL_CPUS"
+        :param warp_mem_limit: Memory limit of the warp operation in MB, 0 uses the GDAL default
+        :return: A context manager yielding the rasterio WarpedVRT
+        """
+        with ExitStack() as stack:
+            if isinstance(raster2_path, rasterio.io.DatasetReader):
+                src2 = raster2_path
+            else:
+                src2 = stack.enter_context(rasterio.open(raster2_path))
+            with WarpedVRT(
+                src2,
+                crs=self.crs,
+                transform=self.transform,
+                width=self.shape[1],
+                height=self.shape[0],
+                dtype=src2.dtypes[0],  # Keep the source dtype, otherwise int8 is read as int16
+                resampling=resampling,
+                warp_mem_limit=warp_mem_limit,
+                warp_extras={"NUM_THREADS": num_threads}
+            ) as vrt:
+                yield vrt
+
+    def resample_raster(self, raster2_path, window=None, resampling=Resampling.bilinear, num_threads=1, warp_mem_limit=0):
         """
         Resamples another raster to match the current raster's resolution and CRS.
 
-        NOTE! Uses bilinear interpolation for continuous data, although consider using nearest-neighbor resampling
+        NOTE! Uses bilinear interpolation by default, pass nearest or mode for categorical data
 
-        :param raster2_path: Path to the raster file to be resampled
+        :param raster2_path: Path to the raster file to be resampled, or an open rasterio dataset
+        :param window: Optional window of the current raster, only this part of the other raster is resampled
+        :param resampling: rasterio Resampling method
+        :param num_threads: Number of threads GDAL uses for warping, or "ALL_CPUS"
+        :param warp_mem_limit: Memory limit of the warp operation in MB, 0 uses the GDAL default
         :return: A numpy array with resampled raster data
         """
-        with rasterio.open(raster2_path) as src2:
-            # Calculate the transform and dimensions for the target raster (self)
-            transform, width, height = calculate_default_transform(
-                src2.crs, self.crs, self.data.shape[1], self.data.shape[0], *self.bounds
-            )
-
-            # Prepare the resampled raster array
-            resampled_data = np.empty((self.data.shape[0], self.data.shape[1]), dtype=src2.meta['dtype'])
-
-            # Perform the resampling
-            reproject(
-                source=rasterio.band(src2, 1),
-                destination=resampled_data,
-                src_transform=src2.transform,
-                src_crs=src2.crs,
-                dst_transform=self.transform,
-                dst_crs=self.crs,
-                resampling=Resampling.bilinear  # Change to nearest for categorical data
-            )
+        with self.open_resampled(raster2_path, resampling, num_threads, warp_mem_limit) as vrt:
+            resampled_data = vrt.read(1, window=window)
 
         return resampled_data
 
-    def save_raster(self, output_path, data, no_data_value=None):
+    def open_writer(self, output_path, dtype, no_data_value=None, profile="plain"):
+        """
+        Opens a new raster file with the current raster's grid, so it can be written window by window. Overviews and
+        the COG layout of the output profile are created when the block is left.
+
+        :param output_path: The file path where the raster will be saved
+        :param dtype: Data type of the raster values
+        :param no_data_value: No-data value to be assigned in the metadata
+        :param profile: Name of an entry of OUTPUT_PROFILES, or a dictionary with some of its keys
+        :return: A context manager yielding an open rasterio dataset in write mode
+        """
+        return _open_output(output_path, self.shape, dtype, self.crs, self.transform, no_data_value, profile)
+
+    def save_raster(self, output_path, data, no_data_value=None, profile="plain"):
         """
         Saves the raster to a new file.
 
         :param output_path: The file path where the raster will be saved
         :param data: A numpy array containing the raster data
         :param no_data_value: No-data value to be assigned in the metadata (if defined, QGIS will recognize it automatically)
+        :param profile: Name of an entry of OUTPUT_PROFILES, or a dictionary with some of its keys
         """
+        with _open_output(output_path, data.shape, data.dtype, self.crs, self.transform, no_data_value, profile) as dst:
+            dst.write(data, 1)
+
+
+# Output layouts of save_raster() and open_writer(). A profile can also be a dictionary with some of these keys, the
+# others are taken from "plain"
+OUTPUT_PROFILES = {
+    # Striped and uncompressed, the original layout
+    "plain": {"tiled": False, "compress": None, "float32": False, "overviews": False, "cog": False,
+              "block_size": 256, "overview_resampling": "average"},
+    # Tiled, lossless DEFLATE with a predictor and internal overviews
+    "compressed": {"tiled": True, "compress": "deflate", "overviews": True},
+    # Like "compressed" with ZSTD, and float values stored as float32 (about half the size, rounds the values)
+    "compact": {"tiled": True, "compress": "zstd", "float32": True, "overviews": True},
+    # Cloud-optimized GeoTIFF: tiles and overviews ordered so a viewer or server only reads what it displays
+    "cog": {"tiled": True, "compress": "deflate", "overviews": True, "cog": True},
+}
+
+
+def resolve_output_profile(profile):
+    """
+    Returns all options of an output profile.
+
+    :param profile: Name of an entry of OUTPUT_PROFILES, or a dictionary with some of its keys
+    :return: Dictionary with every key of the "plain" profile
+    """
+    if isinstance(profile, str):
+        if profile not in OUTPUT_PROFILES:
+            raise ValueError(f"Unknown output profile: {profile} (use one of {sorted(OUTPUT_PROFILES)})")
+        profile = OUTPUT_PROFILES[profile]
+    unknown = set(profile) - set(OUTPUT_PROFILES["plain"])
+    if unknown:
+        raise ValueError(f"Unknown output profile options: {sorted(unknown)}")
+    return {**OUTPUT_PROFILES["plain"], **profile}
+
+
+def overview_factors(shape, block_size=256):
+    """
+    Returns the overview decimation factors (2, 4, 8, ...) until the smallest overview fits into one block.
+
+    :param shape: Tuple (height, width) of the full resolution raster
+    :param block_size: Side length of the blocks in pixels
+    :return: List of factors, empty for rasters that already fit into one block
+    """
+    factors = []
+    factor = 2
+    while max(shape) / (factor // 2) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+@contextmanager
+def _open_output(output_path, shape, dtype, crs, transform, no_data_value, profile):
+    """
+    Opens a GeoTIFF for block-by-block writing with the layout of an output profile. When the block is left, the
+    overviews are built and, for COG outputs, the file is rewritten in the COG layout. COG files can only be created
+    from a finished raster, so they are first written to a temporary tiled GeoTIFF next to the output.
+    """
+    options = resolve_output_profile(profile)
+    dtype = np.dtype(dtype)
+    if options["float32"] and dtype.kind == "f" and dtype.itemsize > 4:
+        dtype = np.dtype(np.float32)  # Blocks are cast by rasterio when they are written
+
+    block_size = options["block_size"]
+    creation_options = {}
+    if options["tiled"] or options["cog"]:
+        creation_options.update(tiled=True, blockxsize=block_size, blockysize=block_size)
+    if options["compress"] and not options["cog"]:
+        # Floating point predictor for float values, horizontal differencing for integers
+        creation_options.update(compress=options["compress"], predictor=3 if dtype.kind == "f" else 2)
+
+    path = f"{output_path}.tmp.tif" if options["cog"] else output_path
+    try:
         with rasterio.open(
-                output_path,
+                path,
                 'w',
                 driver='GTiff',
-                height=data.shape[0],
-                width=data.shape[1],
+                height=shape[0],
+                width=shape[1],
                 count=1,
-                dtype=data.dtype,
-                crs=self.crs,
-                transform=self.transform
+                dtype=dtype,
+                crs=crs,
+                transform=transform,
+                nodata=no_data_value,
+                **creation_options
         ) as dst:
-            dst.write(data, 1)
-            if no_data_value is not None:
-                dst.nodata = no_data_value
\ No newline at end of file
+            yield dst
+            factors = overview_factors(shape, block_size)
+            if options["overviews"] and not options["cog"] and factors:
+                dst.build_overviews(factors, Resampling[options["overview_resampling"]])
+                dst.update_tags(ns="rio_overview", resampling=options["overview_resampling"])
+
+        if options["cog"]:
+            rasterio.shutil.copy(
+                path, output_path, driver="COG", COMPRESS=(options["compress"] or "NONE").upper(),
+                PREDICTOR="YES" if options["compress"] else "NO", BLOCKSIZE=block_size,
+                OVERVIEWS="AUTO" if options["overviews"] else "NONE",
+                RESAMPLING=options["overview_resampling"].upper()
+            )
+    finally:
+        if options["cog"] and os.path.exists(path):
+            os.remove(path)
+
+
+class ResampledGroup:
+    """
+    A class for warping several rasters onto the same target grid in one pass, each with its own resampling method.
+    The inputs of a window are warped concurrently, and GDAL can use several threads for each of them.
+    """
+    def __init__(self, target_raster, sources, num_threads=1, warp_mem_limit=0):
+        """
+        Initializes the ResampledGroup object, the rasters are opened when the group is entered as a context manager.
+
+        :param target_raster: Raster object whose grid the sources are warped to
+        :param sources: Dictionary of name -> (raster file path or open dataset, rasterio Resampling method)
+        :param num_threads: Number of threads GDAL uses for warping each source, or "ALL_CPUS"
+        :param warp_mem_limit: Memory limit of each warp operation in MB, 0 uses the GDAL default
+        """
+        self.target_raster = target_raster
+        self.sources = sources
+        self.num_threads = num_threads
+        self.warp_mem_limit = warp_mem_limit
+        self.vrts = {}
+        self._stack = None
+        self._executor = None
+
+    def __enter__(self):
+        self._stack = ExitStack()
+        for name, (path, resampling) in self.sources.items():
+            self.vrts[name] = self._stack.enter_context(
+                self.target_raster.open_resampled(path, resampling, self.num_threads, self.warp_mem_limit)
+            )
+        if len(self.vrts) > 1:
+            self._executor = self._stack.enter_context(ThreadPoolExecutor(max_workers=len(self.vrts)))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.vrts = {}
+        self._executor = None
+        return self._stack.__exit__(*exc_info)
+
+    def read(self, window=None):
+        """
+        Reads the same window from every warped source.
+
+        :param window: rasterio Window of the target grid, None reads the whole grid
+        :return: Dictionary of name -> numpy array
+        """
+        if self._executor is None:
+            return {name: vrt.read(1, window=window) for name, vrt in self.vrts.items()}
+
+        # rasterio releases the GIL while GDAL warps, so the sources are warped in parallel
+        futures = {name: self._executor.submit(vrt.read, 1, window=window) for name, vrt in self.vrts.items()}
+        return {name: future.result() for name, future in futures.items()}
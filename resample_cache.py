@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+from contextlib import contextmanager
+import numpy as np
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+class ResampleCache:
+    """
+    A class for keeping resampled rasters (the land use grid) on disk, so repeat runs on the same target grid skip
+    the reprojection and memory-map the stored array instead
+    """
+    def __init__(self, cache_dir, max_size_mb=2048):
+        """
+        Initializes the ResampleCache object.
+
+        :param cache_dir: Directory where the cached grids are stored
+        :param max_size_mb: Size limit of the cache in megabytes, the least recently used grids are removed above it
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _file_hash(self, path):
+        """
+        Computes the SHA-256 of a file. Hashes are remembered by path, size and modification time, so an unchanged
+        source file is only read once.
+
+        :param path: Path to the file
+        :return: Hex digest of the file contents
+        """
+        index_path = os.path.join(self.cache_dir, "hashes.json")
+        stat = os.stat(path)
+        abs_path = os.path.abspath(path)
+        entry = self._read_index(index_path).get(abs_path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry["sha256"]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+
+        # Several batch, worker or mosaic processes can share the cache: the index is read again and updated under a
+        # lock, so no process loses the entries of another, and replaced atomically, so readers never see a torn file
+        with self._index_lock():
+            hashes = self._read_index(index_path)
+            hashes[abs_path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(hashes, f, indent=2)
+            os.replace(tmp_path, index_path)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _read_index(index_path):
+        """
+        Reads the remembered file hashes.
+
+        :param index_path: Path to hashes.json
+        :return: Dictionary of absolute path -> size, modification time and SHA-256, empty if there is no index
+        """
+        if not os.path.exists(index_path):
+            return {}
+        try:
+            with open(index_path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}  # A broken index only means the files are hashed again
+
+    @contextmanager
+    def _index_lock(self):
+        """
+        Holds an exclusive lock on the hash index of the cache directory, shared by all processes.
+        """
+        with open(os.path.join(self.cache_dir, "hashes.json.lock"), "a+") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def key(self, target_raster, source_path, resampling):
+        """
+        Builds the cache key of a resampled grid.
+
+        :param target_raster: Raster object whose grid (CRS, transform, shape) the source is resampled to
+        :param source_path: Path to the raster file that is resampled
+        :param resampling: rasterio Resampling method
+        :return: Hex string identifying the grid
+        """
+        parts = {
+            "crs": target_raster.crs.to_wkt(),
+            "transform": list(target_raster.transform)[:6],
+            "shape": list(target_raster.shape),
+            "resampling": resampling.name,
+            "source": self._file_hash(source_path),
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        """
+        Returns the file path of a cached grid.
+        """
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key):
+        """
+        Memory-maps a cached grid, without copying it into RAM.
+
+        :param key: Cache key from key()
+        :return: A read-only numpy memmap, or None if the grid is not cached
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        os.utime(path)  # Mark as recently used for the LRU eviction
+        return np.load(path, mmap_mode="r")
+
+    def fetch(self, target_raster, source_path, resampling, block_size=0, num_threads=1, warp_mem_limit=0, source_dataset=None):
+        """
+        Returns the source raster resampled onto the target grid, from the cache if possible. On a miss the grid is
+        resampled window by window straight into the cache file, so memory stays bounded by the block size.
+
+        :param target_raster: Raster object whose grid the source is resampled to
+        :param source_path: Path to the raster file that is resampled
+        :param resampling: rasterio Resampling method
+        :param block_size: Side length in pixels of the windows used on a miss, 0 uses the internal blocks
+        :param num_threads: Number of threads GDAL uses for warping on a miss, or "ALL_CPUS"
+        :param warp_mem_limit: Memory limit of the warp operation in MB, 0 uses the GDAL default
+        :param source_dataset: Optional open rasterio dataset of the source (e.g. kept in memory), warped on a miss
+            instead of opening source_path again
+        :return: A read-only numpy memmap on the target grid
+        """
+        key = self.key(target_raster, source_path, resampling)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            source = source_dataset if source_dataset is not None else source_path
+            with target_raster.open_resampled(source, resampling, num_threads, warp_mem_limit) as vrt:
+                grid = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=vrt.dtypes[0], shape=target_raster.shape)
+                for window in target_raster.iter_windows(block_size):
+                    grid[window.toslices()] = vrt.read(1, window=window)
+                grid.flush()
+                del grid
+            # Only complete grids get the final name, so an interrupted run never leaves a broken cache entry
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self._evict(keep=path)
+        return np.load(path, mmap_mode="r")
+
+    def _evict(self, keep=None):
+        """
+        Removes the least recently used grids until the cache is below its size limit.
+
+        :param keep: Path of a grid that must not be removed (the one that was just stored)
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy"):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+    def clear(self):
+        """
+        Invalidates the cache by removing all cached grids and remembered file hashes.
+
+        :return: Number of removed grids
+        """
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy") or name == "hashes.json":
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += name.endswith(".npy")
+        return removed
+
+    def report(self):
+        """
+        Returns the hit and miss counts as text.
+        """
+        return f"Resample cache: {self.hits} hit(s), {self.misses} miss(es)"
+
+
+if __name__ == "__main__":
+    # Command line access to the cache, e.g. `python resample_cache.py --clear` after the land use file was replaced
+    parser = argparse.ArgumentParser(description="Manage the on-disk cache of resampled land use grids.")
+    parser.add_argument("--clear", action="store_true", help="remove all cached grids")
+    args = parser.parse_args()
+
+    if not config.RESAMPLE_CACHE_DIR:
+        print("The resample cache is disabled (RESAMPLE_CACHE_DIR = None in config.py), there is nothing to show or clear.")
+        sys.exit(0)
+    cache = ResampleCache(config.RESAMPLE_CACHE_DIR, config.RESAMPLE_CACHE_SIZE_MB)
+    if args.clear:
+        print(f"Removed {cache.clear()} cached grid(s) from {cache.cache_dir}")
+    else:
+        sizes = [os.path.getsize(os.path.join(cache.cache_dir, n)) for n in os.listdir(cache.cache_dir) if n.endswith(".npy")]
+        print(f"{len(sizes)} cached grid(s), {sum(sizes) / 1024 / 1024:.1f} MB in {cache.cache_dir}")
@@ -0,0 +1,376 @@
+import math
+import numpy as np
+import pandas as pd
+
+class StreamingStats:
+    """
+    A class for computing mean, median, standard deviation, minimum and maximum of a raster block by block, in a
+    single pass and with memory that does not depend on the raster size
+    """
+    def __init__(self, relative_error=0.001, exact_limit=1024):
+        """
+        Initializes the StreamingStats object.
+
+        :param relative_error: Error bound of the median, relative to the median value (0.001 = 0.1 %)
+        :param exact_limit: While the data has at most this many distinct values, they are counted exactly and the
+            median is exact (e.g. land use values or classified rasters)
+        """
+        self.count = 0
+        self.sum = 0.0
+        self.m2 = 0.0  # Sum of squared deviations from the mean
+        self.min = np.inf
+        self.max = -np.inf
+
+        # Median sketch: logarithmic buckets with a relative width of relative_error, for positive and negative values
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.log_gamma = math.log(self.gamma)
+        self.zero_count = 0
+        self.buckets = {"positive": (np.zeros(0, dtype=np.int64), 0), "negative": (np.zeros(0, dtype=np.int64), 0)}
+
+        self.exact_limit = exact_limit
+        self.exact_counts = {}
+
+    def update(self, block):
+        """
+        Adds a block of values, NaN values are ignored like in np.nanmean.
+
+        :param block: numpy array with raster values
+        :return: The StreamingStats object itself
+        """
+        values = np.asarray(block, dtype=np.float64).ravel()
+        nan = np.isnan(values)
+        if nan.any():
+            values = values[~nan]
+        if values.size == 0:
+            return self
+
+        # Mean and squared deviations of the block, merged with the running values (Chan et al.)
+        block_mean = values.mean()
+        deviations = values - block_mean
+        block_m2 = np.dot(deviations, deviations)
+        total = self.count + values.size
+        delta = block_mean - self.mean if self.count else 0.0
+        self.m2 += block_m2 + delta * delta * self.count * values.size / total
+        self.count = total
+        self.sum += values.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+
+        if self.exact_counts is not None:
+            self._update_exact(values)
+        else:
+            self._update_sketch(values)
+        return self
+
+    def _update_exact(self, values):
+        """
+        Counts the distinct values as long as there are few of them. Once there are too many, the counts so far are
+        moved into the sketch and only the sketch is used from then on.
+        """
+        # A sample of the block already shows most high-cardinality data, without counting the whole block
+        counts = self._distinct_counts(values[:65536])
+        if counts is not None and values.size > 65536:
+            counts = self._distinct_counts(values)
+
+        if counts is None:
+            self._leave_exact_mode()
+            self._update_sketch(values)
+            return
+        for value, count in zip(counts.index.tolist(), counts.tolist()):
+            self.exact_counts[value] = self.exact_counts.get(value, 0) + count
+
+    def _leave_exact_mode(self):
+        """
+        Moves the exact counts into the sketch, afterwards only the sketch is used.
+        """
+        if self.exact_counts is None:
+            return
+        values = np.array(list(self.exact_counts), dtype=np.float64)
+        weights = np.array(list(self.exact_counts.values()), dtype=np.int64)
+        self.exact_counts = None
+        if values.size:
+            self._update_sketch(values, weights)
+
+    def _distinct_counts(self, values):
+        """
+        Counts the distinct values of an array (hash based, no sort).
+
+        :return: pandas Series of value -> count, or None if the values and the exact counts so far have more than
+            exact_limit distinct values together
+        """
+        counts = pd.Series(values, copy=False).value_counts(sort=False)
+        if len(counts) > self.exact_limit or len(self.exact_counts.keys() | set(counts.index.tolist())) > self.exact_limit:
+            return None
+        return counts
+
+    def _update_sketch(self, values, weights=None):
+        """
+        Adds the values to the logarithmic buckets of the median sketch.
+
+        :param values: numpy array of float values without NaN
+        :param weights: Optional count of each value
+        """
+        keep = np.isfinite(values) & (values != 0)
+        zero_weights = (values == 0) if weights is None else weights[values == 0]
+        self.zero_count += int(zero_weights.sum())
+        if not keep.all():
+            values = values[keep]
+            weights = None if weights is None else weights[keep]
+
+        indices = np.ceil(np.log(np.abs(values)) / self.log_gamma).astype(np.int64)
+        positive = values > 0
+        for side, mask in (("positive", positive), ("negative", ~positive)):
+            if mask.any():
+                self._add_to_buckets(side, indices[mask], None if weights is None else weights[mask])
+
+    def _add_to_buckets(self, side, indices, weights=None):
+        """
+        Adds bucket indices to the dense bucket counts of one side, the array grows when new indices appear.
+
+        :param side: "positive" or "negative"
+        :param indices: numpy array of bucket indices
+        :param weights: Optional count of each index
+        """
+        counts, offset = self.buckets[side]
+        low = min(int(indices.min()), offset) if counts.size else int(indices.min())
+        high = max(int(indices.max()), offset + counts.size - 1) if counts.size else int(indices.max())
+        merged = np.zeros(high - low + 1, dtype=np.int64)
+        if counts.size:
+            merged[offset - low:offset - low + counts.size] = counts
+        merged += np.bincount(indices - low, weights=weights, minlength=merged.size).astype(np.int64)
+        self.buckets[side] = (merged, low)
+
+    def merge(self, other):
+        """
+        Adds the statistics of another StreamingStats object (e.g. computed in parallel on other tiles).
+
+        :param other: StreamingStats object with the same relative error
+        :return: The StreamingStats object itself
+        """
+        if other.count == 0:
+            return self
+        total = self.count + other.count
+        delta = other.mean - self.mean if self.count else 0.0
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.count = total
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        if other.exact_counts is not None:
+            # Counts of the other object are added like a block of values with weights
+            values = np.array(list(other.exact_counts), dtype=np.float64)
+            weights = np.array(list(other.exact_counts.values()), dtype=np.int64)
+            if self.exact_counts is not None and len(self.exact_counts.keys() | other.exact_counts.keys()) <= self.exact_limit:
+                for value, count in other.exact_counts.items():
+                    self.exact_counts[value] = self.exact_counts.get(value, 0) + count
+            else:
+                self._leave_exact_mode()
+                self._update_sketch(values, weights)
+            return self
+
+        self._leave_exact_mode()
+        self.zero_count += other.zero_count
+        for side in ("positive", "negative"):
+            counts, offset = other.buckets[side]
+            if counts.size:
+                self._add_to_buckets(side, np.arange(offset, offset + counts.size), counts)
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        # Population standard deviation, like np.nanstd
+        return math.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    @property
+    def median(self):
+        """
+        Median of all values, exact for data with few distinct values and within the relative error otherwise.
+        """
+        if self.count == 0:
+            return np.nan
+        # For an even count the median is the mean of the two middle values, like np.nanmedian
+        ranks = [(self.count - 1) // 2, self.count // 2]
+        return sum(self._value_at_rank(rank) for rank in ranks) / 2
+
+    def _value_at_rank(self, rank):
+        """
+        Returns the value at a rank (position in the sorted values), from the exact counts or the sketch.
+        """
+        if self.exact_counts is not None:
+            seen = 0
+            for value in sorted(self.exact_counts):
+                seen += self.exact_counts[value]
+                if seen > rank:
+                    return value
+
+        # Order of the sketch: negative buckets from the largest magnitude, zeros, positive buckets from the smallest
+        negative_counts, negative_offset = self.buckets["negative"]
+        if rank < negative_counts.sum():
+            cumulative = np.cumsum(negative_counts[::-1])
+            index = negative_offset + negative_counts.size - 1 - int(np.searchsorted(cumulative, rank, side="right"))
+            return -self._bucket_value(index)
+        rank -= negative_counts.sum()
+
+        if rank < self.zero_count:
+            return 0.0
+        rank -= self.zero_count
+
+        positive_counts, positive_offset = self.buckets["positive"]
+        index = positive_offset + int(np.searchsorted(np.cumsum(positive_counts), rank, side="right"))
+        return self._bucket_value(index)
+
+    def _bucket_value(self, index):
+        """
+        Value that represents a bucket, within the relative error of every value in the bucket.
+        """
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class LandUseRiskStats:
+    """
+    A class for computing the total, average and count of risk per land use category block by block, with np.bincount
+    """
+    def __init__(self, no_data_value):
+        """
+        Initializes the LandUseRiskStats object.
+
+        :param no_data_value: Risk pixels with this value are not counted
+        """
+        self.no_data_value = no_data_value
+        self.sums = np.zeros(0)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.other = {}  # Categories that are not non-negative integers: category -> [sum, count]
+
+    def update(self, land_use_values, risk):
+        """
+        Adds a block of land use values and the risk on the same pixels.
+
+        :param land_use_values: numpy array with the land use value (category) of every pixel
+        :param risk: numpy array with risk values
+        :return: The LandUseRiskStats object itself
+        """
+        land_use_values = np.asarray(land_use_values).ravel()
+        risk = np.asarray(risk, dtype=np.float64).ravel()
+        valid = (risk != self.no_data_value) & ~np.isnan(risk)
+        categories, risk = land_use_values[valid], risk[valid]
+        if categories.size == 0:
+            return self
+
+        if categories.dtype.kind in "iu" and categories.min() >= 0:
+            size = max(self.counts.size, int(categories.max()) + 1)
+            self.sums = np.pad(self.sums, (0, size - self.sums.size)) + np.bincount(categories, weights=risk, minlength=size)
+            self.counts = np.pad(self.counts, (0, size - self.counts.size)) + np.bincount(categories, minlength=size)
+        else:
+            # Float or negative categories (e.g. from damage curves or unknown values) are grouped with np.unique
+            unique, inverse = np.unique(categories, return_inverse=True)
+            sums = np.bincount(inverse, weights=risk)
+            counts = np.bincount(inverse)
+            for category, category_sum, count in zip(unique.tolist(), sums.tolist(), counts.tolist()):
+                entry = self.other.setdefault(category, [0.0, 0])
+                entry[0] += category_sum
+                entry[1] += count
+        return self
+
+    def merge(self, other):
+        """
+        Adds the statistics of another LandUseRiskStats object.
+
+        :param other: LandUseRiskStats object
+        :return: The LandUseRiskStats object itself
+        """
+        size = max(self.counts.size, other.counts.size)
+        self.sums = np.pad(self.sums, (0, size - self.sums.size)) + np.pad(other.sums, (0, size - other.sums.size))
+        self.counts = np.pad(self.counts, (0, size - self.counts.size)) + np.pad(other.counts, (0, size - other.counts.size))
+        for category, (category_sum, count) in other.other.items():
+            entry = self.other.setdefault(category, [0.0, 0])
+            entry[0] += category_sum
+            entry[1] += count
+        return self
+
+    def to_dataframe(self):
+        """
+        Returns the statistics as a table with one row per land use category, sorted by category.
+
+        :return: pandas DataFrame with the columns Land Use Category, Total Risk, Average Risk and Pixel Count
+        """
+        totals = {}
+        for category in np.flatnonzero(self.counts).tolist():
+            totals[category] = [self.sums[category], int(self.counts[category])]
+        for category, (category_sum, count) in self.other.items():
+            entry = totals.setdefault(category, [0.0, 0])
+            entry[0] += category_sum
+            entry[1] += count
+
+        categories = sorted(totals)
+        return pd.DataFrame({
+            "Land Use Category": categories,
+            "Total Risk": [totals[category][0] for category in categories],
+            "Average Risk": [totals[category][0] / totals[category][1] for category in categories],
+            "Pixel Count": [totals[category][1] for category in categories],
+        })
+
+
+class RiskStatistics:
+    """
+    A class that collects all statistics of a risk run (summary table and risk by land use) block by block
+    """
+    def __init__(self, no_data_value, relative_error=0.001):
+        """
+        Initializes the RiskStatistics object.
+
+        :param no_data_value: No-data value of the risk raster, excluded from the risk by land use
+        :param relative_error: Error bound of the medians, relative to the median value
+        """
+        self.risk = StreamingStats(relative_error)
+        self.inundation = StreamingStats(relative_error)
+        self.land_use = StreamingStats(relative_error)
+        self.by_land_use = LandUseRiskStats(no_data_value)
+
+    def update(self, risk, inundation, land_use_values, valid=None):
+        """
+        Adds a block of the risk, inundation and land use value rasters (same window of each).
+
+        :param valid: Optional boolean mask of the valid pixels (from main.compute_risk_compact), only these are counted
+        :return: The RiskStatistics object itself
+        """
+        if valid is not None:
+            risk, inundation, land_use_values = risk[valid], inundation[valid], land_use_values[valid]
+        self.risk.update(risk)
+        self.inundation.update(inundation)
+        self.land_use.update(land_use_values)
+        self.by_land_use.update(land_use_values, risk)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the statistics of another RiskStatistics object.
+
+        :return: The RiskStatistics object itself
+        """
+        self.risk.merge(other.risk)
+        self.inundation.merge(other.inundation)
+        self.land_use.merge(other.land_use)
+        self.by_land_use.merge(other.by_land_use)
+        return self
+
+    def summary_dataframe(self):
+        """
+        Returns the summary table of the risk, inundation and land use rasters.
+
+        :return: pandas DataFrame with the columns Raster, Mean, Median, Standard Deviation, Minimum and Maximum
+        """
+        rasters = [self.risk, self.inundation, self.land_use]
+        return pd.DataFrame({
+            "Raster": ["Risk", "Inundation", "Land Use"],
+            "Mean": [stats.mean for stats in rasters],
+            "Median": [stats.median for stats in rasters],
+            "Standard Deviation": [stats.std for stats in rasters],
+            "Minimum": [stats.min if stats.count else np.nan for stats in rasters],
+            "Maximum": [stats.max if stats.count else np.nan for stats in rasters],
+        })
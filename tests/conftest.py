@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+# The modules of the tool are top-level modules, and config.py uses paths relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import config
+
+# Tests that run the risk pipeline need the bundled CORINE land use raster
+requires_land_use = pytest.mark.skipif(
+    not os.path.exists(os.path.join(ROOT, config.LAND_USE_PATH)), reason="the land use raster is not in data/Project_Files"
+)
+
+
+@pytest.fixture(autouse=True)
+def repository_root(monkeypatch):
+    """
+    Runs every test from the repository root, like the tool itself.
+    """
+    monkeypatch.chdir(ROOT)
@@ -0,0 +1,60 @@
+import os
+import time
+import numpy as np
+from artifact_store import ArtifactStore
+
+
+def store_array(store, key, size=1000):
+    with store.put(key) as writer:
+        writer.array("values", (size,), np.float64)[:] = 1
+    return store.load(key)
+
+
+def age(store, key, seconds):
+    """
+    Moves the last use of an artifact into the past, the mtime resolution of some file systems is coarse.
+    """
+    path = os.path.join(store.store_dir, key)
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_least_recently_used_artifacts_are_evicted(tmp_path):
+    store = ArtifactStore(str(tmp_path), max_size_mb=1)
+    keys = [store.key("damage", index=index) for index in range(4)]
+    for index, key in enumerate(keys[:3]):
+        store.begin_run()
+        store_array(store, key, 37_500)  # 0.3 MB each
+        age(store, key, 100 - index)
+    store.begin_run()
+    assert store.load(keys[0]) is not None  # Used again, so keys[1] is now the least recently used
+
+    store.begin_run()
+    store_array(store, keys[3], 37_500)
+    stored = {name for name in os.listdir(tmp_path)}
+    assert keys[1] not in stored
+    assert {keys[0], keys[2], keys[3]} <= stored
+    assert store.size()[1] <= 1024 * 1024
+
+
+def test_artifacts_of_the_current_run_are_kept(tmp_path):
+    store = ArtifactStore(str(tmp_path), max_size_mb=1)
+    store.begin_run()
+    keys = [store.key(stage, run=1) for stage in ("aligned", "intensity", "damage")]
+    for key in keys:
+        store_array(store, key, 100_000)  # 0.8 MB each, every put is above the limit
+    assert set(keys) <= set(os.listdir(tmp_path))
+
+    # In the next run, the artifacts of the first one can be evicted
+    store.begin_run()
+    store_array(store, store.key("damage", run=2), 100_000)
+    assert store.size()[0] == 1
+
+
+def test_get_counts_hits_and_misses(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    key = store.key("risk", return_period=100)
+    assert store.get(key) is None
+    store_array(store, key)
+    np.testing.assert_array_equal(store.get(key)["values"], 1)
+    assert store.hits == {"risk": 1} and store.misses == {"risk": 1}
@@ -0,0 +1,75 @@
+import os
+import pandas as pd
+import pytest
+from conftest import ROOT, requires_land_use
+import config
+from batch import load_manifest, run_batch
+
+INUNDATION = os.path.join(ROOT, "data", "BiberachInundation.tif")
+
+
+def test_csv_manifest(tmp_path):
+    manifest = tmp_path / "scenarios.csv"
+    manifest.write_text(
+        "name,flood_depth_file,velocity_file,return_period,no_data_value,output_dir,generate_pdf,block_size\n"
+        "hq100,hazards/hq100.tif,,100,-999,out/hq100,no,256\n"
+        ",hazards/hq10.tif,hazards/v10.tif,10,-999,out/hq10,yes,\n"
+    )
+    first, second = load_manifest(str(manifest))
+
+    assert first == {"name": "hq100", "return_period": 100, "no_data_value": -999.0, "generate_pdf": False,
+                     "block_size": 256, "flood_depth_file": str(tmp_path / "hazards" / "hq100.tif"),
+                     "velocity_file": None, "output_dir": str(tmp_path / "out" / "hq100")}
+    assert second["name"] == "scenario_2"
+    assert second["generate_pdf"] is True
+    assert "block_size" not in second
+    assert second["velocity_file"] == str(tmp_path / "hazards" / "v10.tif")
+
+
+def test_json_manifest_with_a_scenarios_key(tmp_path):
+    manifest = tmp_path / "scenarios.json"
+    manifest.write_text('{"scenarios": [{"flood_depth_file": "/data/hq100.tif", "return_period": 100, '
+                        '"no_data_value": -999, "output_dir": "/out/hq100"}]}')
+    (scenario,) = load_manifest(str(manifest))
+    assert scenario["flood_depth_file"] == "/data/hq100.tif"  # Absolute paths are kept
+    assert scenario["generate_pdf"] is False
+
+
+@pytest.mark.parametrize("header, row, message", [
+    ("flood_depth_file,return_period,no_data_value,output_dir,priority", "hq100.tif,100,-999,out,1", "unknown manifest columns"),
+    ("flood_depth_file,return_period,no_data_value,output_dir", "hq100.tif,100,,out", "missing mandatory fields"),
+])
+def test_invalid_manifests(tmp_path, header, row, message):
+    manifest = tmp_path / "scenarios.csv"
+    manifest.write_text(f"{header}\n{row}\n")
+    with pytest.raises(ValueError, match=message):
+        load_manifest(str(manifest))
+
+
+def test_scenarios_need_their_own_output_directory(tmp_path):
+    scenario = {"name": "a", "flood_depth_file": INUNDATION, "return_period": 100, "no_data_value": -999.0,
+                "output_dir": str(tmp_path / "out")}
+    with pytest.raises(ValueError, match="own output directory"):
+        run_batch([scenario, {**scenario, "name": "b"}], workers=1)
+
+
+@requires_land_use
+def test_failed_scenario_does_not_stop_the_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "RESAMPLE_CACHE_DIR", None)
+    monkeypatch.setattr(config, "ARTIFACT_STORE_DIR", None)
+    monkeypatch.setattr(config, "PROFILER", None)
+    scenarios = [
+        {"name": "missing", "flood_depth_file": str(tmp_path / "missing.tif"), "velocity_file": None,
+         "return_period": 100, "no_data_value": -999.0, "output_dir": str(tmp_path / "missing"), "generate_pdf": False},
+        {"name": "biberach", "flood_depth_file": INUNDATION, "velocity_file": None, "return_period": 100,
+         "no_data_value": -999.0, "output_dir": str(tmp_path / "biberach"), "generate_pdf": False},
+    ]
+    report = tmp_path / "report.csv"
+    statuses = run_batch(scenarios, workers=1, report_path=str(report))
+
+    assert [status["status"] for status in statuses] == ["failed", "ok"]
+    assert "missing.tif" in statuses[0]["error"]
+    assert os.path.exists(statuses[1]["outputs"]["risk"])
+    table = pd.read_csv(report)
+    assert list(table["Scenario"]) == ["missing", "biberach"]
+    assert list(table["Status"]) == ["failed", "ok"]
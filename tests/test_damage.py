@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from damage import DamageModel
+
+LAND_USE_MAP = {1: 50, 2: 40, 12: 10, 48: 0}
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.float32])
+def test_lookup_unknown_and_nodata(dtype):
+    model = DamageModel(LAND_USE_MAP)
+    land_use = np.array([[1, 2, 12], [48, 7, 255]], dtype=dtype)
+    np.testing.assert_array_equal(model.lookup(land_use, nodata=255), [[50, 40, 10], [0, 0, 0]])
+    assert model.unknown_codes == {7}
+
+
+def test_lookup_matches_dictionary():
+    model = DamageModel(LAND_USE_MAP, unknown_value=-1)
+    land_use = np.random.default_rng(0).integers(0, 60, size=(50, 50), dtype=np.uint8)
+    expected = np.vectorize(lambda code: LAND_USE_MAP.get(code, -1))(land_use)
+    np.testing.assert_array_equal(model.lookup(land_use), expected)
+    assert model.unknown_codes == set(np.unique(land_use).tolist()) - set(LAND_USE_MAP)
+
+
+def test_nodata_slot_gets_no_damage():
+    model = DamageModel(LAND_USE_MAP, unknown_value=5)
+    slots = model.index(np.array([2, 3, 0], dtype=np.uint8), nodata=0)
+    np.testing.assert_array_equal(slots, [2, model.unknown_slot, model.nodata_slot])
+    np.testing.assert_array_equal(model.values[slots], [40, 5, 0])
+
+
+def test_depth_damage_curves_match_interp():
+    curve = ([0.1, 0.5, 1.0, 2.0], [0.0, 0.25, 0.6, 1.0])
+    model = DamageModel(LAND_USE_MAP, {1: curve})
+    land_use = np.array([1, 1, 1, 1, 2, 2])
+    intensity = np.array([0.0, 0.3, 1.5, 3.0, 0.3, 1.5])
+    land_use_values, damage = model.evaluate(land_use, intensity)
+    expected_factor = np.where(land_use == 1, np.interp(intensity, *curve), intensity)
+    np.testing.assert_allclose(damage, land_use_values * expected_factor)
+
+
+def test_negative_codes_are_rejected():
+    with pytest.raises(ValueError):
+        DamageModel({-1: 10, 1: 50})
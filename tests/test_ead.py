@@ -0,0 +1,72 @@
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from conftest import requires_land_use
+import main
+from ead import integrate_ead, run_ead
+
+INUNDATION = "data/BiberachInundation.tif"
+
+
+def test_two_scenarios():
+    # Trapezoid between the probabilities 1/10 and 1/100: (0.1 - 0.01) * (1 + 2) / 2
+    damage = np.array([[[1.0]], [[2.0]]])
+    np.testing.assert_allclose(integrate_ead(damage, [10, 100]), [[0.135]])
+
+
+def test_constant_damage_integrates_to_the_probability_range():
+    damage = np.full((3, 4, 5), 7.0)
+    np.testing.assert_allclose(integrate_ead(damage, [2, 10, 100]), 7.0 * (1 / 2 - 1 / 100))
+
+
+def test_pixels_are_independent():
+    rng = np.random.default_rng(4)
+    damage = np.sort(rng.uniform(0, 100, size=(4, 6, 6)), axis=0)
+    return_periods = [5, 20, 100, 1000]
+    expected = np.empty((6, 6))
+    for row in range(6):
+        for col in range(6):
+            # np.trapz integrates over increasing x, the probabilities decrease with the return period
+            expected[row, col] = -np.trapz(damage[:, row, col], 1 / np.array(return_periods))
+    np.testing.assert_allclose(integrate_ead(damage, return_periods), expected)
+
+
+def write_scenario(path, depth, profile, window=None, nodata=0):
+    """
+    Writes a depth raster with the profile of the inundation raster, cut to a window of its grid.
+    """
+    with rasterio.open(INUNDATION) as src:
+        transform = src.window_transform(window) if window else src.transform
+    profile = {**profile, "width": depth.shape[1], "height": depth.shape[0], "transform": transform, "nodata": nodata}
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(depth.astype(profile["dtype"]), 1)
+    return str(path)
+
+
+@requires_land_use
+def test_scenario_smaller_than_the_grid(tmp_path):
+    with rasterio.open(INUNDATION) as src:
+        depth, profile = src.read(1), src.profile
+    profile = {key: profile[key] for key in ("driver", "dtype", "count", "crs")}
+    window = Window(40, 60, 150, 120)
+    inside = np.zeros(depth.shape, dtype=bool)
+    inside[window.toslices()] = True
+    small_depth = np.where(depth[window.toslices()] > 0, depth[window.toslices()] * 0.5, -9999)
+
+    # The same frequent scenario, once cut to a smaller extent with a negative no-data value and once on the full grid
+    small = write_scenario(tmp_path / "small.tif", small_depth, profile, window, nodata=-9999)
+    padded = write_scenario(tmp_path / "padded.tif", np.where(inside & (depth > 0), depth * 0.5, 0), profile)
+    resources = main.load_resources()
+    results = {}
+    for name, frequent in (("small", small), ("padded", padded)):
+        hazards = [{"return_period": 10, "flood_depth_file": frequent}, {"return_period": 100, "flood_depth_file": INUNDATION}]
+        (tmp_path / name).mkdir()
+        outputs = run_ead(hazards, str(tmp_path / name), -999.0, block_size=64, resources=resources)
+        with rasterio.open(outputs["ead"]) as ead, rasterio.open(outputs["risk_T10"]) as risk:
+            results[name] = ead.read(1), risk.read(1)
+
+    ead, risk = results["small"]
+    np.testing.assert_allclose(ead, results["padded"][0])
+    np.testing.assert_allclose(risk, results["padded"][1])
+    assert np.all((risk[~inside] == -999.0))
+    assert np.all((risk == -999.0) | (risk > 0))
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from conftest import requires_land_use
+import config
+import main
+from ensemble import DamageEnsemble, run_ensemble, sample_factors
+
+INUNDATION = "data/BiberachInundation.tif"
+VELOCITY = "data/BiberachVelocity.tif"
+FIXED = {"type": "fixed"}
+
+
+def test_fixed_distribution_keeps_the_point_estimate():
+    np.testing.assert_array_equal(sample_factors(FIXED, 5, np.random.default_rng(0)), np.ones(5))
+    factors = sample_factors({"type": "normal", "cv": 5.0}, 1000, np.random.default_rng(0))
+    assert factors.min() == 0  # Negative draws are clipped
+    with pytest.raises(ValueError):
+        sample_factors({"type": "beta"}, 5, np.random.default_rng(0))
+
+
+@requires_land_use
+def test_same_seed_draws_the_same_members():
+    damage_model = main.load_resources()["damage_model"]
+    distribution = config.ENSEMBLE_DAMAGE_DISTRIBUTION
+    first = DamageEnsemble(damage_model, config.LAND_USE_MAP, 8, distribution, seed=3)
+    second = DamageEnsemble(damage_model, config.LAND_USE_MAP, 8, distribution, seed=3)
+    other = DamageEnsemble(damage_model, config.LAND_USE_MAP, 8, distribution, seed=4)
+    np.testing.assert_array_equal(first.table, second.table)
+    assert not np.array_equal(first.table, other.table)
+
+
+def read(path):
+    with rasterio.open(path) as src:
+        return src.read(1)
+
+
+@requires_land_use
+@pytest.mark.parametrize("velocity_file", [None, VELOCITY])
+def test_fixed_ensemble_matches_the_single_run(tmp_path, monkeypatch, velocity_file):
+    monkeypatch.setattr(config, "RESAMPLE_CACHE_DIR", None)
+    monkeypatch.setattr(config, "ARTIFACT_STORE_DIR", None)
+    monkeypatch.setattr(config, "PROFILER", None)
+    monkeypatch.setattr(config, "ENSEMBLE_DAMAGE_DISTRIBUTION", FIXED)
+    monkeypatch.setattr(config, "ENSEMBLE_THRESHOLD_DISTRIBUTION", FIXED)
+    inputs = {"return_period": 100, "no_data_value": -999.0, "flood_depth_file": INUNDATION,
+              "velocity_file": velocity_file, "generate_pdf": False, "block_size": 64}
+    (tmp_path / "single").mkdir()
+    (tmp_path / "ensemble").mkdir()
+    single = main.run_analysis({**inputs, "output_dir": str(tmp_path / "single")})
+    # Small strips, so the members of a block are split over several strips and chunks
+    ensemble = run_ensemble({**inputs, "output_dir": str(tmp_path / "ensemble")}, members=5, chunk_size=2,
+                            memory_mb=0.01)
+
+    # Every member is the point estimate, so the mean and the percentiles are the risk of the single run
+    risk = read(single["risk"])
+    assert (risk > 0).any()
+    for name in ("mean", "p5", "p50", "p95"):
+        np.testing.assert_allclose(read(ensemble[name]), risk, rtol=1e-5)
+
+    members = pd.read_csv(ensemble["members"])
+    np.testing.assert_allclose(members["Total Risk"], risk[risk > 0].sum(), rtol=1e-5)
+    land_use_risk = pd.read_csv(ensemble["land_use_risk"]).set_index("Land Use Class")
+    assert land_use_risk.loc["All", "Pixel Count"] == (risk > 0).sum()
+    np.testing.assert_allclose(land_use_risk.loc["All", "Mean Total Risk"], risk[risk > 0].sum(), rtol=1e-5)
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from scipy import ndimage
+from hotspots import HotspotStatistics, find_hotspots, write_label_raster
+
+THRESHOLD = 0.6
+NO_DATA = -999.0
+
+
+@pytest.fixture
+def risk_path(tmp_path):
+    # Smoothed noise gives irregular areas that cross the seams of every block size, including diagonal contacts
+    rng = np.random.default_rng(5)
+    risk = ndimage.uniform_filter(rng.uniform(0, 1, size=(61, 47)), 3)
+    risk = (risk - risk.min()) / (risk.max() - risk.min())
+    risk[:3, :3] = NO_DATA
+    path = tmp_path / "risk.tif"
+    with rasterio.open(path, "w", driver="GTiff", width=47, height=61, count=1, dtype="float64", nodata=NO_DATA,
+                       crs="EPSG:3857", transform=from_origin(1000, 2000, 10, 10)) as dst:
+        dst.write(risk, 1)
+    return path, risk
+
+
+def resolve(path, block_size, connectivity=8, land_use=None, land_use_nodata=None):
+    statistics, offsets = find_hotspots(path, THRESHOLD, land_use, land_use_nodata, connectivity, block_size)
+    table, ranks = statistics.resolve()
+    labels_path = path.parent / f"labels_{block_size}_{connectivity}.tif"
+    write_label_raster(path, labels_path, ranks, offsets, THRESHOLD, connectivity, block_size)
+    with rasterio.open(labels_path) as src:
+        return table, src.read(1)
+
+
+def test_merge_labels_joins_chains():
+    statistics = HotspotStatistics(from_origin(0, 0, 1, 1))
+    statistics.label_count = 7
+    statistics.add_pairs([[2, 5], [5, 7], [4, 3]])
+    statistics.add_pairs([[7, 6]])
+    parent = statistics.merge_labels()
+    np.testing.assert_array_equal(parent, [0, 1, 2, 3, 3, 2, 2, 2])
+
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+def test_whole_raster_matches_scipy(risk_path, connectivity):
+    path, risk = risk_path
+    table, labels = resolve(path, None, connectivity)
+    structure = np.ones((3, 3)) if connectivity == 8 else None
+    expected, count = ndimage.label((risk >= THRESHOLD) & (risk != NO_DATA), structure)
+    assert len(table) == count
+    pixel_counts = np.bincount(expected.ravel())[1:]
+    assert sorted(table["Pixel Count"]) == sorted(pixel_counts)
+    assert table["Total Risk"].is_monotonic_decreasing
+    # Every hotspot of the label raster is one component of scipy's labels
+    for rank in table["Rank"]:
+        assert np.unique(expected[labels == rank]).size == 1
+
+
+@pytest.mark.parametrize("connectivity", [4, 8])
+@pytest.mark.parametrize("block_size", [0, 5, 8, 16, 23])
+def test_seams_are_merged(risk_path, block_size, connectivity):
+    path, _ = risk_path
+    whole_table, whole_labels = resolve(path, None, connectivity)
+    table, labels = resolve(path, block_size, connectivity)
+    pd.testing.assert_frame_equal(table, whole_table)
+    np.testing.assert_array_equal(labels, whole_labels)
+
+
+def test_land_use_nodata_is_not_a_class(risk_path):
+    path, risk = risk_path
+    land_use = np.where(np.arange(risk.shape[1]) % 3 == 0, 255, 2).astype(np.uint8)[None, :].repeat(risk.shape[0], 0)
+    table, _ = resolve(path, 8, land_use=land_use, land_use_nodata=255)
+    # Hotspots only on no-data columns have no dominant class
+    assert set(table["Dominant Land Use"].dropna()) == {2}
+    assert table["Dominant Land Use"].isna().any()
+    with_nodata, _ = resolve(path, 8, land_use=land_use)
+    assert 255 in set(with_nodata["Dominant Land Use"])
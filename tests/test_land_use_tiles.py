@@ -0,0 +1,64 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+from land_use_tiles import TileIndex, prepare_land_use, verify_prepared
+
+NO_DATA = -128
+# 300 x 400 pixels of 100 m, tiles of 128 pixels
+LEFT, TOP, SIZE = 4200000.0, 2900000.0, 100.0
+
+
+def write_land_use(path):
+    land_use = np.full((300, 400), 11, dtype=np.int8)
+    land_use[:, 200:] = 23
+    land_use[150:, 300:] = 41
+    land_use[:128, :128] = NO_DATA  # The first tile has no data
+    with rasterio.open(path, "w", driver="GTiff", width=400, height=300, count=1, dtype="int8", crs="EPSG:3035",
+                       transform=from_origin(LEFT, TOP, SIZE, SIZE), nodata=NO_DATA) as dst:
+        dst.write(land_use, 1)
+    return land_use
+
+
+def test_prepared_copy_is_exact(tmp_path):
+    source = str(tmp_path / "land_use.tif")
+    land_use = write_land_use(source)
+    prepared = prepare_land_use(source, tile_size=128)
+
+    assert prepared == str(tmp_path / "land_use_tiled.tif")
+    assert verify_prepared(source, prepared) == 0
+    with rasterio.open(prepared) as src:
+        np.testing.assert_array_equal(src.read(1), land_use)
+        assert src.block_shapes[0] == (128, 128)
+        assert src.overviews(1) == [2, 4]
+        assert src.tags(ns="rio_overview")["resampling"] == "mode"
+        # Mode overviews keep the classes, there are no averaged values
+        assert set(np.unique(src.read(1, out_shape=(75, 100)))) <= {NO_DATA, 11, 23, 41}
+
+
+def test_tile_index(tmp_path):
+    source = str(tmp_path / "land_use.tif")
+    write_land_use(source)
+    index = TileIndex.load(prepare_land_use(source, tile_size=128))
+
+    assert len(index.tiles) == 3 * 4
+    # Inside the first tile there is only no-data
+    first_tile = (LEFT + 1000, TOP - 5000, LEFT + 5000, TOP - 1000)
+    assert not index.has_data(first_tile)
+    assert index.classes(first_tile) == []
+    # The lower right corner has the classes 23 and 41, also for a bounding box in another CRS
+    corner = (LEFT + 30500, TOP - 29500, LEFT + 39500, TOP - 15500)
+    assert index.classes(corner) == [23, 41]
+    corner_4326 = transform_bounds("EPSG:3035", "EPSG:4326", *corner)
+    assert set(index.classes(corner_4326, crs="EPSG:4326")) >= {23, 41}
+
+
+def test_outdated_index_is_not_used(tmp_path):
+    source = str(tmp_path / "land_use.tif")
+    write_land_use(source)
+    prepared = prepare_land_use(source, tile_size=128)
+    with rasterio.open(prepared, "r+") as dst:
+        dst.write(np.full((1, 10, 10), 11, dtype=np.int8), window=((0, 10), (0, 10)))
+
+    assert TileIndex.load(prepared) is None
+    assert TileIndex.load(str(tmp_path / "missing.tif")) is None
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+from conftest import requires_land_use
+import config
+from mosaic import combine_overlaps, run_mosaic, union_grid
+
+INUNDATION = "data/BiberachInundation.tif"
+
+
+def test_overlap_rules():
+    first = (np.array([[1.0, 2.0, 0.0]]), np.array([[True, True, False]]))
+    second = (np.array([[3.0, 1.0, 0.0]]), np.array([[True, True, False]]))
+    only_second = (np.array([[5.0, 0.0, 0.0]]), np.array([[True, False, False]]))
+
+    values, covered = combine_overlaps([first, second], "max")
+    np.testing.assert_array_equal(values, [[3.0, 2.0, 0.0]])
+    np.testing.assert_array_equal(covered, [[True, True, False]])
+    np.testing.assert_array_equal(combine_overlaps([first, second], "first")[0], [[1.0, 2.0, 0.0]])
+    np.testing.assert_array_equal(combine_overlaps([first, second], "mean")[0], [[2.0, 1.5, 0.0]])
+    # A tile without data at a pixel does not count for the mean
+    np.testing.assert_array_equal(combine_overlaps([first, only_second], "mean")[0], [[3.0, 2.0, 0.0]])
+    with pytest.raises(ValueError):
+        combine_overlaps([first], "min")
+
+
+def write_tile(path, window, scale=1.0):
+    """
+    Writes a window of the inundation raster as a hazard tile, with its depths multiplied by scale.
+    """
+    with rasterio.open(INUNDATION) as src:
+        depth = src.read(1, window=window)
+        profile = {**src.profile, "width": window.width, "height": window.height,
+                   "transform": src.window_transform(window)}
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write((depth * scale).astype(profile["dtype"]), 1)
+    return {"flood_depth_file": str(path)}
+
+
+def mosaic_risk(output_dir, tiles, overlap):
+    output_dir.mkdir()
+    outputs = run_mosaic(tiles, str(output_dir), 100, -999.0, overlap=overlap, block_size=64, workers=1)
+    with rasterio.open(outputs["risk"]) as src:
+        return src.read(1)
+
+
+@pytest.fixture
+def tiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "RESAMPLE_CACHE_DIR", None)
+    with rasterio.open(INUNDATION) as src:
+        width, height = src.width, src.height
+    # Two tiles overlapping on the columns 120 to 180, the right one twice as deep
+    left = write_tile(tmp_path / "left.tif", Window(0, 0, 180, height))
+    right = write_tile(tmp_path / "right.tif", Window(120, 0, width - 120, height), scale=2.0)
+    full = {"flood_depth_file": INUNDATION}
+    return left, right, full
+
+
+def test_union_grid_of_overlapping_tiles(tiles):
+    left, right, full = tiles
+    grid = union_grid([left["flood_depth_file"], right["flood_depth_file"]])
+    with rasterio.open(INUNDATION) as src:
+        assert grid.shape == (src.height, src.width)
+        np.testing.assert_allclose(tuple(grid.transform), tuple(src.transform))
+
+
+@requires_land_use
+def test_mosaic_overlap_rules(tmp_path, tiles):
+    left, right, full = tiles
+    overlap = np.s_[:, 120:180]
+
+    first = mosaic_risk(tmp_path / "first", [left, right], "first")
+    maximum = mosaic_risk(tmp_path / "max", [left, right], "max")
+    right_first = mosaic_risk(tmp_path / "right_first", [right, left], "first")
+    mean = mosaic_risk(tmp_path / "mean", [left, right], "mean")
+    original = mosaic_risk(tmp_path / "original", [full], "first")
+
+    # With "first" the left tile wins the overlap, so the left part is the risk of the original inundation
+    np.testing.assert_allclose(first[:, :180], original[:, :180])
+    assert (original[overlap] > 0).any()
+    # The damage grows with the depth, so the largest value comes from the deeper right tile
+    np.testing.assert_allclose(maximum, right_first)
+    assert (maximum[overlap] > first[overlap]).any()
+    # Outside of the overlap every rule gives the value of the only tile
+    outside = np.ones(first.shape, dtype=bool)
+    outside[overlap] = False
+    np.testing.assert_allclose(mean[outside], maximum[outside])
+    # The mean of the two damages lies between them
+    valid = first[overlap] > 0
+    assert np.all(mean[overlap][valid] >= first[overlap][valid] - 1e-9)
+    assert np.all(mean[overlap][valid] <= maximum[overlap][valid] + 1e-9)
@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import config
+import main
+
+INUNDATION = "data/BiberachInundation.tif"
+VELOCITY = "data/BiberachVelocity.tif"
+
+pytestmark = pytest.mark.skipif(
+    not os.path.exists(os.path.join(os.path.dirname(os.path.dirname(__file__)), config.LAND_USE_PATH)),
+    reason="the CORINE land use raster is not in data/Project_Files"
+)
+
+
+def run(output_dir, block_size, velocity_file=VELOCITY):
+    output_dir.mkdir()
+    inputs = {"return_period": 100, "no_data_value": -999.0, "flood_depth_file": INUNDATION,
+              "velocity_file": velocity_file, "output_dir": str(output_dir), "generate_pdf": False,
+              "block_size": block_size}
+    outputs = main.run_analysis(inputs)
+    with rasterio.open(outputs["risk"]) as src:
+        risk = src.read(1)
+    return risk, pd.read_csv(outputs["summary"]), pd.read_csv(outputs["land_use_risk"])
+
+
+@pytest.fixture(autouse=True)
+def no_caches(monkeypatch):
+    monkeypatch.setattr(config, "RESAMPLE_CACHE_DIR", None)
+    monkeypatch.setattr(config, "ARTIFACT_STORE_DIR", None)
+    monkeypatch.setattr(config, "PROFILER", None)
+
+
+@pytest.mark.parametrize("velocity_file", [None, VELOCITY])
+@pytest.mark.parametrize("block_size", [0, 64, 100])
+def test_block_streaming_matches_in_memory(tmp_path, block_size, velocity_file):
+    risk, summary, land_use_risk = run(tmp_path / "memory", None, velocity_file)
+    streamed_risk, streamed_summary, streamed_land_use_risk = run(tmp_path / "blocks", block_size, velocity_file)
+
+    np.testing.assert_array_equal(streamed_risk, risk)
+    assert (risk > 0).any()
+    pd.testing.assert_frame_equal(streamed_summary, summary, rtol=1e-9)
+    pd.testing.assert_frame_equal(streamed_land_use_risk, land_use_risk, rtol=1e-9)
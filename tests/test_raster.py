@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from raster import Raster, _open_output, overview_factors, resolve_output_profile
+
+NO_DATA = -999.0
+SHAPE = (700, 600)
+
+
+@pytest.fixture
+def risk():
+    rng = np.random.default_rng(2)
+    values = rng.uniform(0, 100, size=SHAPE)
+    values[rng.uniform(size=SHAPE) < 0.9] = NO_DATA  # Like a flood, most pixels have no risk
+    return values
+
+
+def write(path, data, profile, block_size=None):
+    """
+    Writes an array through _open_output, window by window like the block-streaming pipeline.
+    """
+    with _open_output(str(path), data.shape, data.dtype, "EPSG:3857", from_origin(1000, 2000, 15, 15), NO_DATA, profile) as dst:
+        if block_size is None:
+            dst.write(data, 1)
+            return
+        grid = Raster(file_path=None)
+        grid.shape = data.shape
+        for window in grid.iter_windows(block_size):
+            dst.write(data[window.toslices()], 1, window=window)
+
+
+@pytest.mark.parametrize("profile", ["plain", "compressed", "cog"])
+def test_lossless_profiles_round_trip(tmp_path, risk, profile):
+    path = tmp_path / f"{profile}.tif"
+    write(path, risk, profile, block_size=128)
+    with rasterio.open(path) as src:
+        np.testing.assert_array_equal(src.read(1), risk)
+        assert src.nodata == NO_DATA
+        assert src.dtypes[0] == "float64"
+        overviews = src.overviews(1)
+    assert overviews == ([] if profile == "plain" else overview_factors(SHAPE))
+    assert sorted(os.listdir(tmp_path)) == [f"{profile}.tif"]  # No temporary COG file is left
+
+
+def test_compressed_layout(tmp_path, risk):
+    write(tmp_path / "plain.tif", risk, "plain")
+    write(tmp_path / "compressed.tif", risk, "compressed")
+    with rasterio.open(tmp_path / "compressed.tif") as src:
+        assert src.compression.value == "DEFLATE"
+        assert src.profile["tiled"] and src.block_shapes[0] == (256, 256)
+        assert src.tags(ns="rio_overview")["resampling"] == "average"
+    assert os.path.getsize(tmp_path / "compressed.tif") < os.path.getsize(tmp_path / "plain.tif")
+
+
+def test_cog_layout(tmp_path, risk):
+    write(tmp_path / "cog.tif", risk, "cog")
+    with rasterio.open(tmp_path / "cog.tif") as src:
+        assert src.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert src.compression.value == "DEFLATE"
+
+
+def test_compact_profile_stores_float32(tmp_path, risk):
+    write(tmp_path / "compact.tif", risk, "compact")
+    with rasterio.open(tmp_path / "compact.tif") as src:
+        assert src.dtypes[0] == "float32"
+        np.testing.assert_array_equal(src.read(1), risk.astype(np.float32))
+
+
+def test_failed_cog_leaves_no_files(tmp_path, risk):
+    path = tmp_path / "cog.tif"
+    with pytest.raises(RuntimeError):
+        with _open_output(str(path), SHAPE, risk.dtype, "EPSG:3857", from_origin(1000, 2000, 15, 15), NO_DATA, "cog"):
+            raise RuntimeError("the run was cancelled")
+    assert os.listdir(tmp_path) == []
+
+
+def test_profile_options():
+    assert resolve_output_profile({"compress": "lzw"})["tiled"] is False
+    with pytest.raises(ValueError):
+        resolve_output_profile("webp")
+    with pytest.raises(ValueError):
+        resolve_output_profile({"quality": 90})
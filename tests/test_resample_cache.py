@@ -0,0 +1,71 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from raster import Raster
+from resample_cache import ResampleCache
+
+
+def write_raster(path, data, transform, nodata=None):
+    with rasterio.open(path, "w", driver="GTiff", width=data.shape[1], height=data.shape[0], count=1, dtype=data.dtype,
+                       crs="EPSG:3857", transform=transform, nodata=nodata) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+
+def make_inputs(tmp_path):
+    rng = np.random.default_rng(6)
+    source = write_raster(tmp_path / "land_use.tif", rng.integers(1, 45, size=(80, 90), dtype=np.uint8),
+                          from_origin(1000, 2000, 20, 20), nodata=48)
+    target = write_raster(tmp_path / "inundation.tif", np.zeros((100, 70), dtype=np.float32), from_origin(1105, 1905, 15, 15))
+    return source, Raster(target)
+
+
+def test_hit_returns_the_resampled_grid(tmp_path):
+    source, target = make_inputs(tmp_path)
+    cache = ResampleCache(str(tmp_path / "cache"))
+    first = cache.fetch(target, source, Resampling.nearest, block_size=32)
+    second = cache.fetch(target, source, Resampling.nearest)
+    assert (cache.misses, cache.hits) == (1, 1)
+    expected = target.resample_raster(source, resampling=Resampling.nearest)
+    np.testing.assert_array_equal(first, expected)
+    np.testing.assert_array_equal(second, expected)
+
+    # Another resampling method is another grid
+    cache.fetch(target, source, Resampling.mode)
+    assert cache.misses == 2
+
+
+def test_changed_source_invalidates_the_grid(tmp_path):
+    source, target = make_inputs(tmp_path)
+    cache = ResampleCache(str(tmp_path / "cache"))
+    cache.fetch(target, source, Resampling.nearest)
+    write_raster(source, np.full((80, 90), 7, dtype=np.uint8), from_origin(1000, 2000, 20, 20), nodata=48)
+    grid = cache.fetch(target, source, Resampling.nearest)
+    assert cache.misses == 2
+    assert set(np.unique(grid)) <= {7, 48}
+
+    assert cache.clear() == 2
+    cache.fetch(target, source, Resampling.nearest)
+    assert cache.misses == 3
+
+
+def hash_files(cache_dir, paths):
+    cache = ResampleCache(cache_dir)
+    return [cache._file_hash(path) for path in paths]
+
+
+def test_concurrent_processes_keep_every_hash(tmp_path):
+    paths = []
+    for index in range(24):
+        paths.append(str(tmp_path / f"file_{index}.bin"))
+        with open(paths[-1], "wb") as f:
+            f.write(os.urandom(1000 + index))
+    cache_dir = str(tmp_path / "cache")
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(hash_files, [cache_dir] * 4, [paths[index::4] for index in range(4)]))
+    with open(os.path.join(cache_dir, "hashes.json")) as f:
+        assert set(json.load(f)) == {os.path.abspath(path) for path in paths}
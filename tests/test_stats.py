@@ -0,0 +1,36 @@
+import numpy as np
+from stats import StreamingStats
+
+
+def test_sketch_matches_exact_statistics():
+    values = np.random.default_rng(1).lognormal(0, 1.5, size=200_000)
+    values[::97] = np.nan
+    stats = StreamingStats(relative_error=0.001)
+    for block in np.array_split(values, 37):
+        stats.update(block)
+
+    assert stats.exact_counts is None  # Too many distinct values, the median comes from the sketch
+    assert stats.count == np.count_nonzero(~np.isnan(values))
+    np.testing.assert_allclose(stats.mean, np.nanmean(values))
+    np.testing.assert_allclose(stats.std, np.nanstd(values))
+    assert stats.min == np.nanmin(values) and stats.max == np.nanmax(values)
+    assert abs(stats.median - np.nanmedian(values)) <= 0.001 * np.nanmedian(values)
+
+
+def test_few_distinct_values_give_the_exact_median():
+    values = np.random.default_rng(2).integers(0, 44, size=50_001).astype(np.float64)
+    stats = StreamingStats()
+    for block in np.array_split(values, 5):
+        stats.update(block)
+    assert stats.exact_counts is not None
+    assert stats.median == np.median(values)
+
+
+def test_merge_equals_single_pass():
+    values = np.random.default_rng(3).normal(10, 3, size=30_000)
+    single = StreamingStats().update(values)
+    merged = StreamingStats().update(values[:12_345]).merge(StreamingStats().update(values[12_345:]))
+    assert merged.count == single.count
+    np.testing.assert_allclose([merged.mean, merged.std], [single.mean, single.std])
+    assert merged.min == single.min and merged.max == single.max
+    assert merged.median == single.median
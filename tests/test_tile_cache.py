@@ -0,0 +1,84 @@
+import itertools
+from io import BytesIO
+import numpy as np
+import pytest
+from PIL import Image
+import tile_cache
+from tile_cache import TileCache, is_public_tile_server, lower_zoom_tile
+
+TILE_BYTES = 999
+
+
+class CountingSource:
+    """
+    A tile source that serves a fixed tile and counts the requests.
+    """
+    def __init__(self):
+        self.requests = 0
+
+    def get_tile(self, z, x, y):
+        self.requests += 1
+        return bytes([z, x % 256, y % 256]) * (TILE_BYTES // 3)
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # Every access gets a later time, so the LRU order does not depend on the resolution of the system clock
+    ticks = itertools.count(1)
+    monkeypatch.setattr(tile_cache.time, "time", lambda: float(next(ticks)))
+
+
+def cached(cache):
+    with cache._connect() as db:
+        return {(z, x, 2 ** z - 1 - row) for z, x, row in db.execute("SELECT zoom_level, tile_column, tile_row FROM tiles")}
+
+
+def test_least_recently_used_tiles_are_evicted(tmp_path):
+    # Room for three tiles
+    cache = TileCache(str(tmp_path / "tiles.mbtiles"), max_size_mb=3.5 * TILE_BYTES / 1024 / 1024)
+    source = CountingSource()
+    for x in range(3):
+        cache.put_tile(10, x, 5, source.get_tile(10, x, 5))
+    assert cache.cached_tile(10, 0, 5) is not None  # Tile 0 becomes the most recently used
+
+    cache.put_tile(10, 3, 5, source.get_tile(10, 3, 5))
+    assert cached(cache) == {(10, 0, 5), (10, 2, 5), (10, 3, 5)}
+    assert cache.size()[1] <= cache.max_size
+
+
+def test_missing_tiles_are_fetched_once(tmp_path):
+    source = CountingSource()
+    cache = TileCache(str(tmp_path / "tiles.mbtiles"), source=source)
+    first = cache.get_tile(12, 2100, 1400)
+    assert cache.get_tile(12, 2100, 1400) == first
+    assert (cache.hits, cache.misses, source.requests) == (1, 1, 1)
+
+    # Without a source only cached tiles are returned
+    offline = TileCache(str(tmp_path / "tiles.mbtiles"))
+    assert offline.get_tile(12, 2100, 1400) == first
+    assert offline.get_tile(12, 2101, 1400) is None
+    assert cache.clear() == 1
+
+
+def test_missing_tile_is_cut_from_a_lower_zoom_level(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.mbtiles"))
+    parent = np.zeros((256, 256, 4), dtype=np.uint8)
+    parent[:128, 128:] = (255, 0, 0, 255)  # Top right quarter
+    buffer = BytesIO()
+    Image.fromarray(parent).save(buffer, format="png")
+    cache.put_tile(9, 100, 200, buffer.getvalue())
+
+    # Tile (201, 400) of zoom 10 is the top right quarter of tile (100, 200) of zoom 9
+    tile = lower_zoom_tile(cache, 10, 201, 400)
+    assert tile.shape == (256, 256, 4)
+    assert (tile[..., 0] == 255).all()
+    assert lower_zoom_tile(cache, 10, 200, 401)[..., 3].max() == 0
+    assert lower_zoom_tile(cache, 10, 0, 0) is None
+
+
+def test_public_tile_servers():
+    assert is_public_tile_server("https://tile.openstreetmap.org/{z}/{x}/{y}.png")
+    assert is_public_tile_server("https://a.tile.openstreetmap.org/{z}/{x}/{y}.png")
+    assert not is_public_tile_server("https://tiles.example.org/{z}/{x}/{y}.png")
+    assert not is_public_tile_server("data/basemap.mbtiles")
+    assert not is_public_tile_server(None)
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import signal
+from conftest import requires_land_use
+from worker import RiskWorker
+
+
+def scenario(output_dir):
+    return {"flood_depth_file": "data/BiberachInundation.tif", "return_period": 100, "no_data_value": -999,
+            "output_dir": str(output_dir), "block_size": 32}
+
+
+async def wait_for(condition, timeout=120):
+    for _ in range(int(timeout / 0.02)):
+        if condition():
+            return
+        await asyncio.sleep(0.02)
+    raise TimeoutError
+
+
+async def get(worker, path):
+    reader = asyncio.StreamReader()
+    reader.feed_data(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    reader.feed_eof()
+    return await worker._route(reader)
+
+
+def test_health_reports_a_broken_pool():
+    worker = RiskWorker(processes=1)
+    worker.pool_status = "broken"
+    code, body = asyncio.run(get(worker, "/health"))
+    assert code == 503 and body["pool"] == "broken"
+
+
+@requires_land_use
+def test_pool_is_restarted_after_a_worker_process_died(tmp_path):
+    async def run():
+        worker = RiskWorker(processes=1, queue_size=4)
+        await worker.start()
+        try:
+            assert (await get(worker, "/health"))[0] == 200
+            killed = worker.submit(scenario(tmp_path / "killed"))
+            await wait_for(lambda: killed["status"] == "running")
+            os.kill(next(iter(worker.executor._processes)), signal.SIGKILL)
+            await wait_for(lambda: killed["finished"])
+            assert killed["status"] == "failed" and "BrokenProcessPool" in killed["error"]
+
+            await wait_for(lambda: worker.pool_status == "ready")
+            job = worker.submit(scenario(tmp_path / "after"))
+            await wait_for(lambda: job["finished"])
+            assert job["status"] == "ok", job["error"]
+            code, health = await get(worker, "/health")
+            assert code == 200 and health["restarts"] == 1 and health["failed"] == 1 and health["ok"] == 1
+        finally:
+            worker.stop()
+
+    asyncio.run(run())
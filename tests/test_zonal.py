@@ -0,0 +1,98 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from artifact_store import ArtifactStore
+from raster import Raster
+from zonal import ZoneIndex, aggregate_risk, run_zonal
+
+NO_DATA = -999.0
+# 60 x 80 pixels of 10 m, the two zones split the grid at column 40 and leave the last 10 rows outside
+LEFT, TOP, SIZE = 500000.0, 5400000.0, 10.0
+
+
+def box(left, bottom, right, top):
+    return {"type": "Polygon", "coordinates": [[[left, bottom], [right, bottom], [right, top], [left, top], [left, bottom]]]}
+
+
+@pytest.fixture
+def risk_path(tmp_path):
+    rng = np.random.default_rng(1)
+    risk = rng.uniform(0, 5, size=(60, 80))
+    risk[rng.uniform(size=risk.shape) < 0.3] = NO_DATA
+    path = tmp_path / "risk.tif"
+    with rasterio.open(path, "w", driver="GTiff", width=80, height=60, count=1, dtype="float64", crs="EPSG:32632",
+                       transform=from_origin(LEFT, TOP, SIZE, SIZE), nodata=NO_DATA) as dst:
+        dst.write(risk, 1)
+    return str(path)
+
+
+@pytest.fixture
+def zones_path(tmp_path):
+    bottom = TOP - 500
+    features = [
+        {"type": "Feature", "properties": {"name": "west"}, "geometry": box(LEFT, bottom, LEFT + 400, TOP)},
+        {"type": "Feature", "properties": {"name": "east"}, "geometry": box(LEFT + 400, bottom, LEFT + 800, TOP)},
+    ]
+    path = tmp_path / "zones.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "crs": {"properties": {"name": "EPSG:32632"}},
+                                "features": features}))
+    return str(path)
+
+
+def read_risk(path):
+    with rasterio.open(path) as src:
+        risk = src.read(1)
+    return np.where(risk == NO_DATA, 0, risk)
+
+
+@pytest.mark.parametrize("block_size", [0, 16])
+def test_zone_totals_add_up_to_the_risk_sum(risk_path, zones_path, block_size):
+    risk = read_risk(risk_path)
+    zone_index = ZoneIndex.from_vector(zones_path, Raster(risk_path), id_field="name")
+    statistics = aggregate_risk(risk_path, zone_index, block_size=block_size)
+    table = statistics.to_dataframe().set_index("Zone")
+
+    np.testing.assert_allclose(table.loc["west", "Total Risk"], risk[:50, :40].sum())
+    np.testing.assert_allclose(table.loc["east", "Total Risk"], risk[:50, 40:].sum())
+    assert table.loc["west", "Pixel Count"] == (risk[:50, :40] > 0).sum()
+    # Zone number 0 holds the risk outside of all zones, together they are the whole risk raster
+    np.testing.assert_allclose(statistics.sums.sum(), risk.sum())
+    np.testing.assert_allclose(statistics.sums[0], risk[50:].sum())
+
+
+def test_crosstab_matches_the_zone_totals(risk_path, zones_path):
+    land_use = np.tile(np.array([11, 23], dtype=np.int16).repeat(40), (60, 1))
+    land_use[::7] = -128  # No-data of the land use
+    zone_index = ZoneIndex.from_vector(zones_path, Raster(risk_path), id_field="name")
+    statistics = aggregate_risk(risk_path, zone_index, land_use, land_use_nodata=-128, block_size=16)
+    crosstab = statistics.crosstab_dataframe().set_index("Zone")
+
+    risk = read_risk(risk_path)
+    assert list(crosstab.columns) == [11, 23]
+    np.testing.assert_allclose(crosstab.loc["west", 11], risk[:50, :40][land_use[:50, :40] == 11].sum())
+    assert crosstab.loc["west", 23] == 0
+    np.testing.assert_allclose(crosstab.loc["east", 23], risk[:50, 40:][land_use[:50, 40:] == 23].sum())
+
+
+def test_cached_zones_match_the_rasterized_zones(tmp_path, risk_path, zones_path):
+    cache = ArtifactStore(str(tmp_path / "cache"), 64)
+    direct = ZoneIndex.from_vector(zones_path, Raster(risk_path), id_field="name")
+    stored = ZoneIndex.from_vector(zones_path, Raster(risk_path), id_field="name", cache=cache)
+    loaded = ZoneIndex.from_vector(zones_path, Raster(risk_path), id_field="name", cache=cache)
+
+    np.testing.assert_array_equal(stored.zones, direct.zones)
+    np.testing.assert_array_equal(loaded.zones, direct.zones)
+    assert loaded.zone_ids == ["west", "east"]
+    assert (cache.hits, cache.misses) == ({"zones": 1}, {"zones": 1})
+
+
+def test_run_zonal_saves_one_table_per_layer(tmp_path, risk_path, zones_path):
+    layers = [{"name": "district", "path": zones_path, "id_field": "name"}, {"name": "numbered", "path": zones_path}]
+    paths = run_zonal(risk_path, layers, str(tmp_path))
+    assert sorted(paths) == ["zonal_district", "zonal_numbered"]
+    numbered = pd.read_csv(paths["zonal_numbered"])
+    assert list(numbered["Zone"]) == [1, 2]
+    np.testing.assert_allclose(numbered["Total Risk"].sum(), read_risk(risk_path)[:50].sum())
@@ -0,0 +1,470 @@
+import argparse
+import math
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from urllib.parse import urlsplit
+import numpy as np
+import requests
+from PIL import Image
+import rasterio
+from rasterio.warp import transform_bounds
+import config
+
+# Half the width of the Web Mercator (EPSG:3857) world in meters
+MERCATOR_HALF_WORLD = 20037508.342789244
+TILE_SIZE = 256
+# Servers whose tile usage policy forbids bulk downloads, e.g. seeding the tiles of the whole state
+PUBLIC_TILE_HOSTS = ("tile.openstreetmap.org",)
+
+
+class UrlTileSource:
+    """
+    A tile source that downloads XYZ tiles from a tile server, e.g. OpenStreetMap or a local server
+    """
+    def __init__(self, url_template, timeout=10):
+        """
+        Initializes the UrlTileSource object.
+
+        :param url_template: URL with {z}, {x} and {y} placeholders
+        :param timeout: Timeout of each request in seconds
+        """
+        self.url_template = url_template
+        self.timeout = timeout
+        self.session = requests.Session()
+        # The OpenStreetMap tile usage policy requires an identifying User-Agent
+        self.session.headers["User-Agent"] = "Flood-Risk-Analysis-Tool"
+        self.offline = False  # Set after a connection error, so a node without network does not wait for every tile
+
+    def get_tile(self, z, x, y):
+        """
+        Downloads one tile. Errors do not stop the report, the tile is missing instead.
+
+        :return: The encoded tile image as bytes, or None if the server has no such tile or cannot be reached
+        """
+        if self.offline:
+            return None
+        try:
+            response = self.session.get(self.url_template.format(z=z, x=x, y=y), timeout=self.timeout)
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                self.offline = True
+                print(f"Warning: tile server not reachable, only cached basemap tiles are used ({type(e).__name__})")
+            else:
+                print(f"Warning: basemap tile {z}/{x}/{y} could not be downloaded ({e})")
+            return None
+        return response.content
+
+
+class DirectoryTileSource:
+    """
+    A tile source that reads XYZ tiles from a folder, e.g. tiles exported from a tile server as {z}/{x}/{y}.png
+    """
+    def __init__(self, root, pattern="{z}/{x}/{y}.png"):
+        """
+        Initializes the DirectoryTileSource object.
+
+        :param root: Folder of the tiles
+        :param pattern: Path of a tile relative to the folder, with {z}, {x} and {y} placeholders
+        """
+        self.root = root
+        self.pattern = pattern
+
+    def get_tile(self, z, x, y):
+        """
+        Reads one tile.
+
+        :return: The encoded tile image as bytes, or None if the file does not exist
+        """
+        path = os.path.join(self.root, self.pattern.format(z=z, x=x, y=y))
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class MBTilesSource:
+    """
+    A tile source that reads tiles from an existing MBTiles file, e.g. one exported by a tile server or QGIS
+    """
+    def __init__(self, path):
+        """
+        Initializes the MBTilesSource object.
+
+        :param path: Path to the .mbtiles file
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"MBTiles file not found: {path}")
+        self.path = path
+
+    def get_tile(self, z, x, y):
+        """
+        Reads one tile.
+
+        :return: The encoded tile image as bytes, or None if the file has no such tile
+        """
+        db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            row = db.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                             (z, x, 2 ** z - 1 - y)).fetchone()
+        finally:
+            db.close()
+        return row[0] if row else None
+
+
+class TileCache:
+    """
+    A class for keeping basemap tiles in an MBTiles (SQLite) file, so reports over the same area do not download
+    them again and can be generated without network access. Tiles that are not cached are taken from the tile source.
+    """
+    def __init__(self, path, max_size_mb=1024, source=None):
+        """
+        Initializes the TileCache object and creates the MBTiles file if needed.
+
+        :param path: Path to the .mbtiles file
+        :param max_size_mb: Size limit of the stored tiles in megabytes, the least recently used tiles are removed above it
+        :param source: Tile source with a get_tile(z, x, y) method (see tile_source()), or None to only use cached tiles
+        """
+        self.path = path
+        self.max_size = max_size_mb * 1024 * 1024
+        self.source = source
+        self.hits = 0
+        self.misses = 0
+        self._stored_size = None  # Running total of the tile sizes, so an insert does not scan the whole table
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")  # Several batch workers can read while one writes
+            db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            # The MBTiles columns plus the last access time for the LRU eviction
+            db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+                       "tile_data BLOB, last_used REAL, PRIMARY KEY (zoom_level, tile_column, tile_row))")
+            db.execute("INSERT OR IGNORE INTO metadata VALUES ('name', 'basemap'), ('format', 'png')")
+
+    @classmethod
+    def from_config(cls):
+        """
+        Creates the tile cache configured in config.BASEMAP_CACHE_PATH, with the source config.BASEMAP_SOURCE.
+        """
+        return cls(config.BASEMAP_CACHE_PATH, config.BASEMAP_CACHE_SIZE_MB, tile_source(config.BASEMAP_SOURCE))
+
+    @contextmanager
+    def _connect(self):
+        """
+        Opens the MBTiles file, commits when the block is left without an error and closes the connection.
+        """
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def cached_tile(self, z, x, y):
+        """
+        Returns one tile from the cache only, the source is not asked.
+
+        :return: The encoded tile image as bytes, or None if the tile is not cached
+        """
+        # MBTiles numbers the rows from the south (TMS), XYZ sources from the north
+        tms_y = 2 ** z - 1 - y
+        with self._connect() as db:
+            row = db.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                             (z, x, tms_y)).fetchone()
+            if row is not None:
+                db.execute("UPDATE tiles SET last_used=? WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                           (time.time(), z, x, tms_y))
+                return row[0]
+        return None
+
+    def get_tile(self, z, x, y):
+        """
+        Returns one tile, from the cache if possible, otherwise from the source (and stores it).
+
+        :return: The encoded tile image as bytes, or None if neither the cache nor the source has it
+        """
+        data = self.cached_tile(z, x, y)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        if self.source is None:
+            return None
+        data = self.source.get_tile(z, x, y)
+        if data is not None:
+            self.put_tile(z, x, y, data)
+        return data
+
+    def put_tile(self, z, x, y, data):
+        """
+        Stores one tile and removes the least recently used tiles if the cache is over its size limit.
+        """
+        with self._connect() as db:
+            if self._stored_size is None:
+                self._stored_size = db.execute("SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles").fetchone()[0]
+            db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)", (z, x, 2 ** z - 1 - y, data, time.time()))
+            self._stored_size += len(data)
+            if self._stored_size > self.max_size:
+                self._evict(db)
+
+    def _evict(self, db):
+        """
+        Removes the least recently used tiles until the cache is below its size limit.
+        """
+        # The running total can drift when tiles are replaced or other processes write, so the exact size is used here
+        total = db.execute("SELECT COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles").fetchone()[0]
+        self._stored_size = total
+        if total <= self.max_size:
+            return
+        rows = db.execute("SELECT rowid, LENGTH(tile_data) FROM tiles ORDER BY last_used").fetchall()
+        removed = []
+        for rowid, size in rows:
+            if total <= self.max_size:
+                break
+            removed.append((rowid,))
+            total -= size
+        db.executemany("DELETE FROM tiles WHERE rowid=?", removed)
+        self._stored_size = total
+
+    def prefetch(self, lonlat_bounds, min_zoom, max_zoom, workers=2):
+        """
+        Stores every tile of an area and a range of zoom levels that is not cached yet.
+
+        :param lonlat_bounds: Tuple (west, south, east, north) in degrees
+        :param min_zoom: Lowest zoom level
+        :param max_zoom: Highest zoom level
+        :param workers: Number of parallel downloads (the OpenStreetMap tile usage policy allows 2)
+        :return: Number of tiles that were fetched from the source
+        """
+        if self.source is None:
+            raise ValueError("No tile source configured, give a source (your own tile server or an .mbtiles file) to prefetch tiles.")
+        with self._connect() as db:
+            cached = set(db.execute("SELECT zoom_level, tile_column, tile_row FROM tiles"))
+        missing = [
+            (z, x, y) for z in range(min_zoom, max_zoom + 1) for x, y in tile_range(lonlat_bounds, z)
+            if (z, x, 2 ** z - 1 - y) not in cached
+        ]
+        print(f"Prefetching {len(missing)} tile(s) for zoom levels {min_zoom}-{max_zoom}")
+
+        fetched = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (z, x, y), data in zip(missing, executor.map(lambda tile: self.source.get_tile(*tile), missing)):
+                if data is not None:
+                    self.put_tile(z, x, y, data)
+                    fetched += 1
+        return fetched
+
+    def clear(self):
+        """
+        Removes all cached tiles.
+
+        :return: Number of removed tiles
+        """
+        with self._connect() as db:
+            removed = db.execute("DELETE FROM tiles").rowcount
+        self._stored_size = 0
+        with self._connect() as db:
+            db.execute("VACUUM")
+        return removed
+
+    def size(self):
+        """
+        Returns the number of cached tiles and their size in bytes.
+        """
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles").fetchone()
+
+    def report(self):
+        """
+        Returns the hit and miss counts as text.
+        """
+        return f"Basemap tile cache: {self.hits} hit(s), {self.misses} miss(es)"
+
+
+def tile_source(spec):
+    """
+    Creates the tile source described by a config value.
+
+    :param spec: URL template with {z}/{x}/{y} (tile server), path to a .mbtiles file, path to a tile folder, None,
+        or an object with a get_tile(z, x, y) method that is used as it is
+    :return: A tile source with a get_tile(z, x, y) method, or None
+    """
+    if not spec:
+        return None
+    if hasattr(spec, "get_tile"):
+        return spec
+    if spec.startswith(("http://", "https://")):
+        return UrlTileSource(spec)
+    if spec.endswith(".mbtiles"):
+        return MBTilesSource(spec)
+    return DirectoryTileSource(spec)
+
+
+def is_public_tile_server(spec):
+    """
+    Tells if a tile source is one of the public servers of PUBLIC_TILE_HOSTS, which must not be used for bulk
+    downloads.
+
+    :param spec: Tile source config value (see tile_source())
+    :return: True for a URL of a public tile server
+    """
+    if not isinstance(spec, str) or not spec.startswith(("http://", "https://")):
+        return False
+    host = urlsplit(spec).hostname or ""
+    return any(host == public or host.endswith("." + public) for public in PUBLIC_TILE_HOSTS)
+
+
+def basemap_zoom(lonlat_bounds, max_zoom=19):
+    """
+    Returns the zoom level for a map of an area, the same level contextily chooses automatically.
+
+    :param lonlat_bounds: Tuple (west, south, east, north) in degrees
+    :param max_zoom: Highest zoom level of the tile source
+    """
+    west, south, east, north = lonlat_bounds
+    zoom_lon = math.ceil(math.log2(360 * 2.0 / (east - west)))
+    zoom_lat = math.ceil(math.log2(360 * 2.0 / (north - south)))
+    return min(zoom_lon, zoom_lat, max_zoom)
+
+
+def tile_range(lonlat_bounds, zoom):
+    """
+    Returns the XYZ tile indices that cover an area.
+
+    :param lonlat_bounds: Tuple (west, south, east, north) in degrees
+    :param zoom: Zoom level
+    :return: List of (x, y) tuples
+    """
+    west, south, east, north = lonlat_bounds
+    n = 2 ** zoom
+
+    def column(lon):
+        return min(max(int((lon + 180) / 360 * n), 0), n - 1)
+
+    def row(lat):
+        lat = math.radians(max(min(lat, 85.0511), -85.0511))
+        return min(max(int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n), 0), n - 1)
+
+    return [(x, y) for x in range(column(west), column(east) + 1) for y in range(row(north), row(south) + 1)]
+
+
+def lower_zoom_tile(tile_cache, z, x, y, max_levels=8):
+    """
+    Builds a tile from the highest cached lower zoom level: the part of the lower zoom tile that covers it is cut out
+    and upscaled. Only cached tiles are used (no downloads), e.g. on a node seeded with `prefetch` up to zoom 13.
+
+    :param tile_cache: TileCache (or any tile source)
+    :param z: Zoom level of the missing tile
+    :param x: Column of the missing tile
+    :param y: Row of the missing tile
+    :param max_levels: Number of lower zoom levels that are tried, a tile of 8 levels below is cut down to one pixel
+    :return: RGBA numpy array of TILE_SIZE x TILE_SIZE pixels, or None if no lower zoom level is cached either
+    """
+    lookup = getattr(tile_cache, "cached_tile", tile_cache.get_tile)
+    for levels in range(1, min(max_levels, z) + 1):
+        data = lookup(z - levels, x >> levels, y >> levels)
+        if data is None:
+            continue
+        size = TILE_SIZE >> levels
+        left, top = (x % 2 ** levels) * size, (y % 2 ** levels) * size
+        parent = Image.open(BytesIO(data)).convert("RGBA").resize((TILE_SIZE, TILE_SIZE))
+        return np.asarray(parent.crop((left, top, left + size, top + size)).resize((TILE_SIZE, TILE_SIZE), Image.BILINEAR))
+    return None
+
+
+def render_basemap(tile_cache, lonlat_bounds, max_zoom=19):
+    """
+    Stitches the tiles that cover an area into one image. Tiles that are neither cached nor available from the source
+    are upscaled from the highest cached lower zoom level (see lower_zoom_tile()), or stay transparent.
+
+    :param tile_cache: TileCache (or any tile source)
+    :param lonlat_bounds: Tuple (west, south, east, north) in degrees
+    :param max_zoom: Highest zoom level of the tile source
+    :return: Tuple (RGBA numpy array, (left, right, bottom, top) extent in EPSG:3857, number of tiles missing at the
+        zoom level of the map, including the upscaled ones)
+    """
+    zoom = basemap_zoom(lonlat_bounds, max_zoom)
+    tiles = tile_range(lonlat_bounds, zoom)
+    xs = [x for x, _ in tiles]
+    ys = [y for _, y in tiles]
+    image = np.zeros(((max(ys) - min(ys) + 1) * TILE_SIZE, (max(xs) - min(xs) + 1) * TILE_SIZE, 4), dtype=np.uint8)
+
+    missing = 0
+    for x, y in tiles:
+        data = tile_cache.get_tile(zoom, x, y)
+        if data is None:
+            missing += 1
+            tile = lower_zoom_tile(tile_cache, zoom, x, y)
+            if tile is None:
+                continue
+        else:
+            tile = np.asarray(Image.open(BytesIO(data)).convert("RGBA").resize((TILE_SIZE, TILE_SIZE)))
+        row, col = (y - min(ys)) * TILE_SIZE, (x - min(xs)) * TILE_SIZE
+        image[row:row + TILE_SIZE, col:col + TILE_SIZE] = tile
+
+    tile_width = 2 * MERCATOR_HALF_WORLD / 2 ** zoom
+    extent = (
+        -MERCATOR_HALF_WORLD + min(xs) * tile_width,
+        -MERCATOR_HALF_WORLD + (max(xs) + 1) * tile_width,
+        MERCATOR_HALF_WORLD - (max(ys) + 1) * tile_width,
+        MERCATOR_HALF_WORLD - min(ys) * tile_width,
+    )
+    return image, extent, missing
+
+
+if __name__ == "__main__":
+    # e.g. `python tile_cache.py prefetch --source https://tiles.example.org/{z}/{x}/{y}.png` with your own tile server
+    # (or --source tiles.mbtiles), then copy the cache to the processing nodes, which keep BASEMAP_SOURCE = None
+    parser = argparse.ArgumentParser(description="Manage the offline cache of basemap tiles used by the PDF reports.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    prefetch_parser = subparsers.add_parser("prefetch", help="download the tiles of an area into the cache")
+    prefetch_parser.add_argument("--source", help="tile server URL with {z}/{x}/{y}, .mbtiles file or tile folder to seed "
+                                                  "from (default: BASEMAP_SOURCE of config.py)")
+    prefetch_parser.add_argument("--bounds", type=float, nargs=4, metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+                                 help="area in degrees (default: extent of the land use raster, Baden-Württemberg)")
+    prefetch_parser.add_argument("--raster", help="prefetch the tiles of the report of this raster (its extent and zoom level)")
+    prefetch_parser.add_argument("--min-zoom", type=int, default=6)
+    prefetch_parser.add_argument("--max-zoom", type=int, default=13,
+                                 help="highest zoom level (default: 13, reports of a town use about 14-15 and upscale the "
+                                      "zoom 13 tiles where these are not cached, use --raster for full detail)")
+    prefetch_parser.add_argument("--workers", type=int, default=2, help="parallel downloads (default: 2)")
+    subparsers.add_parser("info", help="show the number and size of the cached tiles")
+    subparsers.add_parser("clear", help="remove all cached tiles")
+    args = parser.parse_args()
+
+    cache = TileCache.from_config()
+    if args.command == "prefetch":
+        source = args.source or config.BASEMAP_SOURCE
+        if not source:
+            parser.error("no tile source, give --source (your own tile server, an .mbtiles file or a tile folder)")
+        # The OpenStreetMap tile usage policy forbids bulk downloads such as the default area of the whole state
+        if is_public_tile_server(source) and not (args.source or args.bounds or args.raster):
+            parser.error(f"{source} is a public tile server that does not allow bulk downloads, seed the cache from "
+                         f"your own tile server or an .mbtiles file with --source, or give --raster or --bounds")
+        cache.source = tile_source(source)
+        if args.raster:
+            with rasterio.open(args.raster) as src:
+                bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+            zoom = basemap_zoom(bounds)
+            fetched = cache.prefetch(bounds, zoom, zoom, args.workers)
+        else:
+            if args.bounds:
+                bounds = args.bounds
+            else:
+                with rasterio.open(config.LAND_USE_PATH) as src:
+                    bounds = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+            fetched = cache.prefetch(bounds, args.min_zoom, args.max_zoom, args.workers)
+        print(f"Fetched {fetched} tile(s) into {cache.path}")
+    elif args.command == "clear":
+        print(f"Removed {cache.clear()} tile(s) from {cache.path}")
+    else:
+        count, size = cache.size()
+        print(f"{count} cached tile(s), {size / 1024 / 1024:.1f} MB in {cache.path}")
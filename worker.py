@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+import batch
+import config
+from instrumentation import file_sha256
+
+# Reason phrases of the HTTP status codes the worker answers with
+HTTP_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                409: "Conflict", 413: "Payload Too Large", 503: "Service Unavailable"}
+MAX_REQUEST_BYTES = 1024 * 1024
+
+
+def _warm_up():
+    """
+    Runs once in every worker process right after batch._init_worker, so the first job does not pay for hashing the
+    land use file.
+
+    :return: The process id of the worker
+    """
+    file_sha256(config.LAND_USE_PATH)
+    return os.getpid()
+
+
+class RiskWorker:
+    """
+    A class for a long-running worker that keeps a pool of warm processes (modules imported, land use in memory,
+    damage model compiled, caches open) and runs the jobs it receives over a local HTTP API. Each process runs one job
+    at a time, so its in-memory land use dataset is never shared between threads.
+    """
+    def __init__(self, processes=None, queue_size=64, history=1000):
+        """
+        Initializes the RiskWorker object.
+
+        :param processes: Number of worker processes, defaults to the number of CPUs
+        :param queue_size: Number of jobs that can wait for a free process, further jobs are refused with 503
+        :param history: Number of finished jobs whose status is kept for polling
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.history = history
+        self.jobs = {}
+        self.queue = None
+        self.executor = None
+        self.runners = []
+        # "starting", "ready", "restarting" after a worker process died, or "broken" if the pool could not be restarted
+        self.pool_status = "starting"
+        self.pool_restarts = 0
+        self._restart_lock = None
+
+    async def start(self):
+        """
+        Starts the worker processes and waits until every process has loaded its resources.
+        """
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._restart_lock = asyncio.Lock()
+        await self._start_pool()
+        self.runners = [asyncio.create_task(self._run_jobs()) for _ in range(self.processes)]
+
+    async def _start_pool(self):
+        """
+        Creates the pool of worker processes and waits until every process has loaded its resources.
+        """
+        self.executor = ProcessPoolExecutor(max_workers=self.processes, initializer=batch._init_worker)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        pids = await asyncio.gather(*[loop.run_in_executor(self.executor, _warm_up) for _ in range(self.processes)])
+        self.pool_status = "ready"
+        print(f"{len(set(pids))} worker process(es) ready in {time.perf_counter() - start:.1f} s")
+
+    async def _restart_pool(self, broken_executor):
+        """
+        Replaces a pool that is broken because one of its processes died (e.g. killed when out of memory), otherwise
+        every later job would fail. Runners that see the same broken pool restart it only once.
+
+        :param broken_executor: The ProcessPoolExecutor the failed job was submitted to
+        """
+        async with self._restart_lock:
+            if self.executor is not broken_executor:
+                return  # Already replaced by another runner
+            self.pool_status = "restarting"
+            self.pool_restarts += 1
+            print("A worker process died, restarting the worker processes")
+            broken_executor.shutdown(wait=False, cancel_futures=True)
+            try:
+                await self._start_pool()
+            except Exception as e:
+                # The next job tries again, until then /health reports the pool as broken
+                self.pool_status = "broken"
+                print(f"The worker processes could not be restarted: {type(e).__name__}: {e}")
+
+    def stop(self):
+        """
+        Stops the worker processes, queued jobs are dropped and running jobs are finished first.
+        """
+        for runner in self.runners:
+            runner.cancel()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, inputs):
+        """
+        Validates a job and puts it into the queue.
+
+        :param inputs: Dictionary with the keys of a batch scenario (see batch.load_manifest()), relative paths are
+            relative to the working directory of the worker
+        :return: The job dictionary
+        """
+        scenario = batch._parse_scenario(inputs, len(self.jobs) + 1, os.getcwd())
+        output_dir = os.path.abspath(scenario["output_dir"])
+        for job in self.jobs.values():
+            if job["status"] in ("queued", "running") and os.path.abspath(job["scenario"]["output_dir"]) == output_dir:
+                raise FileExistsError(f"Job {job['id']} is already writing to {scenario['output_dir']}")
+
+        job_id = uuid.uuid4().hex[:12]
+        job = {"id": job_id, "name": scenario["name"], "status": "queued", "submitted": _now(), "started": None,
+               "finished": None, "seconds": None, "error": "", "outputs": {}, "scenario": scenario}
+        self.queue.put_nowait(job)  # Raises asyncio.QueueFull when the queue is full
+        self.jobs[job_id] = job
+        self._forget_old_jobs()
+        return job
+
+    async def _run_jobs(self):
+        """
+        Takes jobs from the queue and runs them in the worker processes, one runner per process.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            job["status"] = "running"
+            job["started"] = _now()
+            executor, broken = self.executor, False
+            try:
+                status = await loop.run_in_executor(executor, batch._run_scenario, job["scenario"])
+            except Exception as e:  # BrokenProcessPool if the worker process died, e.g. out of memory
+                status = {"status": "failed", "seconds": None, "error": f"{type(e).__name__}: {e}", "outputs": {}}
+                broken = isinstance(e, BrokenProcessPool)
+            job.update(status=status["status"], seconds=status["seconds"], error=status["error"],
+                       outputs=status["outputs"], finished=_now())
+            print(f"Job {job['id']} ({job['name']}) {job['status']} in {job['seconds']} s {job['error']}")
+            if broken:
+                await self._restart_pool(executor)
+            self.queue.task_done()
+
+    def _forget_old_jobs(self):
+        """
+        Removes the oldest finished jobs above the history limit, the dictionary keeps the submission order.
+        """
+        finished = [job_id for job_id, job in self.jobs.items() if job["finished"]]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def state(self):
+        """
+        Returns the status of the worker processes, their number and restarts, and the number of queued, running and
+        finished jobs.
+        """
+        counts = {"queued": 0, "running": 0, "ok": 0, "failed": 0}
+        for job in self.jobs.values():
+            counts[job["status"]] += 1
+        return {"pool": self.pool_status, "restarts": self.pool_restarts, "processes": self.processes,
+                "queue_size": self.queue_size, **counts}
+
+    async def handle(self, reader, writer):
+        """
+        Answers one HTTP request:
+        - POST /jobs with a JSON scenario queues a job (202 with the job, 503 if the queue is full)
+        - GET /jobs lists the jobs, GET /jobs/<id> returns the status and output paths of one job
+        - GET /health returns the state of the worker (503 while the worker processes are restarting or broken)
+        """
+        try:
+            code, body = await self._route(reader)
+        except (ValueError, KeyError, TypeError) as e:
+            code, body = 400, {"error": f"{type(e).__name__}: {e}"}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        data = json.dumps(body, default=str).encode()
+        header = (f"HTTP/1.1 {code} {HTTP_REASONS[code]}\r\nContent-Type: application/json\r\n"
+                  f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n")
+        writer.write(header.encode() + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, reader):
+        """
+        Reads a request and returns the status code and JSON body of the answer.
+        """
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) != 3:
+            raise ValueError("Malformed request line")
+        method, path = request_line[0], request_line[1].split("?")[0].rstrip("/")
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if path == "/health":
+            return 200 if self.pool_status == "ready" else 503, self.state()
+        if path == "/jobs" and method == "POST":
+            length = int(headers.get("content-length", 0))
+            if length > MAX_REQUEST_BYTES:
+                return 413, {"error": "Request body too large"}
+            inputs = json.loads(await reader.readexactly(length))
+            if not isinstance(inputs, dict):
+                raise TypeError("The job must be a JSON object")
+            try:
+                return 202, _public(self.submit(inputs))
+            except asyncio.QueueFull:
+                return 503, {"error": f"The queue is full ({self.queue_size} jobs waiting), retry later"}
+            except FileExistsError as e:
+                return 409, {"error": str(e)}
+        if path == "/jobs" and method == "GET":
+            return 200, [_public(job) for job in self.jobs.values()]
+        if path.startswith("/jobs/"):
+            if method != "GET":
+                return 405, {"error": f"{method} is not allowed on {path}"}
+            job = self.jobs.get(path[len("/jobs/"):])
+            return (200, _public(job)) if job else (404, {"error": f"Unknown job {path[len('/jobs/'):]}"})
+        return 404, {"error": f"Unknown endpoint {method} {path}"}
+
+
+def _now():
+    """
+    Returns the current UTC time as ISO 8601 text.
+    """
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _public(job):
+    """
+    Returns the job as it is sent to clients, without the parsed scenario.
+    """
+    return {key: value for key, value in job.items() if key != "scenario"}
+
+
+async def serve(host="127.0.0.1", port=8765, socket_path=None, processes=None, queue_size=64):
+    """
+    Runs the worker until it is interrupted (Ctrl+C or SIGTERM).
+
+    :param host: Address the HTTP API listens on, only local clients should reach it
+    :param port: TCP port of the HTTP API
+    :param socket_path: Optional Unix socket path, used instead of host and port (not on Windows)
+    :param processes: Number of worker processes, defaults to the number of CPUs
+    :param queue_size: Number of jobs that can wait for a free process
+    """
+    worker = RiskWorker(processes, queue_size)
+    await worker.start()
+    if socket_path:
+        server = await asyncio.start_unix_server(worker.handle, path=socket_path)
+        address = socket_path
+    else:
+        server = await asyncio.start_server(worker.handle, host, port)
+        address = f"http://{host}:{port}"
+    print(f"Flood risk worker listening on {address}")
+
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal_number, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass  # Windows: Ctrl+C raises KeyboardInterrupt instead
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        worker.stop()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+        print("Flood risk worker stopped")
+
+
+if __name__ == "__main__":
+    # Warm worker for many small jobs, e.g. `python worker.py --port 8765`, then
+    # `curl -X POST localhost:8765/jobs -d '{"flood_depth_file": ..., "return_period": 100, ...}'`
+    parser = argparse.ArgumentParser(description="Serve flood risk jobs from warm worker processes over a local HTTP API.")
+    parser.add_argument("--host", default=config.WORKER_HOST, help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=config.WORKER_PORT, help="TCP port (default: %(default)s)")
+    parser.add_argument("--socket", default=config.WORKER_SOCKET, help="listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--processes", type=int, default=config.WORKER_PROCESSES, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--queue-size", type=int, default=config.WORKER_QUEUE_SIZE, help="number of jobs that can wait (default: %(default)s)")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.socket, args.processes, args.queue_size))
+    except KeyboardInterrupt:
+        pass
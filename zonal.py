@@ -0,0 +1,334 @@
+import argparse
+from contextlib import ExitStack
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.features import rasterize
+from rasterio.warp import transform_geom
+from rasterio.windows import Window
+import config
+from artifact_store import ArtifactStore
+from instrumentation import file_sha256
+from raster import Raster
+
+# Rows of the target grid that are rasterized at once, so large grids need no full-size temporary array
+RASTERIZE_ROWS = 1024
+
+
+def read_zones(vector_path, layer=None, id_field=None):
+    """
+    Reads the polygons of a vector layer. GeoJSON is read directly, GeoPackage, Shapefile and the other OGR formats
+    with fiona (in requirements.txt).
+
+    :param vector_path: Path to the vector file
+    :param layer: Name of the layer (e.g. in a GeoPackage with several layers), the first one if None
+    :param id_field: Attribute that identifies the zones (e.g. the municipality key), the feature position if None
+    :return: Tuple of (list of GeoJSON geometries, list of zone ids, CRS of the geometries)
+    """
+    if os.path.splitext(vector_path)[1].lower() in (".geojson", ".json"):
+        with open(vector_path, encoding="utf-8") as f:
+            collection = json.load(f)
+        # RFC 7946 GeoJSON is always WGS84, older files can name another CRS
+        crs_name = collection.get("crs", {}).get("properties", {}).get("name", "EPSG:4326")
+        features = [(feature["geometry"], feature.get("properties") or {}) for feature in collection["features"]]
+        crs = CRS.from_user_input(crs_name)
+    else:
+        try:
+            import fiona
+        except ImportError:
+            raise ImportError("fiona is needed to read GeoPackage and Shapefile layers, install the requirements with `pip install -r requirements.txt` (or convert the layer to GeoJSON).")
+        with fiona.open(vector_path, layer=layer) as src:
+            features = [(dict(feature["geometry"]), dict(feature["properties"])) for feature in src if feature["geometry"]]
+            crs = CRS.from_wkt(src.crs_wkt)
+
+    geometries = [geometry for geometry, _ in features if geometry]
+    if id_field is None:
+        zone_ids = list(range(1, len(geometries) + 1))
+    else:
+        missing = [position for position, (_, properties) in enumerate(features) if id_field not in properties]
+        if missing:
+            raise ValueError(f"Zone layer {vector_path}: {len(missing)} feature(s) have no attribute {id_field!r}.")
+        zone_ids = [properties[id_field] for geometry, properties in features if geometry]
+    return geometries, zone_ids, crs
+
+
+def _vector_hash(vector_path):
+    """
+    Hashes a vector file, together with its sidecar files for Shapefiles (.dbf, .shx, .prj, ...).
+    """
+    stem = os.path.splitext(vector_path)[0]
+    paths = sorted(glob.glob(f"{glob.escape(stem)}.*")) if vector_path.lower().endswith(".shp") else [vector_path]
+    return [file_sha256(path) for path in paths]
+
+
+class ZoneIndex:
+    """
+    A class holding a polygon layer rasterized onto a raster grid: a zone number for every pixel (0 outside of all
+    zones) and the zone id of every number
+    """
+    def __init__(self, zones, zone_ids):
+        """
+        Initializes the ZoneIndex object.
+
+        :param zones: numpy array (or memmap) with the zone number of every pixel, 0 outside of all zones
+        :param zone_ids: Sequence of the zone ids, zone number i has the id zone_ids[i - 1]
+        """
+        self.zones = zones
+        self.zone_ids = list(zone_ids)
+
+    @classmethod
+    def from_vector(cls, vector_path, target_raster, layer=None, id_field=None, all_touched=False, cache=None):
+        """
+        Rasterizes a polygon layer onto the grid of a raster. With a cache, every layer is rasterized once per grid
+        and later runs memory-map the stored zone raster.
+
+        Where polygons overlap, the pixel belongs to the last polygon of the layer.
+
+        :param vector_path: Path to the vector file (GeoJSON, or with fiona GeoPackage, Shapefile, ...)
+        :param target_raster: Raster object whose grid (CRS, transform, shape) the zones are rasterized to
+        :param layer: Name of the layer, the first one if None
+        :param id_field: Attribute that identifies the zones, the feature position if None
+        :param all_touched: If True, every pixel touched by a polygon belongs to it, otherwise only pixels whose
+            center is inside
+        :param cache: Optional ArtifactStore for the rasterized layers
+        :return: ZoneIndex object
+        """
+        key = None
+        if cache is not None:
+            key = cache.key(
+                "zones", vector=_vector_hash(vector_path), layer=layer, id_field=id_field, all_touched=all_touched,
+                crs=target_raster.crs.to_wkt(), transform=list(target_raster.transform)[:6], shape=list(target_raster.shape)
+            )
+            cached = cache.get(key)
+            if cached is not None:
+                return cls(cached["zones"], cached["zone_ids"].tolist())
+
+        geometries, zone_ids, crs = read_zones(vector_path, layer, id_field)
+        if not geometries:
+            raise ValueError(f"Zone layer {vector_path} has no polygons.")
+        if crs != target_raster.crs:
+            geometries = [transform_geom(crs, target_raster.crs, geometry) for geometry in geometries]
+        dtype = np.uint16 if len(geometries) < np.iinfo(np.uint16).max else np.uint32
+        shapes = [(geometry, number) for number, geometry in enumerate(geometries, start=1)]
+
+        height, width = target_raster.shape
+        strips = [Window(0, row, width, min(RASTERIZE_ROWS, height - row)) for row in range(0, height, RASTERIZE_ROWS)]
+
+        def burn(zones):
+            for window in strips:
+                zones[window.toslices()] = rasterize(
+                    shapes, out_shape=(window.height, window.width), fill=0, all_touched=all_touched, dtype=dtype,
+                    transform=rasterio.windows.transform(window, target_raster.transform)
+                )
+
+        if cache is None:
+            zones = np.zeros(target_raster.shape, dtype=dtype)
+            burn(zones)
+            return cls(zones, zone_ids)
+
+        with cache.put(key) as writer:
+            burn(writer.array("zones", target_raster.shape, dtype))
+            # Integer ids stay integers, everything else is stored as text
+            if all(isinstance(zone_id, (int, np.integer)) and not isinstance(zone_id, bool) for zone_id in zone_ids):
+                ids = np.array(zone_ids, dtype=np.int64)
+            else:
+                ids = np.array([str(zone_id) for zone_id in zone_ids], dtype=str)
+            writer.array("zone_ids", ids.shape, ids.dtype)[:] = ids
+        cached = cache.load(key)
+        return cls(cached["zones"], cached["zone_ids"].tolist())
+
+
+class ZonalStatistics:
+    """
+    A class for summing the risk per zone, and per zone and land use class, block by block with bincount
+    """
+    def __init__(self, zone_index, no_data_value, land_use_nodata=None):
+        """
+        Initializes the ZonalStatistics object.
+
+        :param zone_index: ZoneIndex on the grid of the risk raster
+        :param no_data_value: No-data value of the risk raster, these pixels are not counted
+        :param land_use_nodata: No-data value of the land use raster, excluded from the cross-tabulation
+        """
+        self.zone_index = zone_index
+        self.no_data_value = no_data_value
+        self.land_use_nodata = land_use_nodata
+        zone_count = len(zone_index.zone_ids) + 1  # Zone number 0 collects the pixels outside of all zones
+        self.sums = np.zeros(zone_count)
+        self.counts = np.zeros(zone_count, dtype=np.int64)
+        self.class_sums = np.zeros((zone_count, 0))
+        self.class_counts = np.zeros((zone_count, 0), dtype=np.int64)
+
+    def update(self, window, risk, land_use=None):
+        """
+        Adds a block of the risk raster and optionally the land use classes on the same pixels.
+
+        :param window: rasterio Window of the block, selects the zones of the block
+        :param risk: numpy array with risk values
+        :param land_use: Optional numpy array with the land use classes of the block, for the cross-tabulation
+        :return: The ZonalStatistics object itself
+        """
+        zones = np.asarray(self.zone_index.zones[window.toslices()]).ravel()
+        risk = np.asarray(risk).ravel()
+        valid = (risk != self.no_data_value) & ~np.isnan(risk)
+        zones, values = zones[valid], risk[valid].astype(np.float64)
+        size = self.sums.size
+        self.sums += np.bincount(zones, weights=values, minlength=size)
+        self.counts += np.bincount(zones, minlength=size)
+
+        if land_use is not None:
+            classes = np.asarray(land_use).ravel()[valid]
+            keep = classes >= 0
+            if self.land_use_nodata is not None:
+                keep &= classes != self.land_use_nodata
+            zones, values, classes = zones[keep], values[keep], classes[keep].astype(np.int64)
+            if classes.size:
+                width = max(self.class_sums.shape[1], int(classes.max()) + 1)
+                if width > self.class_sums.shape[1]:
+                    padding = ((0, 0), (0, width - self.class_sums.shape[1]))
+                    self.class_sums = np.pad(self.class_sums, padding)
+                    self.class_counts = np.pad(self.class_counts, padding)
+                # One bincount over the combined (zone, class) position fills the whole cross-table
+                combined = zones.astype(np.int64) * width + classes
+                self.class_sums += np.bincount(combined, weights=values, minlength=size * width).reshape(size, width)
+                self.class_counts += np.bincount(combined, minlength=size * width).reshape(size, width)
+        return self
+
+    def to_dataframe(self):
+        """
+        Returns the risk of every zone, zones without valid pixels included.
+
+        :return: pandas DataFrame with the columns Zone, Total Risk, Average Risk and Pixel Count
+        """
+        counts = self.counts[1:]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            average = np.where(counts > 0, self.sums[1:] / counts, np.nan)
+        return pd.DataFrame({
+            "Zone": self.zone_index.zone_ids,
+            "Total Risk": self.sums[1:],
+            "Average Risk": average,
+            "Pixel Count": counts,
+        })
+
+    def crosstab_dataframe(self):
+        """
+        Returns the total risk of every zone and land use class, only classes that occur in a zone are columns.
+
+        :return: pandas DataFrame with a Zone column and one column of total risk per land use class
+        """
+        present = np.flatnonzero(self.class_counts[1:].sum(axis=0))
+        table = pd.DataFrame(self.class_sums[1:, present], columns=[int(code) for code in present])
+        table.insert(0, "Zone", self.zone_index.zone_ids)
+        return table
+
+
+def aggregate_risk(risk_path, zone_index, land_use=None, land_use_nodata=None, block_size=0):
+    """
+    Computes the zonal statistics of a risk GeoTIFF window by window.
+
+    :param risk_path: Path to the risk GeoTIFF, its no-data value marks pixels without risk
+    :param zone_index: ZoneIndex on the grid of the risk raster
+    :param land_use: Optional land use classes for the cross-tabulation: an array on the risk grid (e.g. from the
+        resample cache), or the path to (or open dataset of) a land use raster, which is warped window by window
+    :param land_use_nodata: No-data value of the land use classes, read from the raster if land_use is not an array
+    :param block_size: Side length in pixels of the windows, 0 uses the internal blocks of the risk raster
+    :return: ZonalStatistics object
+    """
+    risk_raster = Raster(risk_path)
+    if tuple(zone_index.zones.shape) != tuple(risk_raster.shape):
+        raise ValueError("The zone index was rasterized onto another grid than the risk raster.")
+
+    with ExitStack() as stack:
+        src = stack.enter_context(rasterio.open(risk_path))
+        vrt = None
+        if land_use is not None and not isinstance(land_use, np.ndarray):
+            land_use_nodata = land_use.nodata if hasattr(land_use, "nodata") else Raster(land_use).nodata
+            vrt = stack.enter_context(risk_raster.open_resampled(land_use, Resampling[config.LAND_USE_RESAMPLING]))
+
+        statistics = ZonalStatistics(zone_index, risk_raster.nodata, land_use_nodata)
+        for window in risk_raster.iter_windows(block_size):
+            if vrt is not None:
+                land_use_block = vrt.read(1, window=window)
+            elif land_use is not None:
+                land_use_block = land_use[window.toslices()]
+            else:
+                land_use_block = None
+            statistics.update(window, src.read(1, window=window), land_use_block)
+    return statistics
+
+
+def save_zonal_tables(statistics, output_dir, name):
+    """
+    Saves zonal_risk_<name>.csv and, if land use classes were given, zonal_land_use_<name>.csv.
+
+    :param statistics: ZonalStatistics object
+    :param output_dir: Folder of the CSV files
+    :param name: Name of the zone layer, e.g. "municipality"
+    :return: Dictionary of output name -> path
+    """
+    paths = {f"zonal_{name}": os.path.join(output_dir, f"zonal_risk_{name}.csv")}
+    statistics.to_dataframe().to_csv(paths[f"zonal_{name}"], index=False)
+    print(f"Risk by {name} saved to {paths[f'zonal_{name}']}")
+    if statistics.class_counts.size:
+        paths[f"zonal_land_use_{name}"] = os.path.join(output_dir, f"zonal_land_use_{name}.csv")
+        statistics.crosstab_dataframe().to_csv(paths[f"zonal_land_use_{name}"], index=False)
+        print(f"Risk by {name} and land use class saved to {paths[f'zonal_land_use_{name}']}")
+    return paths
+
+
+def run_zonal(risk_path, zone_layers, output_dir, land_use=None, block_size=0, cache=None, land_use_nodata=None):
+    """
+    Computes and saves the zonal statistics of a risk GeoTIFF for several zone layers.
+
+    :param risk_path: Path to the risk GeoTIFF
+    :param zone_layers: List of dictionaries with the keys "name" and "path", and optionally "layer", "id_field" and
+        "all_touched" (see config.ZONE_LAYERS)
+    :param output_dir: Folder of the CSV files
+    :param land_use: Optional land use classes for the cross-tabulation (see aggregate_risk)
+    :param block_size: Side length in pixels of the windows, 0 uses the internal blocks of the risk raster
+    :param cache: Optional ArtifactStore for the rasterized layers
+    :param land_use_nodata: No-data value of the land use classes, read from the raster if land_use is not an array
+    :return: Dictionary of output name -> path
+    """
+    risk_raster = Raster(risk_path)
+    paths = {}
+    for zone_layer in zone_layers:
+        zone_index = ZoneIndex.from_vector(
+            zone_layer["path"], risk_raster, zone_layer.get("layer"), zone_layer.get("id_field"),
+            zone_layer.get("all_touched", False), cache
+        )
+        statistics = aggregate_risk(risk_path, zone_index, land_use, land_use_nodata, block_size)
+        paths.update(save_zonal_tables(statistics, output_dir, zone_layer["name"]))
+    return paths
+
+
+def zone_cache():
+    """
+    Returns the ArtifactStore of the rasterized zone layers configured in config.py, or None if it is disabled.
+    """
+    return ArtifactStore(config.ZONE_CACHE_DIR, config.ZONE_CACHE_SIZE_MB) if config.ZONE_CACHE_DIR else None
+
+
+if __name__ == "__main__":
+    # e.g. `python zonal.py output/risk_output.tif data/municipalities.gpkg --id-field AGS --name municipality`
+    parser = argparse.ArgumentParser(description="Sum the risk of a risk GeoTIFF per polygon of a vector layer.")
+    parser.add_argument("risk", help="risk GeoTIFF written by the tool")
+    parser.add_argument("zones", help="vector file with the zone polygons (GeoJSON, or GeoPackage/Shapefile with fiona)")
+    parser.add_argument("--layer", help="layer of the vector file (default: the first one)")
+    parser.add_argument("--id-field", help="attribute that identifies the zones (default: feature number)")
+    parser.add_argument("--name", default="zone", help="name used in the CSV file names (default: zone)")
+    parser.add_argument("--all-touched", action="store_true", help="count every pixel touched by a polygon")
+    parser.add_argument("--no-land-use", action="store_true", help="skip the cross-tabulation by land use class")
+    parser.add_argument("--output-dir", help="folder of the CSV files (default: folder of the risk GeoTIFF)")
+    args = parser.parse_args()
+
+    layers = [{"name": args.name, "path": args.zones, "layer": args.layer, "id_field": args.id_field, "all_touched": args.all_touched}]
+    run_zonal(
+        args.risk, layers, args.output_dir or os.path.dirname(os.path.abspath(args.risk)),
+        None if args.no_land_use else config.LAND_USE_PATH, cache=zone_cache()
+    )